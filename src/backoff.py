@@ -0,0 +1,222 @@
+"""Witten-Bell smoothed Markov models with precomputed backoff tables.
+
+The models saved by `markov.py` give zero probability to anything unseen in
+training, and `generate_second_order` falls back to re-sampling the whole
+starting distribution when it reaches an unseen context. A `BackoffModel`
+instead interpolates each order with the one below it, down to unigrams:
+
+    P(c | a, b) = C(a, b, c) / (C(a, b) + T(a, b)) + bow(a, b) * P(c | b)
+    P(c | b)    = C(b, c) / (C(b) + T(b))          + bow(b) * P(c)
+    bow(ctx)    = T(ctx) / (C(ctx) + T(ctx))
+
+where C counts occurrences in the corpus and T(ctx) is the number of
+distinct values seen after ctx. An unseen context has no row, so its
+distribution is just the one of the shorter context, found with one dict
+lookup per order. A context's interpolated distribution is built the first
+time it is asked for and kept (read-only) in an LRU cache of
+`CACHE_ROWS` rows, so sampling a long melody costs a few dict lookups per
+note instead of a copy of the vocabulary. Each cached row is a dense array
+over the vocabulary, so the cache holds at most `CACHE_ROWS` * V floats.
+
+Everything is stored as arrays over value codes (indices into the sorted
+vocabulary): per order, the sorted context codes, the seen continuations in
+CSR form with their counts / (C + T), and the backoff weights.
+"""
+
+import math
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+from build_graph import atomic_pickle_dump
+import instrument
+
+ORDERS = {'first': 1, 'second': 2}
+# Interpolated distributions kept per model (about 1 MB at a vocabulary of 128)
+CACHE_ROWS = 1024
+
+
+class BackoffModel:
+    def __init__(self, order, values, unigram, layers):
+        """
+        `order`: `first` or `second`
+        `values`: the vocabulary, sorted by value
+        `unigram`: probability of each value
+        `layers`: one dict per context length (1, then 2), with arrays `contexts`
+          (sorted context codes), `indptr`, `indices`, `probs` (count / (C + T)) and `bow`
+        """
+        self.order = order
+        self.values = values
+        self.unigram = unigram
+        self.layers = layers
+        self.vocab = np.array([float(v) for v in values])
+        self.code_of = {v: i for i, v in enumerate(values)}
+        self.rows = [{c: r for r, c in enumerate(layer["contexts"].tolist())} for layer in layers]
+        self.unigram.flags.writeable = False
+        # (context length, row) -> interpolated distribution, least recently used first
+        self.cache = OrderedDict()
+
+    @property
+    def num_values(self):
+        return len(self.values)
+
+    def context_code(self, codes):
+        """Code of a context given as value codes, oldest first."""
+        code = 0
+        for c in codes:
+            code = code * self.num_values + c
+        return code
+
+    def distribution(self, context):
+        """
+        Input:
+        `context`: the previous values, oldest first (at most `order` are used)
+
+        Returns:
+            read-only array of next-value probabilities, aligned with `values`.
+        """
+        codes = [self.code_of.get(v) for v in context]
+        rows = []
+        for k in range(1, len(self.layers) + 1):
+            if len(codes) < k or None in codes[-k:]:
+                break
+            row = self.rows[k - 1].get(self.context_code(codes[-k:]))
+            if row is None:
+                # Longer contexts that end in an unseen one are unseen too
+                break
+            rows.append(row)
+        if not rows:
+            return self.unigram
+
+        cache_key = (len(rows), rows[-1])
+        if cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+            return self.cache[cache_key]
+        probs = self.unigram.copy()
+        for layer, row in zip(self.layers, rows):
+            lo, hi = layer["indptr"][row], layer["indptr"][row + 1]
+            probs *= layer["bow"][row]
+            probs[layer["indices"][lo:hi]] += layer["probs"][lo:hi]
+        probs.flags.writeable = False
+        self.cache[cache_key] = probs
+        if len(self.cache) > CACHE_ROWS:
+            self.cache.popitem(last=False)
+        return probs
+
+    def score(self, sequences, min_prob=1e-6):
+        """
+        Log-likelihood of each sequence: the first value under the unigrams,
+        the second under first order, and so on up to `order`. Values outside
+        the vocabulary get `min_prob` and are counted as unseen.
+
+        Returns:
+            (log_likelihood, unseen): arrays with one entry per sequence.
+        """
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        num_sequences = len(sequences)
+        flat = np.fromiter((float(v) for seq in sequences for v in seq), dtype=float, count=int(lengths.sum()))
+        seq_ids = np.repeat(np.arange(num_sequences), lengths)
+        offsets = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        pos = np.minimum(np.searchsorted(self.vocab, flat), len(self.vocab) - 1)
+        known = self.vocab[pos] == flat
+        codes = np.where(known, pos, 0)
+
+        probs = self.unigram[codes]
+        context = np.zeros(len(flat), dtype=np.int64)
+        context_known = np.ones(len(flat), dtype=bool)
+        for k, layer in enumerate(self.layers, start=1):
+            # Extend each token's context by the value k positions back
+            has = offsets >= k
+            prev = np.zeros(len(flat), dtype=np.int64)
+            prev[k:] = codes[:-k]
+            prev_known = np.zeros(len(flat), dtype=bool)
+            prev_known[k:] = known[:-k]
+            context = prev * self.num_values ** (k - 1) + context
+            context_known &= prev_known & has
+
+            contexts = layer["contexts"]
+            row = np.minimum(np.searchsorted(contexts, context), max(len(contexts) - 1, 0))
+            seen = context_known & (contexts[row] == context) if len(contexts) else np.zeros(len(flat), dtype=bool)
+
+            keys = layer["rows"] * self.num_values + layer["indices"]
+            edge_keys = row * self.num_values + codes
+            edge = np.minimum(np.searchsorted(keys, edge_keys), max(len(keys) - 1, 0))
+            continuation = np.where(seen & (keys[edge] == edge_keys), layer["probs"][edge], 0.0)
+            probs = np.where(seen, continuation + layer["bow"][row] * probs, probs)
+
+        log_probs = np.where(known, np.log(np.maximum(probs, 1e-300)), math.log(min_prob))
+        log_likelihood = np.bincount(seq_ids, weights=log_probs, minlength=num_sequences)
+        unseen = np.bincount(seq_ids, weights=~known, minlength=num_sequences).astype(np.int64)
+        log_likelihood[lengths == 0] = np.nan
+        return log_likelihood, unseen
+
+    def nbytes(self):
+        return self.unigram.nbytes + sum(a.nbytes for layer in self.layers for a in layer.values())
+
+    def save(self, path):
+        atomic_pickle_dump({"order": self.order, "values": self.values, "unigram": self.unigram,
+                            "layers": self.layers}, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(**pickle.load(f))
+
+
+def construct_backoff(data, order, save_to_file=None):
+    """
+    Input:
+    `data`: list of sequences of values (pitches or durations)
+    `order`: `first` or `second`
+
+    Returns:
+        the Witten-Bell BackoffModel of the sequences.
+    """
+    sequences = [list(seq) for seq in data]
+    values = {}
+    for seq in sequences:
+        for v in seq:
+            values.setdefault(float(v), v)
+    vocab = sorted(values)
+    num_values = len(vocab)
+
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    flat = np.fromiter((float(v) for seq in sequences for v in seq), dtype=float, count=int(lengths.sum()))
+    codes = np.searchsorted(np.array(vocab), flat)
+    offsets = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    unigram = np.bincount(codes, minlength=num_values).astype(float)
+    unigram /= max(unigram.sum(), 1)
+
+    layers = []
+    context = np.zeros(len(flat), dtype=np.int64)
+    for k in range(1, ORDERS[order] + 1):
+        prev = np.zeros(len(flat), dtype=np.int64)
+        prev[k:] = codes[:-k]
+        context = prev * num_values ** (k - 1) + context
+        has = offsets >= k
+
+        # Distinct (context, next value) pairs and their counts, sorted by context then value
+        pairs, counts = np.unique(context[has] * num_values + codes[has], return_counts=True)
+        pair_contexts, indices = np.divmod(pairs, num_values)
+        contexts, first_edge, distinct = np.unique(pair_contexts, return_index=True, return_counts=True)
+        totals = np.add.reduceat(counts, first_edge) if len(counts) else np.zeros(0, dtype=np.int64)
+        rows = np.repeat(np.arange(len(contexts)), distinct)
+
+        layers.append({
+            "contexts": contexts,
+            "indptr": np.append(first_edge, len(pairs)).astype(np.int64),
+            "indices": indices,
+            "rows": rows,
+            "probs": counts / (totals + distinct)[rows],
+            "bow": distinct / (totals + distinct),
+        })
+        instrument.count("transitions_counted", int(counts.sum()))
+
+    model = BackoffModel(order, [values[v] for v in vocab], unigram, layers)
+    if save_to_file:
+        with instrument.span("save_pickle", file=save_to_file):
+            model.save(save_to_file)
+    return model
@@ -0,0 +1,119 @@
+"""Beam search for the most likely pitch sequences of a model.
+
+`generate.py` draws melodies at random. Here the `top_k` most likely pitch
+sequences of a given length are searched for instead, over the
+integer-coded model (see `coded_model.py`). Each step expands every beam
+entry along its CSR row at once, adds the edge log-probabilities and keeps
+the `beam_width` best candidates, all as NumPy array operations.
+
+Candidates that cannot finish the melody are pruned with the backward
+tables of `constrained.py`, so the beam never runs into a dead end (a
+state without successors) and, under a `Constraint`, only keeps sequences
+that stay in key and in range and end where required. With `beam_width`
+at least the number of states and `top_k` 1, this is exact Viterbi
+decoding.
+
+Scores are log-probabilities of the pitch sequence under the unconstrained
+model: log P(start) + sum of log P(next | current).
+"""
+
+import numpy as np
+
+from coded_model import coded
+from constrained import Constraint, InfeasibleConstraint, feasibility_table
+
+# Log-probabilities of beam outputs, saved next to them by `generate.py` and read by `evaluate.py`
+SCORES_FILE = 'scores.json'
+
+
+def expand(model, states):
+    """
+    Every outgoing edge of the given states.
+    Returns (position in `states` of each edge's source, edge indices into the CSR arrays).
+    """
+    lo = model.indptr[states]
+    counts = model.indptr[states + 1] - lo
+    parents = np.repeat(np.arange(len(states)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return parents, np.repeat(lo, counts) + offsets
+
+
+def best(scores, n):
+    """Indices of the `n` highest scores, best first."""
+    if len(scores) > n:
+        top = np.argpartition(-scores, n - 1)[:n]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def beam_search(model, num_notes, beam_width=64, top_k=1, table=None):
+    """
+    Input:
+    `model`: a CodedModel of the pitch chain
+    `num_notes`: length of the pitch sequences
+    `beam_width`: candidates kept after each step
+    `top_k`: how many sequences to return (at most `beam_width`)
+    `table`: optional FeasibilityTable restricting the sequences
+
+    Returns:
+        list of (pitches, log_prob), most likely first.
+    """
+    if top_k > beam_width:
+        raise ValueError(f"top_k ({top_k}) can't exceed beam_width ({beam_width})")
+
+    first_notes = 2 if model.order == 'second' else 1
+    num_notes = max(num_notes, first_notes)
+    steps = num_notes - first_notes
+
+    candidates = np.flatnonzero(model.start > 0)
+    if table is not None:
+        candidates = candidates[table.beta(steps)[candidates] > 0]
+    if len(candidates) == 0:
+        if table is None:
+            raise InfeasibleConstraint("The model has no start states")
+        raise InfeasibleConstraint(f"No {num_notes}-note melody satisfies {table.constraint} under this model")
+
+    scores = np.log(model.start[candidates])
+    keep = best(scores, beam_width)
+    states, scores = candidates[keep], scores[keep]
+    first_states = states
+
+    # Per step: the parent position of each beam entry in the previous beam, and its state
+    history = []
+    for remaining in range(steps - 1, -1, -1):
+        parents, edges = expand(model, states)
+        nexts = model.indices[edges]
+        cand_scores = scores[parents] + model.log_probs[edges]
+        if table is not None:
+            ok = table.beta(remaining)[nexts] > 0
+            parents, nexts, cand_scores = parents[ok], nexts[ok], cand_scores[ok]
+
+        keep = best(cand_scores, beam_width)
+        states, scores = nexts[keep], cand_scores[keep]
+        history.append((parents[keep], states))
+
+    results = []
+    for rank in range(min(top_k, len(states))):
+        position = rank
+        values = []
+        for parents, step_states in reversed(history):
+            values.append(model.values[step_states[position]])
+            position = parents[position]
+        head = model.states[first_states[position]]
+        pitches = (list(head) if model.order == 'second' else [head]) + values[::-1]
+        results.append((pitches, float(scores[rank])))
+    return results
+
+
+def decode(pitch_model, starting_pitch_dist, order, num_notes, beam_width=64, top_k=1, constraint=None, scales=None):
+    """
+    `beam_search` on a model as saved by `markov.py`, pruned with the
+    feasibility table of `constraint` (no constraint just rules out dead ends).
+
+    Returns:
+        list of (pitches, log_prob), most likely first.
+    """
+    model = coded(pitch_model, starting_pitch_dist, order)
+    table = feasibility_table(pitch_model, starting_pitch_dist, order, constraint or Constraint(), scales or {})
+    return beam_search(model, num_notes, beam_width, top_k, table)
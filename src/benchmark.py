@@ -0,0 +1,338 @@
+"""Benchmark the preprocess, train, generate and evaluate stages.
+
+Everything runs on synthetic data made from a fixed seed, so results are
+comparable between machines and commits:
+  - parse_midi / analyze_midi_file: synthetic MIDI corpora of N files
+  - construct_first_order / construct_second_order: N synthetic sequences
+  - train_absolute / train_intervals: second-order pitch models of the same
+    N sequences on absolute pitches and on intervals, with their model size
+  - train_raw_durations / train_quantized_durations: second-order duration
+    models of N jittered sequences, before and after quantization
+  - generate_first_order / generate_second_order: melodies of N seconds
+
+Each benchmark reports the best wall-clock time over `--repeats` runs, the
+throughput (files/s, transitions/s or notes/s) and the peak memory traced
+during one extra run.
+
+Usage (from repository root):
+    python3 src/benchmark.py -o evaluation/benchmark.json
+    python3 src/benchmark.py --compare evaluation/benchmark.json
+"""
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import music21
+from music21 import stream, note, chord, midi
+
+from parse_midi import parse_midi, REST
+from markov import construct_first_order, construct_second_order
+from generate import generate_first_order, generate_second_order
+from evaluate import analyze_midi_file
+from build_graph import atomic_write_bytes
+from intervals import to_intervals
+from quantize import quantize_sequence
+
+DURATIONS = [0.25, 0.5, 0.5, 1.0, 1.0, 1.5, 2.0]
+
+
+def synthetic_sequences(num_sequences, seq_length, seed=0):
+    """
+    Returns (pitches, durations): `num_sequences` random-walk melodies of
+    `seq_length` notes each, with occasional rests.
+    """
+    rng = random.Random(seed)
+    all_pitches = []
+    all_durations = []
+    for _ in range(num_sequences):
+        pitch = rng.randint(55, 79)
+        pitches = []
+        durations = []
+        for _ in range(seq_length):
+            if rng.random() < 0.05:
+                pitches.append(REST)
+            else:
+                pitch = min(max(pitch + rng.choice([-4, -2, -1, 0, 1, 2, 4]), 40), 96)
+                pitches.append(pitch)
+            durations.append(rng.choice(DURATIONS))
+        all_pitches.append(pitches)
+        all_durations.append(durations)
+    return all_pitches, all_durations
+
+
+def write_synthetic_corpus(directory, num_files, notes_per_file=200, seed=0):
+    """Write `num_files` synthetic MIDI files (notes, chords and rests) to `directory`."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(num_files):
+        s = stream.Stream()
+        offset = 0.0
+        pitch = rng.randint(55, 79)
+        for _ in range(notes_per_file):
+            pitch = min(max(pitch + rng.choice([-4, -2, -1, 0, 1, 2, 4]), 40), 96)
+            if rng.random() < 0.1:
+                n = chord.Chord([pitch - 7, pitch - 3, pitch])
+            else:
+                n = note.Note(pitch)
+            n.quarterLength = rng.choice(DURATIONS)
+            s.insert(offset, n)
+            # leave a gap now and then so the parser has rests to fill in
+            offset += n.quarterLength + (0.5 if rng.random() < 0.05 else 0.0)
+        path = os.path.join(directory, f"synthetic_{i}.mid")
+        with open(path, 'wb') as f:
+            f.write(midi.translate.streamToMidiFile(s).writestr())
+        paths.append(path)
+    return paths
+
+
+def measure(fn, repeats=3):
+    """
+    Returns (best seconds over `repeats` runs, peak traced memory in MB, result of the last run).
+    Memory is traced in a separate run so tracing doesn't skew the timings.
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / (1024 * 1024), result
+
+
+def record(results, benchmark, scale, seconds, peak_mb, amount, unit, **extra):
+    """Add one result; `extra` fields (e.g. model size) are saved and printed too."""
+    entry = {
+        "benchmark": benchmark,
+        "scale": scale,
+        "seconds": seconds,
+        "throughput": amount / seconds if seconds > 0 else float('inf'),
+        "unit": unit,
+        "peak_mb": peak_mb,
+        **extra,
+    }
+    results.append(entry)
+    details = "".join(f"  {name} {value}" for name, value in extra.items())
+    print(f"  {benchmark:<26} scale={scale:<8} {seconds:9.4f}s  "
+          f"{entry['throughput']:12.1f} {unit:<14} peak {peak_mb:8.2f} MB{details}")
+
+
+def bench_parse_and_analyze(results, file_counts, notes_per_file, repeats, seed):
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_files in file_counts:
+            paths = write_synthetic_corpus(os.path.join(tmp, str(num_files)), num_files, notes_per_file, seed)
+
+            seconds, peak, _ = measure(lambda: [parse_midi(p) for p in paths], repeats)
+            record(results, "parse_midi", num_files, seconds, peak, num_files, "files/s")
+
+            seconds, peak, _ = measure(lambda: [analyze_midi_file(p) for p in paths], repeats)
+            record(results, "analyze_midi_file", num_files, seconds, peak, num_files, "files/s")
+
+
+def bench_construct(results, sequence_counts, seq_length, repeats, seed):
+    for num_sequences in sequence_counts:
+        pitches, _ = synthetic_sequences(num_sequences, seq_length, seed)
+
+        transitions = num_sequences * (seq_length - 1)
+        seconds, peak, _ = measure(lambda: construct_first_order(pitches), repeats)
+        record(results, "construct_first_order", num_sequences, seconds, peak, transitions, "transitions/s")
+
+        transitions = num_sequences * (seq_length - 2)
+        seconds, peak, _ = measure(lambda: construct_second_order(pitches), repeats)
+        record(results, "construct_second_order", num_sequences, seconds, peak, transitions, "transitions/s")
+
+
+def bench_representation(results, sequence_counts, seq_length, repeats, seed):
+    """Second-order pitch models of the same melodies, on absolute pitches and on intervals."""
+    for num_sequences in sequence_counts:
+        pitches, _ = synthetic_sequences(num_sequences, seq_length, seed)
+        transitions = num_sequences * (seq_length - 2)
+        for name, data in [("train_absolute", pitches), ("train_intervals", [to_intervals(p) for p in pitches])]:
+            seconds, peak, (model, start_dist) = measure(lambda: construct_second_order(data), repeats)
+            record(results, name, num_sequences, seconds, peak, transitions, "transitions/s",
+                   states=len(model), edges=sum(len(nexts) for nexts in model.values()),
+                   model_bytes=len(pickle.dumps((model, start_dist))))
+
+
+def jittered_durations(durations, seed=0):
+    """Durations as parsed from performed MIDI: off by a tick or two (at 480 per quarter), with odd gaps."""
+    rng = random.Random(seed)
+    return [[d + rng.choice([-2, -1, 0, 0, 1, 2]) / 480 + (rng.choice([1, 7, 13]) / 96 if rng.random() < 0.05 else 0)
+             for d in seq] for seq in durations]
+
+
+def bench_quantize(results, sequence_counts, seq_length, repeats, seed):
+    """Second-order duration models of the same jittered durations, raw and quantized to a sixteenth/triplet grid."""
+    for num_sequences in sequence_counts:
+        pitches, durations = synthetic_sequences(num_sequences, seq_length, seed)
+        raw = jittered_durations(durations, seed)
+        quantized = [quantize_sequence(p, d) for p, d in zip(pitches, raw)]
+        transitions = num_sequences * (seq_length - 2)
+        for name, data in [("train_raw_durations", raw), ("train_quantized_durations", quantized)]:
+            seconds, peak, (model, start_dist) = measure(lambda: construct_second_order(data), repeats)
+            record(results, name, num_sequences, seconds, peak, transitions, "transitions/s",
+                   vocab=len({v for seq in data for v in seq}), states=len(model),
+                   edges=sum(len(nexts) for nexts in model.values()),
+                   model_bytes=len(pickle.dumps((model, start_dist))))
+
+
+def bench_generate(results, lengths, repeats, seed):
+    pitches, durations = synthetic_sequences(200, 200, seed)
+    first = construct_first_order(pitches), construct_first_order(durations)
+    second = construct_second_order(pitches), construct_second_order(durations)
+
+    for length in lengths:
+        for name, generate_fn, ((p_model, p_dist), (d_model, d_dist)) in [
+            ("generate_first_order", generate_first_order, first),
+            ("generate_second_order", generate_second_order, second),
+        ]:
+            def run():
+                return generate_fn(length, 120, p_model, d_model, p_dist, d_dist, seed=seed)
+            seconds, peak, output = measure(run, repeats)
+            num_notes = len(output.notesAndRests)
+            record(results, name, length, seconds, peak, num_notes, "notes/s")
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Print the throughput change of each benchmark against a saved baseline.
+    Returns the number of benchmarks slower than the baseline by more than `tolerance`.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    old = {(r["benchmark"], r["scale"]): r for r in baseline["results"]}
+
+    regressions = 0
+    print(f"\nComparison against {baseline_path}:")
+    for r in results:
+        prev = old.get((r["benchmark"], r["scale"]))
+        if prev is None:
+            continue
+        change = r["throughput"] / prev["throughput"] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"  {r['benchmark']:<26} scale={r['scale']:<8} {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark parsing, training, generation and evaluation on synthetic data"
+    )
+    parser.add_argument(
+        "--output", "-o",
+        default=None,
+        help="Path to save results as JSON (e.g. evaluation/benchmark.json)"
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="Path to a baseline JSON to compare throughput against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed throughput drop against the baseline before reporting a regression. Default 0.2"
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        nargs="+",
+        default=[5, 20],
+        help="Corpus sizes (MIDI files) for parse_midi and analyze_midi_file"
+    )
+    parser.add_argument(
+        "--notes-per-file",
+        type=int,
+        default=200,
+        help="Notes per synthetic MIDI file. Default 200"
+    )
+    parser.add_argument(
+        "--sequences",
+        type=int,
+        nargs="+",
+        default=[100, 1000],
+        help="Number of sequences for construct_first_order and construct_second_order"
+    )
+    parser.add_argument(
+        "--seq-length",
+        type=int,
+        default=200,
+        help="Notes per synthetic sequence. Default 200"
+    )
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[30, 300],
+        help="Melody lengths (seconds) for generate_first_order and generate_second_order"
+    )
+    parser.add_argument(
+        "--repeats", "-r",
+        type=int,
+        default=3,
+        help="Runs per benchmark; the best time is kept. Default 3"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the synthetic data. Default 0"
+    )
+    args = parser.parse_args()
+
+    print("="*50)
+    print("Running benchmarks...")
+
+    results = []
+    bench_parse_and_analyze(results, args.files, args.notes_per_file, args.repeats, args.seed)
+    bench_construct(results, args.sequences, args.seq_length, args.repeats, args.seed)
+    bench_representation(results, args.sequences, args.seq_length, args.repeats, args.seed)
+    bench_quantize(results, args.sequences, args.seq_length, args.repeats, args.seed)
+    bench_generate(results, args.lengths, args.repeats, args.seed)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "music21": music21.__version__,
+            "seed": args.seed,
+            "repeats": args.repeats,
+            "notes_per_file": args.notes_per_file,
+            "seq_length": args.seq_length,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        atomic_write_bytes(args.output, json.dumps(report, indent=2).encode())
+        print(f"\nSaved benchmark results to {args.output}")
+
+    print("="*50)
+
+    if args.compare:
+        if compare(results, args.compare, args.tolerance) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
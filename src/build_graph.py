@@ -0,0 +1,267 @@
+"""Small dependency-aware build graph used by `pipeline.py`.
+
+Every step has a key: a fingerprint of its parameters, the source code that
+builds it and the keys of the steps it depends on. Raw MIDI inputs are keyed
+by the content of the files themselves. When a step finishes, its key is
+written to a `.stamp` file next to its outputs, so a later run can tell
+whether the outputs are up to date, stale, or left behind by a crashed run
+(outputs without a matching stamp).
+
+Outputs are written with `atomic_write_bytes`/`atomic_pickle_dump`, so a
+reader never sees half a file.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import secrets
+import threading
+
+STAMP_NAME = ".stamp"
+HASH_CACHE_FILE = "data/processed/.raw_hashes.json"
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20) -> str:
+    """Return the sha256 of the contents of `path`."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_values(*values) -> str:
+    """Return a stable fingerprint of JSON-serializable values."""
+    return hash_bytes(json.dumps(values, sort_keys=True, default=str).encode())
+
+
+def hash_source(*filenames) -> str:
+    """Fingerprint source files in `src/`, so code changes invalidate outputs."""
+    return hash_values(*[hash_file(os.path.join(SRC_DIR, f)) for f in filenames])
+
+
+class HashCache:
+    """
+    Content hashes of raw files, reused while a file's size and mtime are unchanged.
+    Saves re-reading tens of thousands of MIDI files on every run.
+    Safe to share between threads (e.g. the jobs of `sweep.py`).
+    """
+    def __init__(self, path=HASH_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def hash(self, path):
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = hash_file(path)
+        with self.lock:
+            self.entries[path] = [st.st_size, st.st_mtime_ns, digest]
+            self.dirty = True
+        return digest
+
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                atomic_write_bytes(self.path, json.dumps(self.entries).encode())
+                self.dirty = False
+
+
+def atomic_write_bytes(path, data: bytes):
+    """Write `data` to `path` through a temporary file and an atomic rename."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # Unlike mkstemp (owner-only files), mode 0o666 lets the process umask apply as for open()
+    while True:
+        tmp_path = os.path.join(directory, f".tmp-{secrets.token_hex(8)}{os.path.basename(path)}")
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_pickle_dump(obj, path):
+    atomic_write_bytes(path, pickle.dumps(obj))
+
+
+def stamp_path(target):
+    """Stamps live inside directory targets and beside file targets."""
+    if os.path.isdir(target):
+        return os.path.join(target, STAMP_NAME)
+    return target + STAMP_NAME
+
+
+def read_stamp(target):
+    try:
+        with open(stamp_path(target), 'r') as f:
+            return json.load(f).get("key")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_stamp(target, key):
+    atomic_write_bytes(stamp_path(target), json.dumps({"key": key}).encode())
+
+
+def file_nonempty(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+
+class Source:
+    """
+    A leaf of the graph: a set of raw input files, keyed by their contents.
+    The key is None when the files are not available on this machine.
+    A `hash_cache` passed in is shared with the caller, who saves it;
+    otherwise the source's own cache is saved by `BuildGraph.run`.
+    """
+    def __init__(self, name, files_fn, hash_cache=None):
+        self.name = name
+        self.files_fn = files_fn
+        self.owns_cache = hash_cache is None
+        self.hash_cache = hash_cache or HashCache()
+        self.deps = []
+        self.key = None
+
+    def resolve(self):
+        files = self.files_fn()
+        if not files:
+            self.key = None
+            return "unavailable"
+        self.key = hash_values(sorted((f, self.hash_cache.hash(f)) for f in files))
+        return "source ({} files)".format(len(files))
+
+
+class Step:
+    """
+    A buildable node of the graph.
+
+    Input:
+    `name`: label shown in the plan.
+    `target`: file or directory whose stamp records the last successful build.
+    `outputs`: function returning the list of files the step must produce.
+    `action`: function that builds the outputs; returns True on success.
+    `deps`: steps/sources this step reads from.
+    `params`: anything (JSON-serializable) that changes the outputs.
+    `code`: source files in `src/` that build the outputs.
+    `always`: rebuild on every run (e.g. unseeded sampling).
+    """
+    def __init__(self, name, target, outputs, action, deps=(), params=None, code=(), always=False):
+        self.name = name
+        self.target = target
+        self.outputs = outputs
+        self.action = action
+        self.deps = list(deps)
+        self.params = params
+        self.code = list(code)
+        self.always = always
+        self.key = None
+        self.stale = False
+
+    def outputs_exist(self):
+        return all(file_nonempty(p) for p in self.outputs())
+
+    def resolve(self):
+        """Compute this step's key and decide whether it must be rebuilt."""
+        dep_keys = [d.key for d in self.deps]
+        dep_rebuilt_always = any(getattr(d, "stale", False) and getattr(d, "always", False) for d in self.deps)
+
+        if any(k is None for k in dep_keys):
+            # Inputs can't be fingerprinted here; keep whatever is already built.
+            if self.outputs_exist():
+                self.key = hash_values([hash_file(p) for p in self.outputs()])
+                self.stale = False
+                return "kept (inputs unavailable)"
+            self.key = None
+            self.stale = True
+            return "cannot build: inputs unavailable"
+
+        self.key = hash_values(self.name, self.params, hash_source(*self.code), dep_keys)
+
+        if self.always:
+            self.stale = True
+            return "stale (always rebuilt)"
+        if dep_rebuilt_always:
+            self.stale = True
+            return "stale (inputs are rebuilt)"
+        if not self.outputs_exist():
+            self.stale = True
+            return "stale (missing outputs)"
+        stamp = read_stamp(self.target)
+        if stamp is None:
+            self.stale = True
+            return "stale (no stamp, possibly from an interrupted run)"
+        if stamp != self.key:
+            self.stale = True
+            return "stale (inputs changed)"
+        self.stale = False
+        return "up to date"
+
+
+class BuildGraph:
+    """Nodes are added in dependency order and resolved/run in that order."""
+    def __init__(self):
+        self.nodes = []
+
+    def add(self, node):
+        self.nodes.append(node)
+        return node
+
+    def plan(self):
+        return [(node, node.resolve()) for node in self.nodes]
+
+    def run(self, dry_run=False, out=None):
+        """
+        Resolve every node, print the plan (to `out`, default stdout) and build
+        whatever is stale. Returns True if everything is up to date afterwards.
+        With `dry_run`, only the plan is printed and nothing is written.
+        """
+        plan = self.plan()
+        print("Build plan:", file=out)
+        for node, status in plan:
+            print(f"  {node.name:<12} {status}", file=out)
+        if dry_run:
+            return True
+        for node in self.nodes:
+            if isinstance(node, Source) and node.owns_cache:
+                node.hash_cache.save()
+
+        for node, status in plan:
+            if not isinstance(node, Step) or not node.stale:
+                continue
+            if node.key is None:
+                print(f"Error: cannot build {node.name}; its inputs are not available.", file=out)
+                return False
+            print(f"\nBuilding {node.name}...", file=out)
+            if out is not None:
+                out.flush()
+            if not node.action():
+                print(f"Error: building {node.name} failed.", file=out)
+                return False
+            write_stamp(node.target, node.key)
+        return True
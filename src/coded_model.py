@@ -0,0 +1,130 @@
+"""Integer-coded, array-backed view of a Markov model.
+
+The models saved by `markov.py` are nested dicts keyed by MIDI numbers,
+durations or pairs of them. For algorithms that touch every state at once
+(constrained sampling, beam search, scoring) those dicts are converted to
+NumPy arrays once:
+
+  - `states`: every state of the chain, as an index -> state list. For a
+    second-order model a state is a pair (previous, current), and the chain
+    over pairs is first-order: (a, b) -> (b, c) with probability P(c | a, b).
+  - `values`: the symbol each state emits (the state itself for first order,
+    the last element of the pair for second order).
+  - `indptr`, `indices`, `probs`: the transition matrix in CSR form, i.e.
+    state i moves to `indices[indptr[i]:indptr[i+1]]` with `probs[...]`.
+  - `start`: start probability of each state.
+
+Second-order pairs that only ever appear as a target have no outgoing
+transitions (an empty CSR row).
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Coded models are cached per model object; entries keep a reference to the
+# model dict, so its id() can't be reused while the entry is alive.
+_CACHE_SIZE = 8
+_cache = OrderedDict()
+
+
+class CodedModel:
+    def __init__(self, order, states, indptr, indices, probs, start):
+        self.order = order
+        self.states = states
+        self.state_to_index = {s: i for i, s in enumerate(states)}
+        self.values = [s[-1] for s in states] if order == 'second' else list(states)
+        self.indptr = indptr
+        self.indices = indices
+        self.probs = probs
+        self.start = start
+        # Row of every stored transition, handy for vectorized updates
+        self.rows = np.repeat(np.arange(len(states)), np.diff(indptr))
+        self._log_probs = None
+
+    @property
+    def log_probs(self):
+        """Log of `probs`, computed on first use."""
+        if self._log_probs is None:
+            self._log_probs = np.log(self.probs)
+        return self._log_probs
+
+    @property
+    def num_states(self):
+        return len(self.states)
+
+    def successors(self, i):
+        """Returns (next state indices, probabilities) of state `i`."""
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return self.indices[lo:hi], self.probs[lo:hi]
+
+    def backward(self, weights):
+        """
+        One backward step: returns, for every state i, sum_j P(i, j) * weights[j].
+        States without successors get 0.
+        """
+        return np.bincount(self.rows, weights=self.probs * weights[self.indices], minlength=self.num_states)
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.probs.nbytes + self.start.nbytes
+
+
+def from_model(transitions: dict, start_dist: dict, order: str) -> CodedModel:
+    """
+    Input:
+    `transitions`, `start_dist`: a model as saved by `construct_first_order`/`construct_second_order`
+    `order`: `first` or `second`
+
+    Returns:
+        the CodedModel of the same chain.
+    """
+    if order == 'first':
+        states = sorted(set(transitions) | set(start_dist)
+                        | {v for nexts in transitions.values() for v in nexts}, key=_sort_key)
+        state_to_index = {s: i for i, s in enumerate(states)}
+
+        def edges(state):
+            return [(state_to_index[v], p) for v, p in transitions.get(state, {}).items()]
+    else:
+        pairs = set(transitions) | set(start_dist)
+        for (a, b), nexts in transitions.items():
+            pairs.update((b, c) for c in nexts)
+        states = sorted(pairs, key=lambda pair: (_sort_key(pair[0]), _sort_key(pair[1])))
+        state_to_index = {s: i for i, s in enumerate(states)}
+
+        def edges(state):
+            return [(state_to_index[(state[1], c)], p) for c, p in transitions.get(state, {}).items()]
+
+    indptr = np.zeros(len(states) + 1, dtype=np.int64)
+    indices = []
+    probs = []
+    for i, state in enumerate(states):
+        row = sorted(edges(state))
+        indices += [j for j, _ in row]
+        probs += [p for _, p in row]
+        indptr[i + 1] = len(indices)
+
+    start = np.zeros(len(states))
+    for state, p in start_dist.items():
+        start[state_to_index[state]] = p
+
+    return CodedModel(order, states, indptr, np.asarray(indices, dtype=np.int64),
+                      np.asarray(probs, dtype=float), start)
+
+
+def coded(transitions: dict, start_dist: dict, order: str) -> CodedModel:
+    """`from_model`, cached for the last few model objects."""
+    cache_key = (id(transitions), id(start_dist), order)
+    if cache_key in _cache:
+        _cache.move_to_end(cache_key)
+        return _cache[cache_key][2]
+    model = from_model(transitions, start_dist, order)
+    _cache[cache_key] = (transitions, start_dist, model)
+    if len(_cache) > _CACHE_SIZE:
+        _cache.popitem(last=False)
+    return model
+
+
+def _sort_key(value):
+    # Durations mix floats and Fractions; both compare fine as floats
+    return float(value)
@@ -0,0 +1,126 @@
+"""Exact constrained sampling of pitch sequences.
+
+`generate.py` applies key constraints greedily, one note at a time, and falls
+back to the unconstrained distribution when every next note is out of key.
+Here the constraints are solved up front instead. For a model and a
+`Constraint` (key, pitch range, end on the tonic), backward tables are
+precomputed over the integer-coded model (see `coded_model.py`):
+
+    beta[0][s]   = 1 if state s may end the melody, else 0
+    beta[k+1][s] = allowed[s] * sum_s' P(s, s') * beta[k][s']
+
+beta[k][s] is (up to a per-k scale) the probability that the chain, from s,
+can take k more steps through allowed states and end on an allowed final
+state. Sampling forward with weights P(s, s') * beta[k][s'] then draws from
+the model's distribution conditioned on the constraints, so it never
+backtracks and never produces an out-of-constraint note.
+
+Tables are cached per (model, constraint) and grown on demand, so repeated
+requests of any length are cheap.
+"""
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from coded_model import coded
+
+REST = -1
+
+Constraint = namedtuple("Constraint", ["key", "end_on_tonic", "min_pitch", "max_pitch"])
+Constraint.__new__.__defaults__ = (None, False, None, None)
+
+_CACHE_SIZE = 32
+_tables = OrderedDict()
+
+
+class InfeasibleConstraint(ValueError):
+    """No melody of the requested length satisfies the constraints under the model."""
+
+
+def value_allowed(value, constraint: Constraint, scales: dict):
+    if value == REST:
+        return True
+    if constraint.key is not None and (value % 12) not in scales[constraint.key]:
+        return False
+    if constraint.min_pitch is not None and value < constraint.min_pitch:
+        return False
+    if constraint.max_pitch is not None and value > constraint.max_pitch:
+        return False
+    return True
+
+
+class FeasibilityTable:
+    """Backward tables of one coded pitch model under one constraint."""
+
+    def __init__(self, model, constraint: Constraint, scales: dict):
+        self.model = model
+        self.constraint = constraint
+
+        if constraint.end_on_tonic and constraint.key is None:
+            raise ValueError("end_on_tonic needs a key")
+
+        elements = [s if isinstance(s, tuple) else (s,) for s in model.states]
+        self.allowed = np.array([all(value_allowed(v, constraint, scales) for v in e) for e in elements], dtype=float)
+
+        final = self.allowed.copy()
+        if constraint.end_on_tonic:
+            tonic = scales[constraint.key][0]
+            final *= np.array([v != REST and v % 12 == tonic for v in model.values], dtype=float)
+        self.betas = [final]
+
+    def beta(self, steps):
+        """Weights for states with `steps` transitions still to take."""
+        while len(self.betas) <= steps:
+            nxt = self.allowed * self.model.backward(self.betas[-1])
+            peak = nxt.max()
+            # Rescale so long melodies don't underflow; conditionals are unchanged
+            self.betas.append(nxt / peak if peak > 0 else nxt)
+        return self.betas[steps]
+
+    def sample(self, num_notes, rng):
+        """
+        Input:
+        `num_notes`: length of the pitch sequence to draw
+        `rng`: a random.Random
+
+        Returns:
+            list of `num_notes` pitches (REST for rests) satisfying the constraint.
+        """
+        first_notes = 2 if self.model.order == 'second' else 1
+        num_notes = max(num_notes, first_notes)
+        steps = num_notes - first_notes
+
+        weights = self.model.start * self.beta(steps)
+        if weights.sum() <= 0:
+            raise InfeasibleConstraint(
+                f"No {num_notes}-note melody satisfies {self.constraint} under this model")
+        state = draw_index(weights, rng)
+        first = self.model.states[state]
+        pitches = list(first) if self.model.order == 'second' else [first]
+
+        for remaining in range(steps - 1, -1, -1):
+            nexts, probs = self.model.successors(state)
+            state = nexts[draw_index(probs * self.beta(remaining)[nexts], rng)]
+            pitches.append(self.model.values[state])
+        return pitches
+
+
+def feasibility_table(pitch_model, starting_pitch_dist, order, constraint: Constraint, scales: dict):
+    """The FeasibilityTable for this model and constraint, cached across calls."""
+    model = coded(pitch_model, starting_pitch_dist, order)
+    cache_key = (id(model), constraint)
+    if cache_key in _tables:
+        _tables.move_to_end(cache_key)
+        return _tables[cache_key][1]
+    table = FeasibilityTable(model, constraint, scales)
+    _tables[cache_key] = (model, table)
+    if len(_tables) > _CACHE_SIZE:
+        _tables.popitem(last=False)
+    return table
+
+
+def draw_index(weights, rng):
+    """Index drawn with probability proportional to `weights`, using `rng` (a random.Random)."""
+    cumulative = np.cumsum(weights)
+    return int(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right'))
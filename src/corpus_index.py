@@ -0,0 +1,234 @@
+"""Persistent metadata index over the raw MIDI corpus.
+
+Every MIDI file under `data/raw` gets one row in an SQLite database with its
+path, content hash, size, folder, XMIDI emotion/genre/ID (from the filename),
+melody note count, pitch range, tempo and parse status. The index is built
+in parallel and updated incrementally: only new or changed files are parsed
+again, and rows of deleted files are dropped.
+
+Training can then pick subsets without reparsing anything, and files that
+failed to parse are skipped up front, e.g.:
+
+    python3 src/corpus_index.py build
+    python3 src/corpus_index.py query -g sad --xmidi-genre jazz --min-notes 200
+    python3 src/preprocess.py -g sad -o data/processed/sad_jazz.pkl --index-db data/processed/corpus_index.sqlite --min-notes 200
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from build_graph import hash_file
+from mood_data_pipeline import parse_xmidi_name
+
+DEFAULT_DB = "data/processed/corpus_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT,
+    sha256 TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    emotion TEXT,
+    genre TEXT,
+    xmidi_id TEXT,
+    num_notes INTEGER,
+    min_pitch INTEGER,
+    max_pitch INTEGER,
+    tempo REAL,
+    status TEXT,
+    error TEXT,
+    parse_seconds REAL,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE INDEX IF NOT EXISTS files_emotion_genre ON files (emotion, genre);
+"""
+
+COLUMNS = ["path", "folder", "sha256", "size", "mtime_ns", "emotion", "genre", "xmidi_id", "num_notes",
+           "min_pitch", "max_pitch", "tempo", "status", "error", "parse_seconds", "indexed_at"]
+
+
+def connect(db_path=DEFAULT_DB):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def find_midi_files(raw_dir="data/raw"):
+    """Every .mid/.midi file below `raw_dir`."""
+    files = []
+    for root, _, names in os.walk(raw_dir):
+        files += [os.path.join(root, n) for n in names if n.lower().endswith('.mid') or n.lower().endswith('.midi')]
+    return sorted(files)
+
+
+def inspect_midi(path):
+    """
+    Parse one file and return its index row (without the stat fields).
+    Notes and pitches are counted on the melody `parse_midi` extracts (with
+    the default `highest` chord strategy), rests left out.
+    """
+    from music21 import converter, tempo
+    from parse_midi import REST, melody_notes, notes_to_sequence
+
+    sha256 = hash_file(path)
+    emotion, genre, xmidi_id = parse_xmidi_name(os.path.basename(path))
+    row = {
+        "path": path,
+        "folder": os.path.basename(os.path.dirname(path)),
+        "sha256": sha256,
+        "emotion": None if emotion == "unknown" else emotion,
+        "genre": genre or None,
+        "xmidi_id": xmidi_id or None,
+        "num_notes": 0, "min_pitch": None, "max_pitch": None, "tempo": None,
+        "status": "ok", "error": None,
+    }
+
+    start_time = time.perf_counter()
+    try:
+        score = converter.parse(path)
+        pitches = [p for p in notes_to_sequence(melody_notes(score))[0] if p != REST]
+        row["num_notes"] = len(pitches)
+        if pitches:
+            row["min_pitch"], row["max_pitch"] = min(pitches), max(pitches)
+        marks = score.flatten().getElementsByClass(tempo.MetronomeMark)
+        if len(marks) > 0 and marks[0].number is not None:
+            row["tempo"] = float(marks[0].number)
+        if not pitches:
+            row["status"] = "empty"
+    except Exception as e:
+        row["status"] = "error"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["parse_seconds"] = time.perf_counter() - start_time
+    return row
+
+
+def build_index(raw_dir="data/raw", db_path=DEFAULT_DB, workers=None):
+    """
+    Bring the index up to date with `raw_dir`: new or modified files are
+    parsed on `workers` processes, deleted files are removed.
+
+    Returns a dict with counts of added/updated, unchanged and removed files.
+    """
+    conn = connect(db_path)
+    rows = conn.execute("SELECT path, size, mtime_ns, sha256 FROM files").fetchall()
+    known = {r["path"]: (r["size"], r["mtime_ns"]) for r in rows}
+    known_hashes = {r["path"]: r["sha256"] for r in rows}
+
+    files = find_midi_files(raw_dir)
+    stats = {path: os.stat(path) for path in files}
+    changed = [p for p in files if known.get(p) != (stats[p].st_size, stats[p].st_mtime_ns)]
+    removed = set(known) - set(files)
+
+    # Files that were only touched keep their row; just refresh their stat fields
+    todo = []
+    for p in changed:
+        if p in known_hashes and hash_file(p) == known_hashes[p]:
+            conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?",
+                         (stats[p].st_size, stats[p].st_mtime_ns, p))
+        else:
+            todo.append(p)
+
+    print(f"Found {len(files)} MIDI files in {raw_dir}: {len(todo)} new or changed, {len(removed)} removed.")
+
+    conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+
+    placeholders = ", ".join("?" for _ in COLUMNS)
+    insert = f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) VALUES ({placeholders})"
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, row in enumerate(pool.map(inspect_midi, todo, chunksize=16)):
+            st = stats[row["path"]]
+            row.update(size=st.st_size, mtime_ns=st.st_mtime_ns, indexed_at=time.time())
+            conn.execute(insert, [row[c] for c in COLUMNS])
+            if (i + 1) % 100 == 0 or (i + 1) == len(todo):
+                conn.commit()
+                print(f"Indexed {i + 1}/{len(todo)} files.")
+    conn.commit()
+    conn.close()
+    return {"indexed": len(todo), "unchanged": len(files) - len(todo), "removed": len(removed)}
+
+
+def select_files(db_path=DEFAULT_DB, group=None, emotion=None, genre=None, min_notes=None, max_notes=None,
+                 include_failed=False):
+    """
+    Input:
+    `group`: a data/raw folder name or an emotion (e.g. `jazz` or `sad`)
+    `emotion`, `genre`: XMIDI emotion/genre from the filename
+    `min_notes`, `max_notes`: bounds on the melody note count
+    `include_failed`: also return files that were empty or failed to parse
+
+    Returns:
+        sorted list of matching file paths.
+    """
+    clauses, params = [], []
+    if group is not None:
+        clauses.append("(folder = ? OR emotion = ?)")
+        params += [group, group.lower()]
+    if emotion is not None:
+        clauses.append("emotion = ?")
+        params.append(emotion.lower())
+    if genre is not None:
+        clauses.append("genre = ?")
+        params.append(genre.lower())
+    if min_notes is not None:
+        clauses.append("num_notes >= ?")
+        params.append(min_notes)
+    if max_notes is not None:
+        clauses.append("num_notes <= ?")
+        params.append(max_notes)
+    if not include_failed:
+        clauses.append("status = 'ok'")
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+
+    conn = connect(db_path)
+    paths = [r["path"] for r in conn.execute(f"SELECT path FROM files{where} ORDER BY path", params)]
+    conn.close()
+    return paths
+
+
+def summary(db_path=DEFAULT_DB):
+    """Print file counts per folder and parse status."""
+    conn = connect(db_path)
+    print(f"{'folder':<16} {'status':<8} {'files':>8} {'notes':>12}")
+    for r in conn.execute("SELECT folder, status, COUNT(*) AS n, SUM(num_notes) AS notes FROM files "
+                          "GROUP BY folder, status ORDER BY folder, status"):
+        print(f"{r['folder']:<16} {r['status']:<8} {r['n']:>8} {r['notes'] or 0:>12}")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the raw MIDI corpus index")
+    parser.add_argument("command", choices=["build", "query", "summary"],
+                        help="`build` updates the index, `query` lists matching files, `summary` prints counts")
+    parser.add_argument("--db", default=DEFAULT_DB, help=f"Path of the SQLite index. Default {DEFAULT_DB}")
+    parser.add_argument("--raw-dir", default="data/raw", help="Root of the raw MIDI corpus. Default data/raw")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="Worker processes for parsing. Default: all CPUs")
+    parser.add_argument("--group", "-g", default=None, help="Folder or emotion to select, e.g. `jazz` or `sad`")
+    parser.add_argument("--emotion", default=None, help="XMIDI emotion to select")
+    parser.add_argument("--xmidi-genre", default=None, help="XMIDI genre to select")
+    parser.add_argument("--min-notes", type=int, default=None, help="Minimum melody note count")
+    parser.add_argument("--max-notes", type=int, default=None, help="Maximum melody note count")
+    parser.add_argument("--include-failed", action="store_true", help="Also list files that failed to parse")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start_time = time.time()
+        counts = build_index(args.raw_dir, args.db, args.workers)
+        print(f"Index updated in {time.time() - start_time:.2f} seconds: {counts}")
+        summary(args.db)
+    elif args.command == "summary":
+        summary(args.db)
+    else:
+        for path in select_files(args.db, args.group, args.emotion, args.xmidi_genre,
+                                 args.min_notes, args.max_notes, args.include_failed):
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
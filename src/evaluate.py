@@ -2,6 +2,10 @@ import os
 from music21 import converter
 import statistics
 import argparse
+import json
+from build_graph import atomic_write_bytes
+import instrument
+from beam import SCORES_FILE
 import matplotlib.pyplot as plt
 
 def analyze_midi_file(filepath, collect_distributions=False):
@@ -65,8 +69,10 @@ def analyze_directory(directory_path, make_plots=False, output_dir='.'):
             filepath = os.path.join(directory_path, filename)
             
             try:
-                metrics = analyze_midi_file(filepath, collect_distributions=make_plots)
+                with instrument.span("analyze_midi_file", file=filepath):
+                    metrics = analyze_midi_file(filepath, collect_distributions=make_plots)
                 if metrics:
+                    instrument.count("files_analyzed")
                     for key in all_metrics:
                         if key in metrics:
                             all_metrics[key].append(metrics[key])
@@ -76,6 +82,7 @@ def analyze_directory(directory_path, make_plots=False, output_dir='.'):
                         all_durations.extend(metrics['raw_durations'])
                         all_intervals.extend(metrics['raw_intervals'])
             except Exception as e:
+                instrument.count("analysis_failures")
                 print(f"Error processing {filename}: {e}")
     
     print("\n=== RESULTS ===")
@@ -89,43 +96,70 @@ def analyze_directory(directory_path, make_plots=False, output_dir='.'):
     print(f"Duration variety: {statistics.mean(all_metrics['duration_variety']):.3f}")
     
     if make_plots:
-        all_pitches = [p for p in all_pitches if isinstance(p, (int, float))]
-        all_durations = [d for d in all_durations if isinstance(d, (int, float)) and d > 0]
-        all_intervals = [i for i in all_intervals if isinstance(i, (int, float))]
+        with instrument.span("make_plots"):
+            all_pitches = [p for p in all_pitches if isinstance(p, (int, float))]
+            all_durations = [d for d in all_durations if isinstance(d, (int, float)) and d > 0]
+            all_intervals = [i for i in all_intervals if isinstance(i, (int, float))]
 
-        # PITCH DISTRIBUTION
-        plt.figure(figsize=(10, 4))
-        plt.hist(all_pitches, bins=30, color='blue', edgecolor='black')
-        plt.xlabel('MIDI Pitch')
-        plt.ylabel('Frequency')
-        plt.title('Pitch Distribution')
-        plt.savefig(os.path.join(output_dir, 'pitch_distribution.png'), dpi=300, bbox_inches='tight')
-        plt.close()
+            # PITCH DISTRIBUTION
+            plt.figure(figsize=(10, 4))
+            plt.hist(all_pitches, bins=30, color='blue', edgecolor='black')
+            plt.xlabel('MIDI Pitch')
+            plt.ylabel('Frequency')
+            plt.title('Pitch Distribution')
+            plt.savefig(os.path.join(output_dir, 'pitch_distribution.png'), dpi=300, bbox_inches='tight')
+            plt.close()
         
-        # DURATION DISTRIBUTION
-        plt.figure(figsize=(10, 4))
-        duration_bins = [i * 0.25 for i in range(21)]
-        plt.hist(all_durations, bins=duration_bins, color='green', edgecolor='black')
-        plt.xlabel('Duration (quarter notes)')
-        plt.ylabel('Frequency')
-        plt.title('Duration Distribution')
-        plt.xlim(0, 5)
-        plt.savefig(os.path.join(output_dir,'duration_distribution.png'), dpi=300, bbox_inches='tight')
-        plt.close()
+            # DURATION DISTRIBUTION
+            plt.figure(figsize=(10, 4))
+            duration_bins = [i * 0.25 for i in range(21)]
+            plt.hist(all_durations, bins=duration_bins, color='green', edgecolor='black')
+            plt.xlabel('Duration (quarter notes)')
+            plt.ylabel('Frequency')
+            plt.title('Duration Distribution')
+            plt.xlim(0, 5)
+            plt.savefig(os.path.join(output_dir,'duration_distribution.png'), dpi=300, bbox_inches='tight')
+            plt.close()
         
-        # INTERVAL DISTRIBUTION
-        plt.figure(figsize=(10, 4))
-        plt.hist(all_intervals, bins=range(-24, 25), color='red', edgecolor='black')
-        plt.xlabel('Interval (half-steps)')
-        plt.ylabel('Frequency')
-        plt.title('Interval Distribution')
-        plt.savefig(os.path.join(output_dir, 'interval_distribution.png'), dpi=300, bbox_inches='tight')
-        plt.close()
+            # INTERVAL DISTRIBUTION
+            plt.figure(figsize=(10, 4))
+            plt.hist(all_intervals, bins=range(-24, 25), color='red', edgecolor='black')
+            plt.xlabel('Interval (half-steps)')
+            plt.ylabel('Frequency')
+            plt.title('Interval Distribution')
+            plt.savefig(os.path.join(output_dir, 'interval_distribution.png'), dpi=300, bbox_inches='tight')
+            plt.close()
         
-        print("\nSaved distribution plots: pitch_distribution.png, duration_distribution.png, interval_distribution.png")
+            print("\nSaved distribution plots: pitch_distribution.png, duration_distribution.png, interval_distribution.png")
     
     return all_metrics
 
+def summarize_metrics(all_metrics):
+    """Average each metric over the analyzed files."""
+    return {key: statistics.mean(values) for key, values in all_metrics.items() if len(values) > 0}
+
+def load_scores(directory_path):
+    """
+    Log-probabilities written by `generate.py --decode beam` next to the samples,
+    averaged over files. Returns an empty dict if there are none.
+    """
+    scores_path = os.path.join(directory_path, SCORES_FILE)
+    if not os.path.exists(scores_path):
+        return {}
+    with open(scores_path, 'r') as f:
+        scores = json.load(f).values()
+    summary = {key: statistics.mean(s[key] for s in scores) for key in ('log_prob', 'log_prob_per_note')}
+    print(f"Average log-probability: {summary['log_prob']:.2f} ({summary['log_prob_per_note']:.3f} per note)")
+    return summary
+
+def save_metrics(all_metrics, path, scores=None):
+    """Save the averaged metrics, and the averaged `scores` if any, as JSON."""
+    summary = summarize_metrics(all_metrics)
+    summary['files_analyzed'] = len(all_metrics['avg_interval'])
+    summary.update(scores or {})
+    atomic_write_bytes(path, json.dumps(summary, indent=2).encode())
+    print(f"Saved metrics to {path}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Evaluate/analyze midi files."
@@ -143,11 +177,22 @@ if __name__ == "__main__":
         help="Generate distribution plots"
     )
 
+    parser.add_argument(
+        "--output-dir", "-o",
+        default=None,
+        help="Where to save metrics and plots. Defaults to evaluation/[DIR_NAME]"
+    )
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.configure(args.trace, "evaluate")
 
     model_name = os.path.basename(os.path.normpath(args.dir))
     
-    eval_dir = os.path.join('evaluation', model_name)
+    eval_dir = args.output_dir or os.path.join('evaluation', model_name)
     os.makedirs(eval_dir, exist_ok=True)
 
-    metrics = analyze_directory(args.dir, make_plots=args.make_plots, output_dir=eval_dir)
\ No newline at end of file
+    with instrument.stage("evaluate", args.profile):
+        metrics = analyze_directory(args.dir, make_plots=args.make_plots, output_dir=eval_dir)
+        save_metrics(metrics, os.path.join(eval_dir, 'metrics.json'), load_scores(args.dir))
\ No newline at end of file
@@ -1,8 +1,20 @@
 from music21 import stream, note, tempo, midi
 import random
 import argparse
+import sys
 import pickle
 import time
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from build_graph import atomic_write_bytes
+import instrument
+from constrained import Constraint, InfeasibleConstraint, feasibility_table, draw_index
+from beam import decode, SCORES_FILE
+from backoff import BackoffModel
+from intervals import to_pitches, DEFAULT_START_PITCH, DEFAULT_REGISTER
+from sample_cache import SampleCache, DEFAULT_MAX_BYTES
 
 REST = -1
 KEYS = {
@@ -15,6 +27,7 @@ KEYS = {
     'A_minor': [9, 11, 0, 2, 4, 5, 7],   # A B C D E F G
     'E_minor': [4, 6, 7, 9, 11, 0, 2],   # E F# G A B C D
     'D_minor': [2, 4, 5, 7, 9, 10, 0],   # D E F G A Bb C
+    'Bb_major': [10, 0, 2, 3, 5, 7, 9],  # Bb C D Eb F G A
 }
 
 def is_in_key(midi_note, key):
@@ -26,7 +39,14 @@ def is_in_key(midi_note, key):
     
     return pitch_class in KEYS[key]
 
-def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, save_path=None, key=None):
+def save_midi(output_stream, save_path):
+    """Write a stream to `save_path` atomically, so a crash never leaves half a MIDI file."""
+    with instrument.span("write_midi", file=save_path):
+        midi_file = midi.translate.streamToMidiFile(output_stream)
+        atomic_write_bytes(save_path, midi_file.writestr())
+    print(f"Saved as {save_path}")
+
+def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, save_path=None, key=None, seed=None):
     """
     Input:
         `length`: float representing total length in seconds of the generated piece.
@@ -36,11 +56,14 @@ def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitc
         `starting_pitch_dist`: Initial probability distribution as a dict {note: probability}.
         `starting_duration_dist`: initial probability distribution as a dict {duration: probability}.
         `save`: whether to save the resulting MIDI file (default False).
+        `key`: musical key to constrain generation (optional).
+        `seed`: int seed for a reproducible melody (optional).
 
     Returns:
         music21.stream.Stream: the generated music21 stream object.
     """
     
+    rng = random.Random(seed)
     output_stream = stream.Stream()
     output_stream.append(tempo.MetronomeMark(number=BPM))
 
@@ -55,13 +78,13 @@ def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitc
             total = sum(in_key_candidates.values())
             candidates = {note: prob/total for note, prob in in_key_candidates.items()}
     
-    current_note = random.choices(
+    current_note = rng.choices(
         population=list(candidates.keys()),
         weights=list(candidates.values())
     )[0]
         
 
-    current_duration = random.choices(
+    current_duration = rng.choices(
         population=list(starting_duration_dist.keys()),
         weights=list(starting_duration_dist.values())
     )[0]
@@ -87,7 +110,7 @@ def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitc
                     total = sum(in_key_transitions.values())
                     transitions = {note: prob/total for note, prob in in_key_transitions.items()}
             
-            current_note = random.choices(
+            current_note = rng.choices(
                 population=list(transitions.keys()),
                 weights=list(transitions.values())
             )[0]
@@ -99,33 +122,31 @@ def generate_first_order(length, BPM, pitch_model, duration_model, starting_pitc
                 if in_key_candidates:
                     total = sum(in_key_candidates.values())
                     candidates = {note: prob/total for note, prob in in_key_candidates.items()}
-            current_note = random.choices(
+            current_note = rng.choices(
                 population=list(candidates.keys()),
                 weights=list(candidates.values())
             )[0]
         
         if current_duration in duration_model:
             transitions = duration_model[current_duration]
-            current_duration = random.choices(
+            current_duration = rng.choices(
                 population=list(transitions.keys()),
                 weights=list(transitions.values())
             )[0]
         else:
-            current_duration = random.choices(
+            current_duration = rng.choices(
                 population=list(starting_duration_dist.keys()),
                 weights=list(starting_duration_dist.values())
             )[0]
 
+    instrument.count("notes_generated", len(output_stream.notesAndRests))
+
     if save_path:
-        midi_file = midi.translate.streamToMidiFile(output_stream)
-        midi_file.open(save_path, "wb")
-        midi_file.write()
-        midi_file.close()
-        print(f"Saved as {save_path}")
+        save_midi(output_stream, save_path)
 
     return output_stream
 
-def generate_second_order(length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, save_path=None, key=None):
+def generate_second_order(length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, save_path=None, key=None, seed=None):
     """
     Input:
         `length`: float representing total length in seconds of the generated piece.
@@ -136,23 +157,25 @@ def generate_second_order(length, BPM, pitch_model, duration_model, starting_pit
         `starting_duration_dist`: initial probability distribution as a dict {(duration1, duration2): probability}.
         `save_path`: path to save MIDI file (optional).
         `key`: musical key to constrain generation (optional).
+        `seed`: int seed for a reproducible melody (optional).
 
     Returns:
         music21.stream.Stream: the generated music21 stream object.
     """
 
+    rng = random.Random(seed)
     output_stream = stream.Stream()
     output_stream.append(tempo.MetronomeMark(number=BPM))
 
     seconds_per_beat = 60.0 / BPM
     current_time = 0.0
 
-    current_note = random.choices(
+    current_note = rng.choices(
         population=list(starting_pitch_dist.keys()),
         weights=list(starting_pitch_dist.values())
     )[0]
 
-    current_duration = random.choices(
+    current_duration = rng.choices(
         population=list(starting_duration_dist.keys()),
         weights=list(starting_duration_dist.values())
     )[0]
@@ -180,7 +203,7 @@ def generate_second_order(length, BPM, pitch_model, duration_model, starting_pit
                     total = sum(in_key_transitions.values())
                     transitions = {note: prob/total for note, prob in in_key_transitions.items()}
             
-            next_pitch = random.choices(
+            next_pitch = rng.choices(
                 population=list(transitions.keys()),
                 weights=list(transitions.values())
             )[0]
@@ -194,7 +217,7 @@ def generate_second_order(length, BPM, pitch_model, duration_model, starting_pit
                     total = sum(in_key_candidates.values())
                     candidates = {note_pair: prob/total for note_pair, prob in in_key_candidates.items()}
             
-            new_note = random.choices(
+            new_note = rng.choices(
                 population=list(candidates.keys()),
                 weights=list(candidates.values())
             )[0]
@@ -202,12 +225,12 @@ def generate_second_order(length, BPM, pitch_model, duration_model, starting_pit
         
         if current_duration in duration_model:
             transitions = duration_model[current_duration]
-            next_duration = random.choices(
+            next_duration = rng.choices(
                 population=list(transitions.keys()),
                 weights=list(transitions.values())
             )[0]
         else:
-            new_duration = random.choices(
+            new_duration = rng.choices(
                 population=list(starting_duration_dist.keys()),
                 weights=list(starting_duration_dist.values())
             )[0]
@@ -224,15 +247,312 @@ def generate_second_order(length, BPM, pitch_model, duration_model, starting_pit
         current_note = (current_note[1], next_pitch)
         current_duration = (current_duration[1], next_duration)
 
+    instrument.count("notes_generated", len(output_stream.notesAndRests))
+
     if save_path:
-        midi_file = midi.translate.streamToMidiFile(output_stream)
-        midi_file.open(save_path, "wb")
-        midi_file.write()
-        midi_file.close()
-        print(f"Saved as {save_path}")
+        save_midi(output_stream, save_path)
+
+    return output_stream
+
+def sample_durations(order, length, BPM, duration_model, starting_duration_dist, rng):
+    """
+    Sample durations the way `generate_first_order`/`generate_second_order` do,
+    until they fill `length` seconds. Returns the list of durations.
+    """
+    seconds_per_beat = 60.0 / BPM
+    durations = []
+    current_time = 0.0
+
+    current_duration = rng.choices(
+        population=list(starting_duration_dist.keys()),
+        weights=list(starting_duration_dist.values())
+    )[0]
+    if order == 'second':
+        durations += list(current_duration)
+    else:
+        durations.append(current_duration)
+    current_time += seconds_per_beat * sum(float(d) for d in durations)
+
+    while current_time < length:
+        if current_duration in duration_model:
+            transitions = duration_model[current_duration]
+            next_duration = rng.choices(
+                population=list(transitions.keys()),
+                weights=list(transitions.values())
+            )[0]
+        else:
+            new_duration = rng.choices(
+                population=list(starting_duration_dist.keys()),
+                weights=list(starting_duration_dist.values())
+            )[0]
+            next_duration = new_duration[1] if order == 'second' else new_duration
+        durations.append(next_duration)
+        current_time += seconds_per_beat * float(next_duration)
+        current_duration = (current_duration[1], next_duration) if order == 'second' else next_duration
+
+    return durations
+
+def sample_chain(order, num_values, transitions, start_dist, rng):
+    """
+    Sample `num_values` values from a chain, restarting from `start_dist` in
+    unseen contexts the way `generate_first_order`/`generate_second_order` do.
+    """
+    current = rng.choices(population=list(start_dist.keys()), weights=list(start_dist.values()))[0]
+    values = list(current) if order == 'second' else [current]
+
+    while len(values) < num_values:
+        if current in transitions:
+            nexts = transitions[current]
+            next_value = rng.choices(population=list(nexts.keys()), weights=list(nexts.values()))[0]
+        else:
+            restart = rng.choices(population=list(start_dist.keys()), weights=list(start_dist.values()))[0]
+            next_value = restart[1] if order == 'second' else restart
+        values.append(next_value)
+        current = (current[1], next_value) if order == 'second' else next_value
+
+    return values[:num_values]
+
+def generate_intervals(order, length, BPM, interval_model, duration_model, starting_interval_dist, starting_duration_dist, save_path=None, key=None, seed=None, start_pitch=DEFAULT_START_PITCH, register=DEFAULT_REGISTER):
+    """
+    Generate from a model trained on intervals (`preprocess.py --intervals`).
+    Intervals are sampled like pitches in `generate_first_order`/`generate_second_order`
+    and mapped back to pitches from `start_pitch`, folded into `register` (see `intervals.py`).
+    With a `key`, every note is snapped to the nearest pitch in the key.
+
+    Input:
+        `order`: `first` or `second`, matching the models.
+        `interval_model`, `starting_interval_dist`: the pitch model and distribution, over intervals.
+        `start_pitch`: MIDI pitch of the first note.
+        `register`: (low, high) MIDI pitches the melody stays in.
+        the rest as in `generate_first_order`.
+
+    Returns:
+        music21.stream.Stream: the generated music21 stream object.
+    """
+    rng = random.Random(seed)
+    durations = sample_durations(order, length, BPM, duration_model, starting_duration_dist, rng)
+    interval_values = sample_chain(order, len(durations), interval_model, starting_interval_dist, rng)
+    pitches = to_pitches(interval_values, start_pitch, register, KEYS[key] if key is not None else None)
+
+    output_stream = make_stream(pitches, durations, BPM)
+
+    instrument.count("notes_generated", len(output_stream.notesAndRests))
+
+    if save_path:
+        save_midi(output_stream, save_path)
+
+    return output_stream
+
+def generate_constrained(order, length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, save_path=None, constraint=None, seed=None):
+    """
+    Like `generate_first_order`/`generate_second_order`, but the pitches are drawn
+    exactly from the model conditioned on `constraint` (see `constrained.py`):
+    every note is in key and in range, and the melody can be forced to end on
+    the tonic. Durations are sampled first, which fixes the number of notes.
+
+    Input:
+        `order`: `first` or `second`, matching the models.
+        `constraint`: a `constrained.Constraint(key, end_on_tonic, min_pitch, max_pitch)`.
+        the rest as in `generate_first_order`.
+
+    Returns:
+        music21.stream.Stream: the generated music21 stream object.
+
+    Raises `constrained.InfeasibleConstraint` if no melody satisfies the constraint.
+    """
+    rng = random.Random(seed)
+    constraint = constraint or Constraint()
+    durations = sample_durations(order, length, BPM, duration_model, starting_duration_dist, rng)
+    table = feasibility_table(pitch_model, starting_pitch_dist, order, constraint, KEYS)
+    pitches = table.sample(len(durations), rng)
+
+    output_stream = make_stream(pitches, durations, BPM)
+
+    instrument.count("notes_generated", len(output_stream.notesAndRests))
+
+    if save_path:
+        save_midi(output_stream, save_path)
 
     return output_stream
 
+def generate_beam(order, length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, beam_width=64, top_k=1, constraint=None, seed=None):
+    """
+    The `top_k` most likely pitch sequences found by beam search (see `beam.py`),
+    instead of random ones. Durations are sampled first, as in `generate_constrained`,
+    and shared by all `top_k` melodies.
+
+    Input:
+        `order`: `first` or `second`, matching the models.
+        `beam_width`: candidates kept per step; wider is slower but finds likelier melodies.
+        `top_k`: how many melodies to return (at most `beam_width`).
+        `constraint`: optional `constrained.Constraint` every melody must satisfy.
+        the rest as in `generate_first_order`.
+
+    Returns:
+        list of (music21.stream.Stream, log-probability of its pitches), most likely first.
+    """
+    rng = random.Random(seed)
+    durations = sample_durations(order, length, BPM, duration_model, starting_duration_dist, rng)
+    with instrument.span("beam_search", beam_width=beam_width, top_k=top_k):
+        decoded = decode(pitch_model, starting_pitch_dist, order, len(durations), beam_width, top_k, constraint, KEYS)
+
+    results = []
+    for pitches, log_prob in decoded:
+        output_stream = make_stream(pitches, durations, BPM)
+        instrument.count("notes_generated", len(output_stream.notesAndRests))
+        results.append((output_stream, log_prob))
+    return results
+
+def generate_smoothed(order, length, BPM, pitch_backoff, duration_backoff, starting_pitch_dist, starting_duration_dist, save_path=None, key=None, seed=None):
+    """
+    Like `generate_first_order`/`generate_second_order`, but every next pitch and
+    duration is drawn from Witten-Bell smoothed models (see `backoff.py`), so an
+    unseen context backs off to a shorter one instead of restarting the melody.
+
+    Input:
+        `order`: `first` or `second`, matching the models.
+        `pitch_backoff`, `duration_backoff`: `backoff.BackoffModel`s, as saved by `markov.py --smoothing`.
+        the rest as in `generate_first_order`.
+
+    Returns:
+        music21.stream.Stream: the generated music21 stream object.
+    """
+    rng = random.Random(seed)
+    seconds_per_beat = 60.0 / BPM
+    context_length = 2 if order == 'second' else 1
+
+    in_key = None
+    if key is not None:
+        in_key = np.array([v == REST or is_in_key(v, key) for v in pitch_backoff.values], dtype=float)
+
+    def sample_next(model, context, mask=None):
+        probs = model.distribution(context[-context_length:])
+        if mask is not None and (probs * mask).sum() > 0:
+            probs = probs * mask
+        return model.values[draw_index(probs, rng)]
+
+    pitch_candidates = starting_pitch_dist
+    if key is not None:
+        in_key_candidates = {start: prob for start, prob in pitch_candidates.items()
+                             if all(p == REST or is_in_key(p, key) for p in (start if order == 'second' else [start]))}
+        if in_key_candidates:
+            pitch_candidates = in_key_candidates
+    start_pitch = rng.choices(list(pitch_candidates.keys()), weights=list(pitch_candidates.values()))[0]
+    start_duration = rng.choices(list(starting_duration_dist.keys()), weights=list(starting_duration_dist.values()))[0]
+    pitches = list(start_pitch) if order == 'second' else [start_pitch]
+    durations = list(start_duration) if order == 'second' else [start_duration]
+
+    current_time = seconds_per_beat * sum(float(d) for d in durations)
+    while current_time < length:
+        pitches.append(sample_next(pitch_backoff, pitches, in_key))
+        durations.append(sample_next(duration_backoff, durations))
+        current_time += seconds_per_beat * float(durations[-1])
+
+    output_stream = make_stream(pitches, durations, BPM)
+
+    instrument.count("notes_generated", len(output_stream.notesAndRests))
+
+    if save_path:
+        save_midi(output_stream, save_path)
+
+    return output_stream
+
+def make_stream(pitches, durations, BPM):
+    """A stream of the given pitches (REST for rests) and durations."""
+    output_stream = stream.Stream()
+    output_stream.append(tempo.MetronomeMark(number=BPM))
+    for pitch, duration in zip(pitches, durations):
+        n = note.Rest() if pitch == REST else note.Note(pitch)
+        n.quarterLength = duration
+        output_stream.append(n)
+    return output_stream
+
+def child_seeds(seed, num_samples):
+    """
+    Derive one independent seed per sample from `seed` with numpy's SeedSequence.
+    Sample i always gets the same child seed, however many samples are drawn and
+    however they are split between workers. With `seed` None, fresh entropy is used.
+    """
+    children = np.random.SeedSequence(seed).spawn(num_samples)
+    return [int(child.generate_state(1, dtype=np.uint64)[0]) for child in children]
+
+# Models and settings shared by every sample in a batch, set once per worker process
+_batch_args = None
+
+def _init_batch_worker(batch_args):
+    global _batch_args
+    _batch_args = batch_args
+
+def _generate_sample(seed):
+    order, length, BPM, models, key, constraint, backoff, interval_args = _batch_args
+    if interval_args is not None:
+        output_stream = generate_intervals(order, length, BPM, *models, None, key, seed, *interval_args)
+    elif backoff is not None:
+        pitch_model, duration_model, starting_pitch_dist, starting_duration_dist = models
+        output_stream = generate_smoothed(order, length, BPM, *backoff, starting_pitch_dist, starting_duration_dist,
+                                          None, key, seed)
+    elif constraint is not None:
+        output_stream = generate_constrained(order, length, BPM, *models, None, constraint, seed)
+    else:
+        generate = generate_first_order if order == 'first' else generate_second_order
+        output_stream = generate(length, BPM, *models, None, key, seed)
+    return midi.translate.streamToMidiFile(output_stream).writestr()
+
+def generate_batch(order, num_samples, length, BPM, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, key=None, seed=None, save_paths=None, workers=1, constraint=None, backoff=None, interval_args=None, cache=None, fingerprint=None):
+    """
+    Input:
+        `order`: `first` or `second`, matching the models.
+        `num_samples`: how many melodies to generate.
+        `length`, `BPM`, models, distributions and `key`: as in `generate_first_order`/`generate_second_order`.
+        `seed`: int seed for the whole batch; sample i is generated from `child_seeds(seed, ...)[i]`.
+        `save_paths`: optional list of `num_samples` paths to save the MIDI files to.
+        `workers`: number of worker processes. The output doesn't depend on it.
+        `constraint`: optional `constrained.Constraint`; uses `generate_constrained` instead.
+        `backoff`: optional (pitch, duration) `backoff.BackoffModel`s; uses `generate_smoothed` instead.
+        `interval_args`: (start_pitch, register) for models trained on intervals; uses `generate_intervals` instead.
+        `cache`: optional `sample_cache.SampleCache`; seeded samples are looked up there first and stored after.
+        `fingerprint`: with `cache`, the model's `SampleCache.model_fingerprint`.
+
+    Returns:
+        list of MIDI file contents (bytes), one per sample.
+    """
+    seeds = child_seeds(seed, num_samples)
+    batch_args = (order, length, BPM, (pitch_model, duration_model, starting_pitch_dist, starting_duration_dist), key, constraint,
+                  backoff, interval_args)
+
+    samples = [None] * num_samples
+    keys = None
+    if cache is not None and seed is not None:
+        params = {"order": order, "length": length, "bpm": BPM, "key": key,
+                  "constraint": constraint._asdict() if constraint is not None else None,
+                  "smoothing": backoff is not None, "intervals": interval_args}
+        keys = cache.keys(fingerprint, params, seeds)
+        samples = [cache.get(k) for k in keys]
+    missing = [i for i, data in enumerate(samples) if data is None]
+
+    generated = []
+    if missing and workers <= 1:
+        _init_batch_worker(batch_args)
+        generated = [_generate_sample(seeds[i]) for i in missing]
+    elif missing:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(batch_args,)) as pool:
+            generated = list(pool.map(_generate_sample, [seeds[i] for i in missing]))
+    for i, data in zip(missing, generated):
+        samples[i] = data
+        if keys is not None:
+            cache.put(keys[i], data)
+    if keys is not None:
+        print(f"Sample cache: {num_samples - len(missing)} hits, {len(missing)} generated")
+        if missing:
+            cache.evict()
+
+    if save_paths:
+        for data, save_path in zip(samples, save_paths):
+            with instrument.span("write_midi", file=save_path):
+                atomic_write_bytes(save_path, data)
+            print(f"Saved as {save_path}")
+    return samples
+
 def main():
     parser = argparse.ArgumentParser(description="Generate midi files")
 
@@ -244,6 +564,65 @@ def main():
         "--output", "-o",
         help="Path to the sample output file"
     )
+    parser.add_argument(
+        "--output-dir", "-od",
+        default=None,
+        help="Directory to save [1..N].mid into, instead of a single --output file"
+    )
+    parser.add_argument(
+        "--num-samples", "-n",
+        type=int,
+        default=1,
+        help="How many samples to generate into --output-dir. Default 1"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for reproducible samples. Each sample gets its own child seed"
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=1,
+        help="Worker processes for generating several samples. Doesn't change the output"
+    )
+    parser.add_argument(
+        "--decode",
+        choices=['sample', 'beam'],
+        default='sample',
+        help="`sample` draws random melodies, `beam` writes the N most likely ones (with their scores). Default sample"
+    )
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=64,
+        help="Candidates kept per step with --decode beam. Default 64"
+    )
+    parser.add_argument(
+        "--smoothing",
+        action="store_true",
+        help="Sample from the Witten-Bell backoff tables saved by `markov.py --smoothing witten-bell`"
+    )
+    parser.add_argument(
+        "--intervals",
+        action="store_true",
+        help="The model was trained on intervals (`preprocess.py --intervals`); map them back to pitches"
+    )
+    parser.add_argument(
+        "--start-pitch",
+        type=int,
+        default=DEFAULT_START_PITCH,
+        help=f"First MIDI pitch with --intervals. Default {DEFAULT_START_PITCH}"
+    )
+    parser.add_argument(
+        "--register",
+        type=int,
+        nargs=2,
+        default=list(DEFAULT_REGISTER),
+        metavar=("LOW", "HIGH"),
+        help=f"Lowest and highest MIDI pitch with --intervals. Default {DEFAULT_REGISTER[0]} {DEFAULT_REGISTER[1]}"
+    )
     parser.add_argument(
         "--order", "-or",
         choices=['first', 'second'],
@@ -270,11 +649,59 @@ def main():
         help="Musical key to constrain generation (e.g., C_major, A_minor)"
     )
 
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Sample exactly under the constraints (key, range, ending) instead of filtering greedily"
+    )
+    parser.add_argument(
+        "--end-on-tonic",
+        action="store_true",
+        help="End on the tonic of --key. Implies --strict"
+    )
+    parser.add_argument(
+        "--min-pitch",
+        type=int,
+        default=None,
+        help="Lowest MIDI pitch allowed. Implies --strict"
+    )
+    parser.add_argument(
+        "--max-pitch",
+        type=int,
+        default=None,
+        help="Highest MIDI pitch allowed. Implies --strict"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Reuse seeded samples stored in this directory, and store new ones there"
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=float,
+        default=DEFAULT_MAX_BYTES / (1024 * 1024),
+        help=f"Size cap of --cache-dir; least recently used samples are evicted. Default {DEFAULT_MAX_BYTES // (1024 * 1024)}"
+    )
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.configure(args.trace, "generate")
+
+    constraint = None
+    if args.strict or args.end_on_tonic or args.min_pitch is not None or args.max_pitch is not None:
+        if args.end_on_tonic and args.key is None:
+            parser.error("--end-on-tonic needs --key")
+        constraint = Constraint(args.key, args.end_on_tonic, args.min_pitch, args.max_pitch)
 
     # set up args
     input_model_dir = args.input
-    output_file = args.output
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_files = [os.path.join(args.output_dir, f"{i}.mid") for i in range(1, args.num_samples + 1)]
+    else:
+        output_files = [args.output]
     order = args.order
     bpm = args.bpm
     length = args.length
@@ -284,39 +711,106 @@ def main():
     pitch_model = input_model_dir + '/pitch.pkl'
     duration_model = input_model_dir + '/duration.pkl'
     try:
-        with open(pitch_model, 'rb') as file:
+        with open(pitch_model, 'rb') as file, instrument.span("load_model", file=pitch_model):
             pitch_transitions, pitch_dist = pickle.load(file)
     except FileNotFoundError:
         print(f"Error: The file '{pitch_model}' was not found.")
-        return
+        sys.exit(1)
     except Exception as e:
         print(f"An error occurred during extraction: {e}")
-        return
+        sys.exit(1)
 
     try:
-        with open(duration_model, 'rb') as file:
+        with open(duration_model, 'rb') as file, instrument.span("load_model", file=duration_model):
             duration_transitions, duration_dist = pickle.load(file)
     except FileNotFoundError:
         print(f"Error: The file '{duration_model}' was not found.")
-        return
+        sys.exit(1)
     except Exception as e:
         print(f"An error occurred during extraction: {e}")
-        return
+        sys.exit(1)
             
+    interval_args = None
+    if args.intervals:
+        if constraint is not None or args.decode == 'beam' or args.smoothing:
+            parser.error("--intervals can't be combined with --strict constraints, --decode beam or --smoothing")
+        if args.register[1] - args.register[0] < 11:
+            parser.error("--register must span at least an octave")
+        interval_args = (args.start_pitch, tuple(args.register))
+
+    backoff = None
+    if args.smoothing:
+        if constraint is not None or args.decode == 'beam':
+            parser.error("--smoothing can't be combined with --strict constraints or --decode beam")
+        try:
+            backoff = tuple(BackoffModel.load(os.path.join(input_model_dir, f"{part}_backoff.pkl"))
+                            for part in ['pitch', 'duration'])
+        except FileNotFoundError as e:
+            print(f"Error: {e}. Train the model with `markov.py --smoothing witten-bell`.")
+            sys.exit(1)
+
     print("="*50)
     print("Generating melodies...")
 
     start_time = time.time()
-    if order == 'first':
-        generate_first_order(length, bpm, pitch_transitions, duration_transitions, pitch_dist, duration_dist, output_file, key)
-    if order == 'second':
-        generate_second_order(length, bpm, pitch_transitions, duration_transitions, pitch_dist, duration_dist, output_file, key)
+    try:
+        with instrument.stage("generate", args.profile):
+            if args.decode == 'beam':
+                if constraint is None and key is not None:
+                    constraint = Constraint(key)
+                decoded = generate_beam(order, length, bpm, pitch_transitions, duration_transitions, pitch_dist,
+                                        duration_dist, max(args.beam_width, len(output_files)), len(output_files),
+                                        constraint, args.seed)
+                if len(decoded) < len(output_files):
+                    print(f"Warning: beam search found only {len(decoded)} melodies.")
+                    output_files = output_files[:len(decoded)]
+                samples = [midi.translate.streamToMidiFile(s).writestr() for s, _ in decoded]
+            else:
+                cache = fingerprint = None
+                if args.cache_dir and args.seed is not None:
+                    cache = SampleCache(args.cache_dir, int(args.cache_size_mb * 1024 * 1024))
+                    model_files = ['pitch.pkl', 'duration.pkl']
+                    if backoff is not None:
+                        model_files += ['pitch_backoff.pkl', 'duration_backoff.pkl']
+                    fingerprint = cache.model_fingerprint(input_model_dir, model_files)
+                with instrument.span("sample"):
+                    samples = generate_batch(order, len(output_files), length, bpm, pitch_transitions, duration_transitions,
+                                             pitch_dist, duration_dist, key, args.seed, workers=args.workers,
+                                             constraint=constraint, backoff=backoff, interval_args=interval_args,
+                                             cache=cache, fingerprint=fingerprint)
+            for data, output_file in zip(samples, output_files):
+                # Without --output or --output-dir the melody is only generated, as before
+                if output_file is None:
+                    continue
+                with instrument.span("write_midi", file=output_file):
+                    atomic_write_bytes(output_file, data)
+
+            if args.decode == 'beam':
+                scores = {os.path.basename(f or "melody"): {"log_prob": log_prob,
+                                                "log_prob_per_note": log_prob / len(s.notesAndRests),
+                                                "num_notes": len(s.notesAndRests)}
+                          for f, (s, log_prob) in zip(output_files, decoded)}
+                for name, score in scores.items():
+                    print(f"{name}: log-probability {score['log_prob']:.2f} ({score['log_prob_per_note']:.3f} per note)")
+                if args.output_dir:
+                    scores_path = os.path.join(args.output_dir, SCORES_FILE)
+                    atomic_write_bytes(scores_path, json.dumps(scores, indent=2).encode())
+                    print(f"Saved scores to {scores_path}")
+            elif args.output_dir and os.path.exists(os.path.join(args.output_dir, SCORES_FILE)):
+                # Scores of earlier beam outputs don't describe these samples
+                os.remove(os.path.join(args.output_dir, SCORES_FILE))
+    except InfeasibleConstraint as e:
+        print(f"Error: {e}")
+        sys.exit(1)
     end_time = time.time()
 
     print("="*50)
     print("\nFinished generating melody: ")
     print(f"Completed process in {end_time - start_time:.2f} seconds")
-    print(f"Saved melody to {output_file}")
+    if output_files[0] is not None:
+        print(f"Saved melody to {', '.join(output_files)}")
+    else:
+        print("Melody not saved; pass --output or --output-dir to save it")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,286 @@
+"""Inspect model sizes and prune models to a byte budget.
+
+`stats` reports, for the pitch and duration models of each directory, the
+number of states (contexts with a row), transitions, values, the pickled
+size and the entropy of the rows, e.g.:
+
+    python3 src/inspect_model.py stats -m models/jazz_highest_second models/pop_highest_first
+
+`prune` writes a smaller copy of a model, e.g. for memory-limited workers:
+
+    python3 src/inspect_model.py prune -m models/jazz_highest_second -o models/jazz_highest_second_small \\
+        --max-kb 500 --eval data/processed/jazz_highest.pkl
+
+Transitions are ranked by their flow: how often the chain is expected to
+take them, i.e. the occupancy of their state times their probability. The
+occupancy is the long-run share of time the chain spends in each state when
+it is restarted from the start distribution at dead ends, like `generate.py`
+does. With `--mass`, each row keeps its most likely transitions up to that
+share of its probability; with `--max-kb`, the transitions with the least
+flow are dropped until both models fit in the budget. A state whose every
+transition is dropped loses its row (a rare context), so generation restarts
+from the start distribution there. Kept rows are re-normalized. Only
+`pitch.pkl` and `duration.pkl` are written: backoff tables and counts
+(`*_backoff.pkl`, `*_counts.pkl`) are left out, with a warning.
+
+The loss is reported as the flow removed (the share of expected transitions
+that now lead nowhere or to a state without a row), and, with `--eval`, as
+the change in log-likelihood per token of held-out sequences (see `score.py`).
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+from build_graph import atomic_pickle_dump, atomic_write_bytes
+from coded_model import from_model
+from markov import model_stats
+from score import model_order, load_model, load_sequences, SequenceScorer, DEFAULT_MIN_PROB
+import instrument
+
+PARTS = ['pitch', 'duration']
+OCCUPANCY_STEPS = 200
+
+
+def row_entropy(model):
+    """Entropy in bits of every row of a CodedModel (0 for states without successors)."""
+    terms = -model.probs * np.log2(model.probs)
+    return np.bincount(model.rows, weights=terms, minlength=model.num_states)
+
+
+def occupancy(model, steps=OCCUPANCY_STEPS):
+    """
+    Long-run share of time spent in each state, starting from `model.start`
+    and restarting from it whenever the chain reaches a state without
+    successors. Averaged over `steps` steps, so periodic chains converge too.
+    """
+    dist = model.start.copy()
+    total = np.zeros(model.num_states)
+    for _ in range(steps):
+        total += dist
+        nxt = np.bincount(model.indices, weights=model.probs * dist[model.rows], minlength=model.num_states)
+        nxt += (1.0 - nxt.sum()) * model.start
+        dist = nxt
+    return total / total.sum()
+
+
+def part_stats(transitions, start_dist):
+    """Sizes and row entropies of one pitch or duration model."""
+    model = from_model(transitions, start_dist, model_order(transitions, start_dist))
+    entropy = row_entropy(model)
+    degree = np.diff(model.indptr)
+    has_row = degree > 0
+    weights = occupancy(model)
+    stats = model_stats(transitions, start_dist)
+    stats.update({
+        "values": len(set(model.values)),
+        "start_states": len(start_dist),
+        "mean_out_degree": float(degree[has_row].mean()) if has_row.any() else 0.0,
+        "max_out_degree": int(degree.max()) if len(degree) else 0,
+        "mean_entropy_bits": float(entropy[has_row].mean()) if has_row.any() else 0.0,
+        "max_entropy_bits": float(entropy.max()) if len(entropy) else 0.0,
+        # Entropy rate: row entropies weighted by how often the chain is in each state
+        "entropy_rate_bits": float((weights * entropy).sum()),
+    })
+    return stats
+
+
+def model_dir_stats(model_dir):
+    """`part_stats` of the pitch and duration models of a directory, plus its file sizes."""
+    model = load_model(model_dir)
+    stats = {part: part_stats(*model[part]) for part in PARTS}
+    stats["files"] = {f: os.path.getsize(os.path.join(model_dir, f)) for f in sorted(os.listdir(model_dir))
+                      if f.endswith(".pkl")}
+    return stats
+
+
+def edge_flows(model):
+    """Expected share of transitions that take each edge of a CodedModel."""
+    return occupancy(model)[model.rows] * model.probs
+
+
+def mass_mask(model, mass):
+    """Per row, keep the most likely edges until they cover `mass` of the row's probability."""
+    keep = np.zeros(len(model.probs), dtype=bool)
+    for i in range(model.num_states):
+        lo, hi = model.indptr[i], model.indptr[i + 1]
+        if lo == hi:
+            continue
+        order = np.argsort(-model.probs[lo:hi], kind="stable")
+        covered = np.cumsum(model.probs[lo:hi][order])
+        # Keep up to and including the edge that reaches `mass`
+        count = int(np.searchsorted(covered, mass - 1e-12)) + 1
+        keep[lo + order[:count]] = True
+    return keep
+
+
+def to_transitions(model, keep):
+    """The transitions dict of a CodedModel restricted to the `keep` edges, re-normalized."""
+    transitions = {}
+    for i in range(model.num_states):
+        lo, hi = model.indptr[i], model.indptr[i + 1]
+        kept = np.flatnonzero(keep[lo:hi]) + lo
+        if len(kept) == 0:
+            continue
+        total = model.probs[kept].sum()
+        transitions[model.states[i]] = {model.values[j]: float(p / total)
+                                        for j, p in zip(model.indices[kept].tolist(), model.probs[kept])}
+    return transitions
+
+
+def pickled_size(transitions, start_dist):
+    return len(pickle.dumps((transitions, start_dist)))
+
+
+def prune(model, mass=None, max_bytes=None):
+    """
+    Input:
+    `model`: {'pitch': (transitions, start_dist), 'duration': (...)}, as from `score.load_model`
+    `mass`: optional share of each row's probability to keep
+    `max_bytes`: optional budget for the pickled size of both parts together
+
+    Returns:
+        ({'pitch': (transitions, start_dist), 'duration': (...)}, {part: share of the flow removed}).
+    """
+    coded = {part: from_model(*model[part], model_order(*model[part])) for part in PARTS}
+    flows = {part: edge_flows(coded[part]) for part in PARTS}
+    keep = {part: np.ones(len(coded[part].probs), dtype=bool) for part in PARTS}
+    if mass is not None:
+        keep = {part: mass_mask(coded[part], mass) for part in PARTS}
+
+    def build(threshold):
+        masks = {part: keep[part] & (flows[part] >= threshold) for part in PARTS}
+        pruned = {part: (to_transitions(coded[part], masks[part]), model[part][1]) for part in PARTS}
+        return pruned, masks
+
+    pruned, masks = build(0.0)
+    if max_bytes is not None and sum(pickled_size(*pruned[p]) for p in PARTS) > max_bytes:
+        # Binary search for the smallest flow threshold that fits the budget
+        candidates = np.unique(np.concatenate([flows[p][keep[p]] for p in PARTS]))
+        lo, hi = 0, len(candidates)
+        best = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            with instrument.span("prune_try", threshold=float(candidates[mid])):
+                attempt = build(candidates[mid])
+            if sum(pickled_size(*attempt[0][p]) for p in PARTS) <= max_bytes:
+                best, hi = attempt, mid
+            else:
+                lo = mid + 1
+        if best is None:
+            # Even without transitions the start distributions don't fit
+            best = build(np.inf)
+        pruned, masks = best
+
+    removed = {part: float(flows[part][~masks[part]].sum() / max(flows[part].sum(), 1e-300)) for part in PARTS}
+    return pruned, removed
+
+
+def log_likelihood_per_token(model, pitches, durations, min_prob=DEFAULT_MIN_PROB):
+    """Mean log-likelihood per pitch and per duration token, and the unseen count of each."""
+    result = {}
+    for part, data in [("pitch", pitches), ("duration", durations)]:
+        ll, unseen = SequenceScorer(*model[part]).score(data, min_prob)
+        tokens = sum(len(seq) for seq in data)
+        result[part] = (float(np.nansum(ll) / max(tokens, 1)), int(unseen.sum()))
+    return result
+
+
+def print_stats(model_dir, stats):
+    print(f"{model_dir}:")
+    for part in PARTS:
+        s = stats[part]
+        print(f"  {part:8}: {s['states']} states, {s['edges']} transitions, {s['values']} values, "
+              f"{s['start_states']} start states, {s['bytes'] / 1024:.1f} KB")
+        print(f"  {'':8}  out-degree mean {s['mean_out_degree']:.2f} / max {s['max_out_degree']}, "
+              f"row entropy mean {s['mean_entropy_bits']:.3f} / max {s['max_entropy_bits']:.3f} bits, "
+              f"entropy rate {s['entropy_rate_bits']:.3f} bits")
+    files = ", ".join(f"{f} {size / 1024:.1f} KB" for f, size in stats["files"].items())
+    print(f"  files   : {files}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect model sizes, or prune a model to a byte budget")
+    parser.add_argument("command", choices=["stats", "prune"],
+                        help="`stats` reports sizes and entropies, `prune` writes a smaller copy of a model")
+    parser.add_argument("--models", "-m", nargs="+", required=True, help="Model directories (one for prune)")
+    parser.add_argument("--output", "-o", default=None,
+                        help="stats: save the report as JSON to this file. prune: output model directory")
+    parser.add_argument("--mass", type=float, default=None,
+                        help="prune: keep each row's most likely transitions up to this share of its probability")
+    parser.add_argument("--max-kb", type=float, default=None,
+                        help="prune: drop the least used transitions until pitch.pkl and duration.pkl fit in this many KB")
+    parser.add_argument("--eval", default=None,
+                        help="prune: preprocessed pickle or MIDI directory to report the log-likelihood loss on")
+    parser.add_argument("--chord-strategy", "-c", choices=["highest", "root", "skip"], default="highest",
+                        help="How to reduce chords to a single pitch when parsing --eval MIDI files")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="Worker processes for parsing --eval MIDI files")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.trace, "inspect")
+
+    if args.command == "stats":
+        report = {}
+        with instrument.stage("inspect", args.profile):
+            for model_dir in args.models:
+                try:
+                    report[model_dir] = model_dir_stats(model_dir)
+                except FileNotFoundError as e:
+                    print(f"Error: {e}")
+                    sys.exit(1)
+                print_stats(model_dir, report[model_dir])
+        if args.output:
+            atomic_write_bytes(args.output, json.dumps(report, indent=2).encode())
+            print(f"Saved stats to {args.output}")
+        return
+
+    if len(args.models) != 1 or args.output is None:
+        parser.error("prune needs exactly one --models directory and --output")
+    if args.mass is None and args.max_kb is None:
+        parser.error("prune needs --mass and/or --max-kb")
+    if args.mass is not None and not 0 < args.mass <= 1:
+        parser.error("--mass must be in (0, 1]")
+    model_dir = args.models[0]
+    try:
+        model = load_model(model_dir)
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    with instrument.stage("prune", args.profile):
+        max_bytes = int(args.max_kb * 1024) if args.max_kb is not None else None
+        pruned, removed = prune(model, args.mass, max_bytes)
+        for part in PARTS:
+            atomic_pickle_dump(pruned[part], os.path.join(args.output, f"{part}.pkl"))
+
+    for part in PARTS:
+        before, after = model_stats(*model[part]), model_stats(*pruned[part])
+        print(f"{part}: {before['states']} -> {after['states']} states, {before['edges']} -> {after['edges']} transitions, "
+              f"{before['bytes'] / 1024:.1f} -> {after['bytes'] / 1024:.1f} KB, {removed[part]:.2%} of the flow removed")
+    if max_bytes is not None and sum(pickled_size(*pruned[p]) for p in PARTS) > max_bytes:
+        print(f"Warning: the start distributions alone don't fit in {args.max_kb} KB.")
+    if args.eval:
+        _, pitches, durations = load_sequences(args.eval, args.chord_strategy, args.workers)
+    if args.eval and not pitches:
+        print(f"Warning: no sequences to evaluate in {args.eval}.")
+    elif args.eval:
+        before = log_likelihood_per_token(model, pitches, durations)
+        after = log_likelihood_per_token(pruned, pitches, durations)
+        for part in PARTS:
+            print(f"{part}: log-likelihood per token {before[part][0]:.4f} -> {after[part][0]:.4f} "
+                  f"({after[part][0] - before[part][0]:+.4f}), unseen {before[part][1]} -> {after[part][1]}")
+    print(f"Saved pruned model to {args.output}")
+    # Backoff tables and counts describe the unpruned model, so they aren't carried over
+    dropped = sorted(f for f in os.listdir(model_dir)
+                     if f.endswith(".pkl") and f not in {f"{part}.pkl" for part in PARTS})
+    if dropped:
+        print(f"Warning: {', '.join(dropped)} not copied; the pruned model can't be used with "
+              f"`generate.py --smoothing` or `online.py`. Retrain with `markov.py` for those.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Lightweight per-stage instrumentation.
+
+Stages (preprocess, train, generate, evaluate) record:
+  - spans: named, timed sections such as parsing, pickling, sampling or MIDI writing
+  - counters: files parsed, failures, transitions counted, notes generated, ...
+  - peak RSS of the process
+
+Records are appended as JSON lines to the trace file given by `--trace` (or
+the MELODY_TRACE environment variable, which `pipeline.py` sets for the
+scripts it runs). Nothing is written when no trace file is configured.
+
+`--profile PATH` additionally runs the whole stage under cProfile and dumps
+the stats to PATH (view with `python3 -m pstats PATH`). With the
+MELODY_PROFILE_DIR environment variable set instead, every stage dumps its
+stats to `<dir>/<stage>-<pid>.prof`.
+"""
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+TRACE_ENV = "MELODY_TRACE"
+PROFILE_DIR_ENV = "MELODY_PROFILE_DIR"
+
+_trace_path = os.environ.get(TRACE_ENV)
+_current_stage = None
+_counters = defaultdict(int)
+_lock = threading.Lock()
+
+
+def configure(trace_path=None, stage_name=None):
+    """
+    Set the trace file (falls back to the MELODY_TRACE environment variable)
+    and the stage that spans recorded from now on belong to.
+    """
+    global _trace_path, _current_stage
+    _trace_path = trace_path or os.environ.get(TRACE_ENV)
+    _current_stage = stage_name
+
+
+def add_arguments(parser):
+    """Add the `--trace` and `--profile` flags to a stage's argument parser."""
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help=f"Append per-stage spans and counters as JSON lines to this file (or set ${TRACE_ENV})"
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Run the stage under cProfile and dump the stats to this file"
+    )
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def emit(record: dict):
+    """Append one JSON record to the trace file, if tracing is enabled."""
+    if not _trace_path:
+        return
+    record = {"time": time.time(), "pid": os.getpid(), "stage": _current_stage, **record}
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        with open(_trace_path, 'a') as f:
+            f.write(line)
+
+
+def count(name, amount=1):
+    """Add `amount` to a counter of the current stage."""
+    with _lock:
+        _counters[name] += amount
+
+
+@contextmanager
+def span(name, **fields):
+    """Time a section of a stage and record it as a span."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit({"type": "span", "name": name, "seconds": time.perf_counter() - start_time,
+              "peak_rss_mb": peak_rss_mb(), **fields})
+
+
+@contextmanager
+def stage(name, profile_path=None):
+    """
+    Wrap a whole stage: optionally profiles it, and records a summary with its
+    duration, counters and peak RSS at the end.
+    """
+    global _current_stage
+    _current_stage = name
+    if profile_path is None and os.environ.get(PROFILE_DIR_ENV):
+        profile_dir = os.environ[PROFILE_DIR_ENV]
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_path = os.path.join(profile_dir, f"{name}-{os.getpid()}.prof")
+    profiler = cProfile.Profile() if profile_path else None
+    start_time = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"Saved profile to {profile_path}")
+        emit({"type": "stage", "name": name, "seconds": time.perf_counter() - start_time,
+              "counters": dict(_counters), "peak_rss_mb": peak_rss_mb()})
+        _counters.clear()
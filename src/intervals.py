@@ -0,0 +1,81 @@
+"""Transposition-invariant interval representation of pitch sequences.
+
+Pitch models key on absolute MIDI numbers, so one melodic shape in 12 keys
+is learned as 12 unrelated sets of states. With `preprocess.py --intervals`
+each sounding note is stored as the interval (in half-steps) from the
+previous sounding note instead, so the shape is learned once:
+
+    [60, 62, REST, 64, 59]  ->  [0, 2, INTERVAL_REST, 2, -5]
+
+The first sounding note has interval 0. Rests keep their place but can't be
+REST (-1) here, since intervals can be negative; they become INTERVAL_REST.
+Interval sequences are trained with the usual `construct_*` functions, and
+generated intervals are mapped back to absolute pitches from a start pitch,
+with every note folded by octaves into a register so long walks in one
+direction stay playable.
+"""
+
+REST = -1
+# Any value outside the possible intervals (-127..127) works
+INTERVAL_REST = 128
+
+DEFAULT_START_PITCH = 60
+DEFAULT_REGISTER = (48, 84)
+
+
+def to_intervals(pitches):
+    """Intervals of a pitch sequence (REST for rests), with INTERVAL_REST for rests."""
+    intervals = []
+    previous = None
+    for pitch in pitches:
+        if pitch == REST:
+            intervals.append(INTERVAL_REST)
+            continue
+        intervals.append(0 if previous is None else pitch - previous)
+        previous = pitch
+    return intervals
+
+
+def clamp_register(pitch, low, high):
+    """Move `pitch` by octaves until it lies in [low, high]."""
+    while pitch > high:
+        pitch -= 12
+    while pitch < low:
+        pitch += 12
+    return pitch
+
+
+def snap_to_scale(pitch, scale):
+    """The nearest pitch (downwards on ties) whose pitch class is in `scale`."""
+    for offset in [0, -1, 1, -2, 2]:
+        if (pitch + offset) % 12 in scale:
+            return pitch + offset
+    return pitch
+
+
+def to_pitches(intervals, start_pitch=DEFAULT_START_PITCH, register=DEFAULT_REGISTER, scale=None):
+    """
+    Input:
+    `intervals`: interval sequence, as made by `to_intervals`
+    `start_pitch`: pitch the first interval is applied to
+    `register`: (low, high) MIDI pitches every note is folded into; at least an octave apart
+    `scale`: optional pitch classes to snap every note to (e.g. `KEYS['C_major']`)
+
+    Returns:
+        list of MIDI pitches, with REST for rests.
+    """
+    low, high = register
+    if high - low < 11:
+        raise ValueError(f"Register {register} is narrower than an octave")
+
+    pitches = []
+    current = start_pitch
+    for interval in intervals:
+        if interval == INTERVAL_REST:
+            pitches.append(REST)
+            continue
+        current = clamp_register(current + interval, low, high)
+        if scale is not None:
+            current = clamp_register(snap_to_scale(current, scale), low, high)
+        pitches.append(current)
+    return pitches
@@ -0,0 +1,377 @@
+"""Play a model live, as MIDI events at BPM-accurate wall-clock times.
+
+`generate.py` renders whole melodies to `.mid` files. Here notes are sampled
+without end and sent as raw MIDI messages (note on / note off) to a sink:
+
+  - `stdout`: the raw bytes, e.g. piped into another program
+  - `socket`: a TCP connection; `live.py receive` is a local test receiver
+  - `port`: a virtual MIDI port other software can connect to (needs `mido`
+    with a backend such as `python-rtmidi`)
+
+e.g.
+
+    python3 src/live.py receive --port 5004 &
+    python3 src/live.py play -i models/jazz_highest_second -or second --sink socket --port 5004
+
+Sampling happens on a background thread that keeps a queue of upcoming notes
+filled, so the main thread only waits and sends. Every note has a deadline
+computed from the start time and the beats before it (so errors don't
+accumulate); the main thread sleeps until shortly before it and spins for
+the rest. How late each note was sent is reported as percentiles at the end.
+Models trained on intervals are played with `--intervals`, mapped back to
+pitches as in `generate.py`.
+"""
+
+import argparse
+import json
+import pickle
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from build_graph import atomic_write_bytes
+from generate import REST, KEYS, is_in_key
+from intervals import INTERVAL_REST, DEFAULT_START_PITCH, DEFAULT_REGISTER, clamp_register, snap_to_scale
+import instrument
+
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5004
+DEFAULT_PORT_NAME = "markov-melody"
+
+# Sleep until this long before a deadline, then spin
+SPIN_SECONDS = 0.002
+# Delay between filling the queue and the first note
+LEAD_SECONDS = 0.1
+
+
+def sample_values(order, transitions, start_dist, rng, allowed=None):
+    """
+    Endless values of a chain, restarting from `start_dist` in unseen contexts
+    like `generate_first_order`/`generate_second_order`. Next values are
+    restricted to `allowed` (a predicate) where any of them is allowed.
+    """
+    def choose(dist, last=lambda v: v):
+        if allowed is not None:
+            filtered = {v: p for v, p in dist.items() if allowed(last(v))}
+            dist = filtered or dist
+        return rng.choices(population=list(dist.keys()), weights=list(dist.values()))[0]
+
+    current = rng.choices(population=list(start_dist.keys()), weights=list(start_dist.values()))[0]
+    yield from (current if order == 'second' else [current])
+
+    while True:
+        if current in transitions:
+            next_value = choose(transitions[current])
+        elif order == 'second':
+            next_value = choose(start_dist, last=lambda pair: pair[1])[1]
+        else:
+            next_value = choose(start_dist)
+        yield next_value
+        current = (current[1], next_value) if order == 'second' else next_value
+
+
+def sample_notes(order, pitch_model, duration_model, starting_pitch_dist, starting_duration_dist, key=None, seed=None):
+    """Endless (pitch, duration) pairs, pitches restricted to `key` like `generate_*`."""
+    rng = random.Random(seed)
+    allowed = None if key is None else (lambda p: p == REST or is_in_key(p, key))
+    pitches = sample_values(order, pitch_model, starting_pitch_dist, rng, allowed)
+    durations = sample_values(order, duration_model, starting_duration_dist, rng)
+    return zip(pitches, durations)
+
+
+def interval_notes(notes, start_pitch=DEFAULT_START_PITCH, register=DEFAULT_REGISTER, scale=None):
+    """Map endless (interval, duration) pairs to (pitch, duration) pairs, like `intervals.to_pitches`."""
+    low, high = register
+    current = start_pitch
+    for interval, duration in notes:
+        if interval == INTERVAL_REST:
+            yield REST, duration
+            continue
+        current = clamp_register(current + interval, low, high)
+        if scale is not None:
+            current = clamp_register(snap_to_scale(current, scale), low, high)
+        yield current, duration
+
+
+class NoteQueue:
+    """Keeps up to `ahead` notes of `notes` sampled in advance on a background thread."""
+
+    def __init__(self, notes, ahead=64):
+        self.notes = notes
+        self.queue = queue.Queue(maxsize=ahead)
+        self.stopped = threading.Event()
+        self.underruns = 0
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        for item in self.notes:
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.stopped.is_set():
+                return
+
+    def wait_full(self, timeout=5.0):
+        """Block until the queue is full (or `timeout` seconds passed)."""
+        deadline = time.perf_counter() + timeout
+        while not self.queue.full() and time.perf_counter() < deadline:
+            time.sleep(0.005)
+
+    def get(self):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            # Sampling fell behind playback
+            self.underruns += 1
+            return self.queue.get()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class StreamSink:
+    """Writes raw MIDI bytes to a binary file object (e.g. stdout)."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def send(self, message):
+        self.f.write(message)
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+
+
+class SocketSink:
+    """Sends raw MIDI bytes over a TCP connection."""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, message):
+        self.sock.sendall(message)
+
+    def close(self):
+        self.sock.close()
+
+
+class PortSink:
+    """Sends messages to a virtual MIDI output port."""
+
+    def __init__(self, name=DEFAULT_PORT_NAME):
+        try:
+            import mido
+        except ImportError:
+            raise RuntimeError("--sink port needs `mido` and `python-rtmidi` (pip install mido python-rtmidi)")
+        self.mido = mido
+        self.port = mido.open_output(name, virtual=True)
+
+    def send(self, message):
+        self.port.send(self.mido.Message.from_bytes(message))
+
+    def close(self):
+        self.port.close()
+
+
+def wait_until(deadline, spin=SPIN_SECONDS):
+    """Sleep until `spin` seconds before `deadline` (a `time.perf_counter` value), then spin."""
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > spin:
+            time.sleep(remaining - spin)
+
+
+def play(notes, BPM, sink, length, channel=0, velocity=100, lead=LEAD_SECONDS):
+    """
+    Input:
+    `notes`: object with a `get()` returning the next (pitch, duration), e.g. a NoteQueue
+    `BPM`: beats per minute
+    `sink`: object with `send(bytes)`
+    `length`: seconds to play; notes that would start later aren't played
+    `channel`, `velocity`: of the note on messages
+
+    Returns:
+        array of scheduling errors in seconds (send time minus deadline), one per note or rest.
+    """
+    seconds_per_beat = 60.0 / BPM
+    start = time.perf_counter() + lead
+    elapsed = 0.0
+    errors = []
+    sounding = None
+
+    while elapsed < length:
+        pitch, duration = notes.get()
+        deadline = start + elapsed
+        wait_until(deadline)
+        errors.append(time.perf_counter() - deadline)
+        if sounding is not None:
+            sink.send(bytes([NOTE_OFF | channel, sounding, 0]))
+        # Keep out-of-range values from breaking the MIDI message
+        sounding = None if pitch == REST else min(max(int(pitch), 0), 127)
+        if sounding is not None:
+            sink.send(bytes([NOTE_ON | channel, sounding, velocity]))
+        elapsed += seconds_per_beat * float(duration)
+
+    if sounding is not None:
+        wait_until(start + elapsed)
+        sink.send(bytes([NOTE_OFF | channel, sounding, 0]))
+
+    instrument.count("notes_played", len(errors))
+    return np.array(errors)
+
+
+def timing_report(errors, underruns=0):
+    """Percentiles of the scheduling errors, in milliseconds."""
+    ms = errors * 1000.0
+    report = {"notes": len(ms), "underruns": underruns}
+    if len(ms):
+        for p in [50, 90, 99]:
+            report[f"p{p}_ms"] = round(float(np.percentile(ms, p)), 4)
+        report["max_ms"] = round(float(ms.max()), 4)
+        report["mean_ms"] = round(float(ms.mean()), 4)
+    return report
+
+
+def receive(host=DEFAULT_HOST, port=DEFAULT_PORT, out=sys.stdout):
+    """
+    Accept one connection and print each MIDI message with its arrival time
+    (seconds since the first one), until the sender disconnects.
+    """
+    with socket.create_server((host, port)) as server:
+        print(f"Listening on {host}:{port}", file=sys.stderr)
+        conn, _ = server.accept()
+        with conn:
+            buffer = b""
+            first = None
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                now = time.perf_counter()
+                first = now if first is None else first
+                buffer += data
+                while len(buffer) >= 3:
+                    status, pitch, velocity = buffer[:3]
+                    buffer = buffer[3:]
+                    kind = "note_on" if status & 0xF0 == NOTE_ON else "note_off"
+                    print(f"{now - first:10.4f} {kind:8} ch={status & 0x0F} pitch={pitch} velocity={velocity}",
+                          file=out, flush=True)
+
+
+def make_sink(args):
+    if args.sink == 'stdout':
+        return StreamSink(sys.stdout.buffer)
+    if args.sink == 'socket':
+        return SocketSink(args.host, args.port)
+    return PortSink(args.port_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a model live as MIDI events")
+    parser.add_argument("command", choices=["play", "receive"],
+                        help="`play` sends generated notes to --sink, `receive` prints what a socket sink sends")
+    parser.add_argument("--input", "-i", help="Path to the model directory")
+    parser.add_argument("--order", "-or", choices=['first', 'second'], help="`first` or `second` depending out input model.")
+    parser.add_argument("--bpm", type=int, default=120, help="Set BPM, default 120")
+    parser.add_argument("--length", type=float, default=30, help="Seconds to play. Default 30")
+    parser.add_argument("--key", "-k", default=None, choices=list(KEYS),
+                        help="Musical key to constrain generation (e.g., C_major, A_minor)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for a reproducible melody")
+    parser.add_argument("--intervals", action="store_true",
+                        help="The model was trained on intervals (`preprocess.py --intervals`); map them back to pitches")
+    parser.add_argument("--start-pitch", type=int, default=DEFAULT_START_PITCH,
+                        help=f"First MIDI pitch with --intervals. Default {DEFAULT_START_PITCH}")
+    parser.add_argument("--register", type=int, nargs=2, default=list(DEFAULT_REGISTER), metavar=("LOW", "HIGH"),
+                        help=f"Lowest and highest MIDI pitch with --intervals. Default {DEFAULT_REGISTER[0]} {DEFAULT_REGISTER[1]}")
+    parser.add_argument("--sink", choices=['stdout', 'socket', 'port'], default='socket',
+                        help="Where MIDI messages go: raw bytes on stdout, a TCP socket, or a virtual MIDI port. Default socket")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Socket host. Default {DEFAULT_HOST}")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Socket port. Default {DEFAULT_PORT}")
+    parser.add_argument("--port-name", default=DEFAULT_PORT_NAME,
+                        help=f"Name of the virtual MIDI port. Default {DEFAULT_PORT_NAME}")
+    parser.add_argument("--ahead", type=int, default=64, help="Notes sampled in advance. Default 64")
+    parser.add_argument("--report", default=None, help="Save the timing report as JSON to this file")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrument.configure(args.trace, "live")
+
+    if args.command == "receive":
+        receive(args.host, args.port)
+        return
+    if args.input is None or args.order is None:
+        parser.error("play needs --input and --order")
+    if args.intervals and args.register[1] - args.register[0] < 11:
+        parser.error("--register must span at least an octave")
+
+    models = []
+    for part in ['pitch', 'duration']:
+        path = f"{args.input}/{part}.pkl"
+        try:
+            with open(path, 'rb') as f, instrument.span("load_model", file=path):
+                models.append(pickle.load(f))
+        except FileNotFoundError:
+            print(f"Error: The file '{path}' was not found.", file=sys.stderr)
+            sys.exit(1)
+    (pitch_transitions, pitch_dist), (duration_transitions, duration_dist) = models
+
+    try:
+        sink = make_sink(args)
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.intervals:
+        # The key snaps mapped pitches to its scale, as in `generate_intervals`
+        notes = sample_notes(args.order, pitch_transitions, duration_transitions, pitch_dist, duration_dist,
+                             None, args.seed)
+        notes = interval_notes(notes, args.start_pitch, tuple(args.register),
+                               KEYS[args.key] if args.key is not None else None)
+    else:
+        notes = sample_notes(args.order, pitch_transitions, duration_transitions, pitch_dist, duration_dist,
+                             args.key, args.seed)
+    notes = NoteQueue(notes, args.ahead)
+    notes.wait_full()
+    try:
+        with instrument.stage("live", args.profile), instrument.span("play"):
+            errors = play(notes, args.bpm, sink, args.length)
+    except (KeyboardInterrupt, BrokenPipeError, ConnectionError):
+        errors = None
+    finally:
+        notes.stop()
+        try:
+            sink.close()
+        except OSError:
+            pass
+    if errors is None:
+        print("Playback stopped.", file=sys.stderr)
+        return
+
+    report = timing_report(errors, notes.underruns)
+    # stdout may carry the MIDI bytes, so the report goes to stderr
+    print(f"Played {report['notes']} notes and rests, {report['underruns']} sampling underruns.", file=sys.stderr)
+    if report['notes']:
+        print(f"Scheduling error: p50 {report['p50_ms']:.3f} ms, p90 {report['p90_ms']:.3f} ms, "
+              f"p99 {report['p99_ms']:.3f} ms, max {report['max_ms']:.3f} ms", file=sys.stderr)
+    if args.report:
+        atomic_write_bytes(args.report, json.dumps(report, indent=2).encode())
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,16 @@ import sys
 import time
 import argparse
 import os
+from build_graph import atomic_pickle_dump
+import instrument
+from backoff import construct_backoff
+from online import CountModel, save_model
 
-def construct_first_order(data: Iterable[Iterable[float]], save_to_file=None) -> Tuple[Dict[float, Dict[float, float]], Dict[float, float]]:
+def construct_first_order(data: Iterable[Iterable[float]], save_to_file=None, min_count=1) -> Tuple[Dict[float, Dict[float, float]], Dict[float, float]]:
     """
     Input:
     `data`: list of numbers, representing a sequence of notes or durations
+    `min_count`: transitions seen fewer times are dropped (states left without any are pruned)
     
     Returns:
       - transition_matrix: dict where each key is a state and its value
@@ -57,6 +62,8 @@ def construct_first_order(data: Iterable[Iterable[float]], save_to_file=None) ->
             i = state_to_index[a]
             j = state_to_index[b]
             counts[i, j] += 1
+    instrument.count("transitions_counted", int(counts.sum()))
+    counts[counts < min_count] = 0
 
     # Convert counts to probabilities (row-normalize)
     probs = counts.astype(float)
@@ -88,16 +95,17 @@ def construct_first_order(data: Iterable[Iterable[float]], save_to_file=None) ->
             start_dist_dict[state] = prob
 
     if save_to_file:
-        with open(save_to_file, 'wb') as f:
-            pickle.dump((transition_dict, start_dist_dict), f)
+        with instrument.span("save_pickle", file=save_to_file):
+            atomic_pickle_dump((transition_dict, start_dist_dict), save_to_file)
 
     return transition_dict, start_dist_dict
 
 
-def construct_second_order(data: Iterable[Iterable[float]], save_to_file=None) -> Tuple[Dict[Tuple[float, float], Dict[float, float]], Dict[Tuple[float, float], float]]:
+def construct_second_order(data: Iterable[Iterable[float]], save_to_file=None, min_count=1) -> Tuple[Dict[Tuple[float, float], Dict[float, float]], Dict[Tuple[float, float], float]]:
     """
     Input:
     `data`: list of numbers, representing a sequence of notes or durations
+    `min_count`: transitions seen fewer times are dropped (states left without any are pruned)
     
     Returns:
         - transition_matrix: dict where each key is a pair of states (note1, note2) 
@@ -128,9 +136,11 @@ def construct_second_order(data: Iterable[Iterable[float]], save_to_file=None) -
             state = (seq[i], seq[i + 1])
             next_val = seq[i + 2]
             transitions[state][next_val] += 1
+        instrument.count("transitions_counted", len(seq) - 2)
     
     transition_dict = {}
     for state, next_vals in transitions.items():
+        next_vals = {val: count for val, count in next_vals.items() if count >= min_count}
         total = sum(next_vals.values())
         if total > 0:
             transition_dict[state] = {val: count / total for val, count in next_vals.items()}
@@ -141,11 +151,19 @@ def construct_second_order(data: Iterable[Iterable[float]], save_to_file=None) -
         start_dist_dict = {pair: count / total_starts for pair, count in start_counts.items()}
     
     if save_to_file:
-        with open(save_to_file, 'wb') as f:
-            pickle.dump((transition_dict, start_dist_dict), f)
+        with instrument.span("save_pickle", file=save_to_file):
+            atomic_pickle_dump((transition_dict, start_dist_dict), save_to_file)
     
     return transition_dict, start_dist_dict
 
+def model_stats(transitions, start_dist):
+    """States, transitions and pickled size of a model."""
+    return {
+        "states": len(transitions),
+        "edges": sum(len(nexts) for nexts in transitions.values()),
+        "bytes": len(pickle.dumps((transitions, start_dist))),
+    }
+
 def main():
     parser = argparse.ArgumentParser(
         description="Construct markov model from data"
@@ -166,7 +184,26 @@ def main():
         help='Order for desired markov model, one of `first` or `second`',
         choices=["first", "second"]
     )
+    parser.add_argument(
+        "--smoothing", "-s",
+        choices=["none", "witten-bell"],
+        default="none",
+        help='Also save Witten-Bell backoff tables (pitch_backoff.pkl, duration_backoff.pkl) for `generate.py --smoothing`. Default none'
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=1,
+        help='Drop transitions seen fewer than N times, pruning rare states. Default 1 (keep everything)'
+    )
+    parser.add_argument(
+        "--keep-counts",
+        action="store_true",
+        help='Also save the raw counts (pitch_counts.pkl, duration_counts.pkl), so `online.py` can update the model later'
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.configure(args.trace, "train")
 
     input_data = args.input
     pitch_output_file = os.path.join(args.output, 'pitch.pkl')
@@ -174,23 +211,39 @@ def main():
     order = args.order
 
     try:
-        with open(input_data, 'rb') as file:
+        with open(input_data, 'rb') as file, instrument.span("load_corpus"):
             pitches, durations = pickle.load(file)
     except FileNotFoundError:
         print(f"Error: The file '{input_data}' was not found.")
+        sys.exit(1)
     except Exception as e:
         print(f"An error occurred during extraction: {e}")
+        sys.exit(1)
            
     print("="*50)
     print("Constructing Markov Models...")
 
     start_time = time.time()
-    if (order == 'first'):
-        construct_first_order(pitches, pitch_output_file)
-        construct_first_order(durations, duration_output_file)
-    else:
-        construct_second_order(pitches, pitch_output_file)
-        construct_second_order(durations, duration_output_file)
+    construct = construct_first_order if order == 'first' else construct_second_order
+    with instrument.stage("train", args.profile):
+        for name, data, output_file in [("pitch", pitches, pitch_output_file),
+                                        ("duration", durations, duration_output_file)]:
+            part_start = time.time()
+            with instrument.span("train_" + name):
+                if args.keep_counts:
+                    # Same transitions as `construct`, from counts kept for later updates
+                    model = CountModel(order, min_count=args.min_count)
+                    model.update(data)
+                    stats = model_stats(*save_model(model, args.output, name))
+                else:
+                    stats = model_stats(*construct(data, output_file, args.min_count))
+            vocab = len({v for seq in data for v in seq})
+            print(f"{name}: {vocab} values, {stats['states']} states, {stats['edges']} transitions, "
+                  f"{stats['bytes'] / 1024:.1f} KB, trained in {time.time() - part_start:.2f} seconds")
+        if args.smoothing == "witten-bell":
+            with instrument.span("train_backoff"):
+                construct_backoff(pitches, order, os.path.join(args.output, 'pitch_backoff.pkl'))
+                construct_backoff(durations, order, os.path.join(args.output, 'duration_backoff.pkl'))
 
     print("="*50)
     end_time = time.time()
@@ -9,28 +9,213 @@ It will create folders under `data/raw` for each emotion and move the files
 into the matching folder. Files that don't match the expected pattern or whose
 emotion is not in the known list are moved into `data/raw/unknown`.
 
+Moves are planned up front and recorded in a journal
+(`data/raw/.organize_journal.jsonl`) as they complete, so a run that crashes
+halfway can be resumed by running it again. A resumed run also plans files
+added to the source folder since, and drops planned files that are gone from
+both the source and the destination. Files are moved on a thread pool.
+
+With --index, nothing is moved: a manifest (`data/raw/xmidi_manifest.csv`)
+of every file's emotion, genre and ID is written instead, and
+`preprocess.py --manifest` can read emotion subsets straight from the source
+folder.
+
 Usage (from repository root):
 	python -m src.mood_data_pipeline --organize
+	python -m src.mood_data_pipeline --index
 
 See the --help output for options like --source and --dest.
 """
 
+import csv
+import io
+import json
+import os
 import re
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
 
+try:
+	from build_graph import atomic_write_bytes
+except ImportError:  # run as `python -m src.mood_data_pipeline`
+	from src.build_graph import atomic_write_bytes
+
 
 DEFAULT_EMOTIONS = [
 	"exciting", "warm", "happy", "romantic", "funny",
 	"sad", "angry", "lazy", "quiet", "fear", "magnificent",
 ]
 
+DEFAULT_MANIFEST = "data/raw/xmidi_manifest.csv"
+JOURNAL_NAME = ".organize_journal.jsonl"
+MANIFEST_FIELDS = ["path", "emotion", "genre", "id"]
+
+XMIDI_PATTERN = re.compile(r"^XMIDI_([^_]+)_([^_]+)_([^_.]+)\.midi?$", re.IGNORECASE)
+EMOTION_PATTERN = re.compile(r"^XMIDI_([^_]+)_", re.IGNORECASE)
+
+
+def parse_xmidi_name(filename: str, emotions: list = None):
+	"""Return (emotion, genre, id) for an XMIDI filename.
+
+	Emotion is "unknown" when the name doesn't match or the emotion isn't in
+	`emotions`; genre and ID are empty when they can't be read.
+	"""
+	if emotions is None:
+		emotions = DEFAULT_EMOTIONS
+	m = XMIDI_PATTERN.match(filename)
+	if m:
+		emo, genre, file_id = m.group(1).lower(), m.group(2).lower(), m.group(3)
+	else:
+		m = EMOTION_PATTERN.match(filename)
+		emo = m.group(1).lower() if m else "unknown"
+		genre, file_id = "", ""
+	if emo not in emotions:
+		emo = "unknown"
+	return emo, genre, file_id
+
+
+def list_midi_files(directory: Path):
+	return sorted(p for p in directory.iterdir() if p.is_file() and p.suffix.lower() in {".mid", ".midi"})
+
+
+def build_manifest(all_moods_dir: str = "data/raw/all_moods", emotions: list = None):
+	"""Return one manifest row (path, emotion, genre, id) per MIDI file in `all_moods_dir`."""
+	if emotions is None:
+		emotions = DEFAULT_EMOTIONS
+	emotions = [e.lower() for e in emotions]
+	rows = []
+	for p in list_midi_files(Path(all_moods_dir)):
+		emo, genre, file_id = parse_xmidi_name(p.name, emotions)
+		rows.append({"path": str(p), "emotion": emo, "genre": genre, "id": file_id})
+	return rows
+
+
+def write_manifest(rows: list, manifest_path: str = DEFAULT_MANIFEST):
+	"""Write manifest rows as CSV, through a temporary file so readers never see half a manifest."""
+	buffer = io.StringIO()
+	writer = csv.DictWriter(buffer, fieldnames=MANIFEST_FIELDS)
+	writer.writeheader()
+	writer.writerows(rows)
+	atomic_write_bytes(manifest_path, buffer.getvalue().encode())
+
+
+def read_manifest(manifest_path: str = DEFAULT_MANIFEST):
+	with open(manifest_path, "r", newline="") as f:
+		return list(csv.DictReader(f))
+
+
+def manifest_files(manifest_path: str, emotions: list, genres: list = None):
+	"""Return the paths of manifest entries with one of `emotions` (and, optionally, one of `genres`)."""
+	emotions = {e.lower() for e in emotions}
+	genres = {g.lower() for g in genres} if genres else None
+	return [row["path"] for row in read_manifest(manifest_path)
+			if row["emotion"] in emotions and (genres is None or row["genre"] in genres)]
+
+
+def index_midi_by_emotion(all_moods_dir: str = "data/raw/all_moods", manifest_path: str = DEFAULT_MANIFEST,
+						  emotions: list = None):
+	"""Write the emotion/genre/ID manifest for `all_moods_dir` without moving anything.
+
+	Returns a dict of counts per emotion.
+	"""
+	if not Path(all_moods_dir).exists():
+		print(f"Source folder {all_moods_dir} does not exist. Nothing to index.")
+		return {}
+	rows = build_manifest(all_moods_dir, emotions)
+	write_manifest(rows, manifest_path)
+
+	counts = {}
+	for row in rows:
+		counts[row["emotion"]] = counts.get(row["emotion"], 0) + 1
+	print(f"Indexed {len(rows)} MIDI files from {all_moods_dir} into {manifest_path}")
+	for emo, c in sorted(counts.items()):
+		print(f"  {emo}: {c} files")
+	return counts
+
+
+class MoveJournal:
+	"""Append-only record of planned and completed moves.
+
+	Each line is a JSON object: {"op": "plan", "src", "dest", "emotion"} for
+	every planned move, {"op": "done", "src"} once a move has completed, and
+	{"op": "complete"} once no planned move is left to retry. A run with failed
+	moves stays incomplete, so the next run retries them. Every append is
+	fsynced, so a completed move is never lost to a crash.
+	"""
+
+	def __init__(self, path: Path):
+		self.path = path
+		self.lock = threading.Lock()
+
+	def read(self):
+		"""Return (planned moves in order, set of completed sources, whether the run completed)."""
+		planned, done, complete = [], set(), False
+		if not self.path.exists():
+			return planned, done, complete
+		with open(self.path, "r") as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# a torn last line from a crash
+					continue
+				if record["op"] == "plan":
+					planned.append(record)
+				elif record["op"] == "done":
+					done.add(record["src"])
+				elif record["op"] == "complete":
+					complete = True
+		return planned, done, complete
+
+	def start(self, moves: list):
+		"""Start a new journal with the planned moves."""
+		atomic_write_bytes(str(self.path), "".join(json.dumps({"op": "plan", **move}) + "\n" for move in moves).encode())
+
+	def append(self, *records: dict):
+		with self.lock:
+			with open(self.path, "a") as f:
+				f.write("".join(json.dumps(record) + "\n" for record in records))
+				f.flush()
+				os.fsync(f.fileno())
+
+
+def plan_moves(all_moods_path: Path, base_path: Path, emotions: list):
+	moves = []
+	for p in list_midi_files(all_moods_path):
+		emo, _, _ = parse_xmidi_name(p.name, emotions)
+		moves.append({"src": str(p), "dest": str(base_path / emo / p.name), "emotion": emo})
+	return moves
+
+
+def _gone(move: dict):
+	"""Whether a planned file is missing from both its source and its destination, so it can't be moved."""
+	return not os.path.exists(move["src"]) and not os.path.exists(move["dest"])
+
+
+def _move(move: dict):
+	"""Move one file. Returns None on success or an error message."""
+	src, dest = move["src"], move["dest"]
+	if not os.path.exists(src):
+		# Moved before a crash but not journaled yet
+		if os.path.exists(dest):
+			return None
+		return f"source {src} is missing"
+	try:
+		shutil.move(src, dest)
+	except Exception as e:
+		return str(e)
+	return None
+
 
 def organize_midi_by_emotion(all_moods_dir: str = "data/raw/all_moods", raw_base: str = "data/raw",
-							 emotions: list = None):
+							 emotions: list = None, workers: int = 8):
 	"""Move MIDI files from `all_moods_dir` into emotion folders under `raw_base`.
 
+	Resumes an interrupted run from its journal in `raw_base` if there is one.
+
 	Returns a dict of counts per emotion.
 	"""
 	if emotions is None:
@@ -39,10 +224,38 @@ def organize_midi_by_emotion(all_moods_dir: str = "data/raw/all_moods", raw_base
 
 	all_moods_path = Path(all_moods_dir)
 	base_path = Path(raw_base)
+	base_path.mkdir(parents=True, exist_ok=True)
+	journal = MoveJournal(base_path / JOURNAL_NAME)
 
-	if not all_moods_path.exists():
-		print(f"Source folder {all_moods_path} does not exist. Nothing to organize.")
-		return {}
+	planned, done, complete = journal.read()
+	skipped = 0
+	if planned and not complete:
+		print(f"Resuming interrupted run: {len(done)} of {len(planned)} moves already done")
+		moves = []
+		for m in planned:
+			if m["src"] in done:
+				continue
+			if _gone(m):
+				print(f"Skipping {m['src']}: it is missing and was never moved to {m['dest']}")
+				skipped += 1
+				continue
+			moves.append(m)
+		if all_moods_path.exists():
+			planned_srcs = {m["src"] for m in planned}
+			added = [m for m in plan_moves(all_moods_path, base_path, emotions) if m["src"] not in planned_srcs]
+			if added:
+				journal.append(*({"op": "plan", **m} for m in added))
+				planned += added
+				moves += added
+				print(f"Found {len(added)} new MIDI files in {all_moods_path}")
+	else:
+		if not all_moods_path.exists():
+			print(f"Source folder {all_moods_path} does not exist. Nothing to organize.")
+			return {}
+		planned = plan_moves(all_moods_path, base_path, emotions)
+		journal.start(planned)
+		moves = planned
+		print(f"Found {len(moves)} MIDI files in {all_moods_path}")
 
 	# Ensure target emotion folders exist
 	for emo in emotions + ["unknown"]:
@@ -50,45 +263,48 @@ def organize_midi_by_emotion(all_moods_dir: str = "data/raw/all_moods", raw_base
 		if not target.exists():
 			target.mkdir(parents=True, exist_ok=True)
 
-	pattern = re.compile(r"^XMIDI_([^_]+)_", re.IGNORECASE)
 	counts = {emo: 0 for emo in emotions}
 	counts["unknown"] = 0
+	for m in planned:
+		if m["src"] in done:
+			counts[m["emotion"]] = counts.get(m["emotion"], 0) + 1
 
-	midi_files = [p for p in all_moods_path.iterdir() if p.is_file() and p.suffix.lower() in {".mid", ".midi"}]
-	print(f"Found {len(midi_files)} MIDI files in {all_moods_path}")
-
-	for p in midi_files:
-		m = pattern.match(p.name)
-		if m:
-			emo = m.group(1).lower()
-			if emo in emotions:
-				dest_dir = base_path / emo
-			else:
-				dest_dir = base_path / "unknown"
-				emo = "unknown"
-		else:
-			dest_dir = base_path / "unknown"
-			emo = "unknown"
-
-		dest = dest_dir / p.name
-		try:
-			shutil.move(str(p), str(dest))
-		except Exception as e:
-			print(f"Failed to move {p} -> {dest}: {e}")
-			continue
-		counts[emo] = counts.get(emo, 0) + 1
-
-	print("Organization complete. Summary:")
+	def move_and_record(move):
+		error = _move(move)
+		if error is None:
+			journal.append({"op": "done", "src": move["src"]})
+		return move, error
+
+	failed = 0
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for move, error in pool.map(move_and_record, moves):
+			if error is not None and _gone(move):
+				print(f"Skipping {move['src']}: it is missing and was never moved to {move['dest']}")
+				skipped += 1
+				continue
+			if error is not None:
+				print(f"Failed to move {move['src']} -> {move['dest']}: {error}")
+				failed += 1
+				continue
+			counts[move["emotion"]] = counts.get(move["emotion"], 0) + 1
+
+	if skipped:
+		print(f"Skipped {skipped} files that no longer exist.")
+	if failed:
+		print(f"{failed} moves failed; run --organize again to retry them. Summary:")
+	else:
+		journal.append({"op": "complete"})
+		print("Organization complete. Summary:")
 	for emo, c in counts.items():
 		print(f"  {emo}: {c} files")
 
 	# If the source folder is now empty, remove it
 	try:
 		# If there are no entries left in the directory, remove it
-		if not any(all_moods_path.iterdir()):
+		if all_moods_path.exists() and not any(all_moods_path.iterdir()):
 			all_moods_path.rmdir()
 			print(f"Removed empty source folder {all_moods_path}")
-		else:
+		elif all_moods_path.exists():
 			print(f"Source folder {all_moods_path} is not empty; not removed.")
 	except Exception as e:
 		print(f"Could not remove source folder {all_moods_path}: {e}")
@@ -98,15 +314,19 @@ def organize_midi_by_emotion(all_moods_dir: str = "data/raw/all_moods", raw_base
 
 def main():
 	parser = argparse.ArgumentParser(description="Organize raw mood MIDI files into per-emotion folders.")
-	parser.add_argument("--organize", action="store_true", help="Run organization (moves files).")
+	parser.add_argument("--organize", action="store_true", help="Run organization (moves files). Resumes an interrupted run.")
+	parser.add_argument("--index", action="store_true", help="Only write the emotion/genre/ID manifest; don't move anything.")
 	parser.add_argument("--source", default="data/raw/all_moods", help="Source folder containing raw all_moods MIDI files")
 	parser.add_argument("--dest", default="data/raw", help="Destination raw base folder where emotion folders will be created")
+	parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="Path of the manifest written by --index")
+	parser.add_argument("--workers", type=int, default=8, help="Threads used to move files")
 	args = parser.parse_args()
 
+	if args.index:
+		index_midi_by_emotion(all_moods_dir=args.source, manifest_path=args.manifest)
 	if args.organize:
-		organize_midi_by_emotion(all_moods_dir=args.source, raw_base=args.dest)
+		organize_midi_by_emotion(all_moods_dir=args.source, raw_base=args.dest, workers=args.workers)
 
 
 if __name__ == "__main__":
 	main()
-
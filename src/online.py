@@ -0,0 +1,245 @@
+"""Count-keeping Markov models that can be updated with new sequences.
+
+Models saved by `markov.py` hold only normalized probabilities, so adding a
+few new files means retraining on the whole corpus. With
+`markov.py --keep-counts`, each model directory also gets the raw counts
+(`pitch_counts.pkl`, `duration_counts.pkl`), and new material can be folded
+in later, e.g.:
+
+    python3 src/online.py -m models/jazz_highest_second -i data/raw/new_jazz
+    python3 src/online.py -m models/jazz_highest_second -i data/processed/new.pkl --decay 0.9
+
+An update adds the new transitions to the counts and re-normalizes only the
+rows (states) they touched, so its cost grows with the new data, not the
+corpus. New states and start states are inserted in place (sorted for first
+order, first seen for second order), and the start total is kept alongside
+the counts. The rewritten `pitch.pkl`/`duration.pkl` are exactly what
+`construct_first_order`/`construct_second_order` would give on all the data,
+down to the order of states and values, so seeded sampling draws the same
+melodies. Building those dicts (`transitions`, `start_dist`) walks the whole
+model, like writing it out does.
+
+With `decay`, every update first multiplies all earlier counts by it, so the
+model follows newer material. Instead of touching every count, the decay is
+kept as one global `scale` (effective count = stored count * scale) and new
+counts are added as 1 / scale. Scaling a whole row doesn't change its
+probabilities, so untouched rows stay valid. A `min_count` above 1 is applied
+to the effective counts; rows normalized at an earlier scale are
+re-thresholded when the model is read, not on every decay.
+"""
+
+import argparse
+import bisect
+import os
+import pickle
+import sys
+import time
+
+from build_graph import atomic_pickle_dump
+import instrument
+
+# Fold the global scale into the counts before it underflows
+MIN_SCALE = 1e-100
+
+
+class CountModel:
+    def __init__(self, order, counts=None, start_counts=None, scale=1.0, min_count=1, start_total=None):
+        """
+        `order`: `first` or `second`
+        `counts`: {state: {next_value: count}}, states as in `construct_*` (values or pairs)
+        `start_counts`: {state: count} of sequence starts
+        `scale`: global factor applied to every stored count (see module docstring)
+        `min_count`: transitions with a smaller effective count are left out of `transitions` (1 keeps everything)
+        `start_total`: sum of `start_counts`, as kept by `update`
+        """
+        self.order = order
+        self.counts = counts if counts is not None else {}
+        self.start_counts = start_counts if start_counts is not None else {}
+        self.scale = scale
+        self.min_count = min_count
+        self.start_total = start_total if start_total is not None else sum(self.start_counts.values())
+        # Sorted state lists give first-order models their `construct_first_order` order;
+        # second-order models use the first-seen order of the dicts themselves
+        self.states = sorted(self.counts) if order == 'first' else None
+        self.start_states = sorted(self.start_counts) if order == 'first' else None
+        # state -> (threshold it was normalized at, normalized row or None)
+        self.rows = {}
+
+    def split(self, seq):
+        """The start state of a sequence (None if too short) and its (state, next value) transitions."""
+        if self.order == 'first':
+            start = seq[0] if len(seq) >= 1 else None
+            return start, zip(seq[:-1], seq[1:])
+        start = (seq[0], seq[1]) if len(seq) >= 2 else None
+        return start, (((seq[i], seq[i + 1]), seq[i + 2]) for i in range(len(seq) - 2))
+
+    def update(self, sequences, decay=None):
+        """
+        Input:
+        `sequences`: new sequences of values (pitches or durations)
+        `decay`: optional factor in (0, 1] applied to all earlier counts first
+
+        Returns:
+            the set of states whose rows were re-normalized.
+        """
+        if decay is not None:
+            if not 0 < decay <= 1:
+                raise ValueError(f"decay must be in (0, 1], got {decay}")
+            self.scale *= decay
+            if self.scale < MIN_SCALE:
+                self._rescale()
+        weight = 1.0 / self.scale
+
+        touched = set()
+        num_transitions = 0
+        for seq in sequences:
+            start, transitions = self.split(list(seq))
+            if start is not None:
+                if start not in self.start_counts and self.start_states is not None:
+                    bisect.insort(self.start_states, start)
+                self.start_counts[start] = self.start_counts.get(start, 0) + weight
+                self.start_total += weight
+            for state, next_value in transitions:
+                row = self.counts.get(state)
+                if row is None:
+                    row = self.counts[state] = {}
+                    if self.states is not None:
+                        bisect.insort(self.states, state)
+                row[next_value] = row.get(next_value, 0) + weight
+                touched.add(state)
+                num_transitions += 1
+
+        for state in touched:
+            self._normalize(state)
+        instrument.count("transitions_counted", num_transitions)
+        return touched
+
+    def _threshold(self):
+        """Smallest stored count kept in `transitions`, or None when everything is kept."""
+        return self.min_count / self.scale if self.min_count > 1 else None
+
+    def _normalize(self, state):
+        threshold = self._threshold()
+        items = self.counts[state].items()
+        if self.order == 'first':
+            items = sorted(items)
+        row = {v: c for v, c in items if threshold is None or c >= threshold}
+        total = sum(row.values())
+        self.rows[state] = (threshold, {v: c / total for v, c in row.items()} if total > 0 else None)
+
+    @property
+    def transitions(self):
+        """{state: {next_value: probability}}, in `construct_*` order."""
+        threshold = self._threshold()
+        transitions = {}
+        for state in (self.states if self.states is not None else self.counts):
+            cached = self.rows.get(state)
+            if cached is None or cached[0] != threshold:
+                self._normalize(state)
+                cached = self.rows[state]
+            if cached[1] is not None:
+                transitions[state] = cached[1]
+        return transitions
+
+    @property
+    def start_dist(self):
+        """{state: probability} of sequence starts, in `construct_*` order."""
+        if self.start_total <= 0:
+            return {}
+        starts = self.start_states if self.start_states is not None else self.start_counts
+        return {s: self.start_counts[s] / self.start_total for s in starts}
+
+    def _rescale(self):
+        for row in self.counts.values():
+            for v in row:
+                row[v] *= self.scale
+        for s in self.start_counts:
+            self.start_counts[s] *= self.scale
+        self.start_total *= self.scale
+        self.scale = 1.0
+        self.rows = {}
+
+    def save(self, path):
+        atomic_pickle_dump({"order": self.order, "counts": self.counts, "start_counts": self.start_counts,
+                            "scale": self.scale, "min_count": self.min_count, "start_total": self.start_total}, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(**pickle.load(f))
+
+
+def save_model(model, model_dir, part):
+    """
+    Write `<part>.pkl` (as `markov.py` does) and `<part>_counts.pkl` into `model_dir`.
+
+    Returns:
+        the saved (transitions, start_dist).
+    """
+    model_file = os.path.join(model_dir, f"{part}.pkl")
+    counts_file = os.path.join(model_dir, f"{part}_counts.pkl")
+    with instrument.span("save_pickle", file=model_file):
+        saved = (model.transitions, model.start_dist)
+        atomic_pickle_dump(saved, model_file)
+        model.save(counts_file)
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold new sequences into a model trained with `markov.py --keep-counts`")
+    parser.add_argument("--model", "-m", required=True, help="Path to the model directory")
+    parser.add_argument("--input", "-i", required=True,
+                        help="A preprocessed pickle or a directory of MIDI files with the new material")
+    parser.add_argument("--decay", type=float, default=None,
+                        help="Multiply all earlier counts by this factor in (0, 1] before adding the new ones")
+    parser.add_argument("--intervals", action="store_true",
+                        help="The model was trained on intervals; convert the pitches of MIDI input to intervals")
+    parser.add_argument("--chord-strategy", "-c", choices=["highest", "root", "skip"], default="highest",
+                        help="How to reduce chords to a single pitch when parsing MIDI input")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="Worker processes for parsing MIDI input")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.trace, "update")
+
+    if args.decay is not None and not 0 < args.decay <= 1:
+        parser.error("--decay must be in (0, 1]")
+
+    models = {}
+    for part in ['pitch', 'duration']:
+        path = os.path.join(args.model, f"{part}_counts.pkl")
+        try:
+            with instrument.span("load_model", file=path):
+                models[part] = CountModel.load(path)
+        except FileNotFoundError:
+            print(f"Error: The file '{path}' was not found. Train the model with `markov.py --keep-counts`.")
+            sys.exit(1)
+
+    from score import load_sequences
+    with instrument.span("load_sequences"):
+        _, pitches, durations = load_sequences(args.input, args.chord_strategy, args.workers)
+    if args.intervals and os.path.isdir(args.input):
+        from intervals import to_intervals
+        pitches = [to_intervals(p) for p in pitches]
+
+    print("=" * 50)
+    print(f"Updating {args.model} with {len(pitches)} sequences...")
+    start_time = time.time()
+    with instrument.stage("update", args.profile):
+        for part, data in [("pitch", pitches), ("duration", durations)]:
+            model = models[part]
+            states_before = len(model.counts)
+            with instrument.span("update_" + part):
+                touched = model.update(data, args.decay)
+            transitions, _ = save_model(model, args.model, part)
+            print(f"{part}: {len(touched)} rows re-normalized, "
+                  f"{len(model.counts) - states_before} new states, {len(transitions)} total")
+
+    stale = [f for f in ["pitch_backoff.pkl", "duration_backoff.pkl"] if os.path.exists(os.path.join(args.model, f))]
+    if stale:
+        print(f"Warning: {', '.join(stale)} were not updated; retrain with `markov.py --smoothing witten-bell`.")
+    print("=" * 50)
+    print(f"Completed update in {time.time() - start_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
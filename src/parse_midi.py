@@ -1,13 +1,52 @@
-from music21 import converter, note
+from music21 import converter, note, instrument
 
 REST = -1
 
-def parse_midi(filename, chord_strategy='highest'):
+def notes_to_sequence(notes, chord_strategy='highest'):
+    """
+    Turn a flattened stream of notes/chords into (pitches, durations), adding a
+    REST wherever there is a gap between notes. See `parse_midi` for `chord_strategy`.
+    """
+    pitches = []
+    durations = []
+    current_time = 0
+
+    for n in notes:
+        if n.offset > current_time:
+            rest_duration = n.offset - current_time
+            pitches.append(REST)
+            durations.append(rest_duration)
+
+        if n.isNote:
+            pitches.append(n.pitch.midi)
+            durations.append(n.duration.quarterLength)
+        elif n.isChord:
+            if chord_strategy == 'highest':
+                pitches.append(n.pitches[-1].midi)
+            elif chord_strategy == 'root':
+                pitches.append(n.root().midi)
+            elif chord_strategy == 'skip': 
+                continue
+            durations.append(n.duration.quarterLength)
+        current_time = n.offset + n.duration.quarterLength
+
+    return pitches, durations
+
+def melody_notes(score):
+    """The flattened notes of the melody: the first part, or the whole score if that part has no notes."""
+    if len(score.parts) > 0:
+        notes = score.parts[0].flatten().notes
+        if len(notes) > 0:
+            return notes
+    return score.flatten().notes
+
+def parse_midi(filename, chord_strategy='highest', raise_errors=False):
     """
     Input:
     `filename`: path to a MIDI file
     `chord_strategy`: strategy for handling chords; options are
       'highest' (use highest note), 'root' (use root note), 'skip' (ignore chords)
+    `raise_errors`: raise parse errors instead of returning empty sequences
   
     Returns:
       - pitches: list of MIDI pitch numbers (integers), with REST (-1) for rests
@@ -15,38 +54,97 @@ def parse_midi(filename, chord_strategy='highest'):
     """
     try:
         score = converter.parse(filename)
-        
-        if len(score.parts) > 0:
-            notes = score.parts[0].flatten().notes
-            if len(notes) == 0:
-                notes = score.flatten().notes
-        else:
-            notes = score.flatten().notes
-        
-        pitches = []
-        durations = []
-        current_time = 0
-        
-        for n in notes:
-            if n.offset > current_time:
-                rest_duration = n.offset - current_time
-                pitches.append(REST)
-                durations.append(rest_duration)
-
-            if n.isNote:
-                pitches.append(n.pitch.midi)
-                durations.append(n.duration.quarterLength)
-            elif n.isChord:
-                if chord_strategy == 'highest':
-                    pitches.append(n.pitches[-1].midi)
-                elif chord_strategy == 'root':
-                    pitches.append(n.root().midi)
-                elif chord_strategy == 'skip': 
-                    continue
-                durations.append(n.duration.quarterLength)
-            current_time = n.offset + n.duration.quarterLength
-
-        return pitches, durations
+        return notes_to_sequence(melody_notes(score), chord_strategy)
     
     except Exception as e:
-        return [], []
\ No newline at end of file
+        if raise_errors:
+            raise
+        return [], []
+
+def notes_to_chords(notes):
+    """
+    Like `notes_to_sequence`, but keeping every pitch: returns (chords, durations) where each
+    chord is a sorted tuple of MIDI pitches, a single note a 1-tuple, and a rest ().
+    """
+    chords = []
+    durations = []
+    current_time = 0
+
+    for n in notes:
+        if n.offset > current_time:
+            chords.append(())
+            durations.append(n.offset - current_time)
+        if n.isNote or n.isChord:
+            chords.append(tuple(sorted(p.midi for p in n.pitches)))
+            durations.append(n.duration.quarterLength)
+        current_time = n.offset + n.duration.quarterLength
+
+    return chords, durations
+
+def is_percussion(part):
+    """Whether a part is a drum track (MIDI channel 10, or an unpitched percussion instrument)."""
+    return any(inst.midiChannel == 9 or isinstance(inst, instrument.UnpitchedPercussion)
+               for inst in part.recurse().getElementsByClass(instrument.Instrument))
+
+def parse_midi_parts(filename, chord_strategy='highest', raise_errors=False):
+    """
+    Input:
+    `filename`: path to a MIDI file
+    `chord_strategy`, `raise_errors`: as in `parse_midi`
+
+    Parses the file once and returns one entry per part with notes, as a dict with:
+      - index, name: the part's position in the score and its name
+      - role: `melody` (the part `parse_midi` reads, so its sequence is the same),
+        `bass` (the lowest part, if below the melody), `harmony` (mostly chords),
+        or `inner` (anything else). Drum tracks are recognized and left out
+      - pitches, durations: as returned by `parse_midi`
+      - chords, chord_durations: as returned by `notes_to_chords`
+    Returns [] if the file can't be parsed.
+    """
+    try:
+        score = converter.parse(filename)
+    except Exception as e:
+        if raise_errors:
+            raise
+        return []
+
+    parts = []
+    for index, part in enumerate(score.parts):
+        notes = part.flatten().notes
+        if len(notes) == 0:
+            continue
+        parts.append({"index": index, "name": part.partName, "notes": notes,
+                      "role": "drums" if is_percussion(part) else None})
+
+    # Same melody as parse_midi: the first part, or the whole score if that part is empty
+    if len(score.parts) > 0 and parts and parts[0]["index"] == 0:
+        melody = parts[0]
+    else:
+        melody = {"index": None, "name": "score", "notes": score.flatten().notes, "role": None}
+        parts.insert(0, melody)
+    melody["role"] = "melody"
+
+    def mean_pitch(p):
+        pitches = [pitch.midi for n in p["notes"] for pitch in n.pitches]
+        return sum(pitches) / len(pitches) if pitches else float('inf')
+
+    others = [p for p in parts if p["role"] is None]
+    if others:
+        lowest = min(others, key=mean_pitch)
+        if mean_pitch(lowest) < mean_pitch(melody):
+            lowest["role"] = "bass"
+    for p in others:
+        if p["role"] is None:
+            chord_share = sum(1 for n in p["notes"] if n.isChord) / len(p["notes"])
+            p["role"] = "harmony" if chord_share >= 0.3 else "inner"
+
+    result = []
+    for p in parts:
+        if p["role"] == "drums":
+            continue
+        pitches, durations = notes_to_sequence(p["notes"], chord_strategy)
+        chords, chord_durations = notes_to_chords(p["notes"])
+        result.append({"index": p["index"], "name": p["name"], "role": p["role"],
+                       "pitches": pitches, "durations": durations,
+                       "chords": chords, "chord_durations": chord_durations})
+    return result
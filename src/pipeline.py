@@ -1,6 +1,12 @@
 import argparse
 import os
 import subprocess
+import sys
+from build_graph import BuildGraph, Source, Step
+import instrument
+from mood_data_pipeline import DEFAULT_MANIFEST, manifest_files
+from constrained import Constraint
+from sample_cache import GENERATION_CODE
 
 def join_genres(genres: list):
     """
@@ -9,24 +15,26 @@ def join_genres(genres: list):
     """
     return "_".join(sorted(genres))
 
-def get_preprocessed_path(genres: list, chord_strategy: str, base_dir="data/processed"):
+def representation_suffix(representation: str):
+    """Name suffix of processed data and models for a pitch representation (none for absolute pitches)."""
+    return "" if representation == "absolute" else f"_{representation}"
+
+def get_preprocessed_path(genres: list, chord_strategy: str, base_dir="data/processed", representation="absolute"):
     """
     Returns the path to the preprocessed .pkl file.
     """
     genre_str = join_genres(genres)
-    filename = f"processed_{genre_str}_{chord_strategy}.pkl"
+    filename = f"processed_{genre_str}_{chord_strategy}{representation_suffix(representation)}.pkl"
     full_path = os.path.join(base_dir, filename)
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
     return full_path
 
-def get_model_dir(genres: list, chord_strategy: str, order: str, base_dir="models"):
+def get_model_dir(genres: list, chord_strategy: str, order: str, base_dir="models", representation="absolute"):
     """
     Returns a directory path for a Markov model.
     """
     genre_str = join_genres(genres)
-    dirname = f"{genre_str}_{chord_strategy}_{order}"
+    dirname = f"{genre_str}_{chord_strategy}{representation_suffix(representation)}_{order}"
     full_path = os.path.join(base_dir, dirname)
-    os.makedirs(full_path, exist_ok=True)
     return full_path
 
 def get_sample_dir(model_dir: str, base_dir="outputs"):
@@ -35,11 +43,193 @@ def get_sample_dir(model_dir: str, base_dir="outputs"):
     """
     model_name = os.path.basename(model_dir)
     full_path = os.path.join(base_dir, model_name)
-    os.makedirs(full_path, exist_ok=True)
     return full_path
 
-def file_nonempty(path):
-    return os.path.exists(path) and os.path.getsize(path) > 0
+def get_raw_files(genres: list, base_dir="data/raw", manifest=DEFAULT_MANIFEST):
+    """
+    Returns every raw MIDI file for the given genres, or [] if any genre is
+    missing (a partial corpus can't reproduce the processed data).
+    Moods that weren't organized into folders are looked up in the XMIDI manifest.
+    """
+    files = []
+    for genre in genres:
+        genre_dir = os.path.join(base_dir, genre)
+        if os.path.isdir(genre_dir):
+            files += [os.path.join(genre_dir, f) for f in sorted(os.listdir(genre_dir))
+                      if f.lower().endswith('.mid') or f.lower().endswith('.midi')]
+            continue
+        indexed = sorted(manifest_files(manifest, [genre])) if os.path.exists(manifest) else []
+        if not indexed:
+            return []
+        files += indexed
+    return files
+
+def run_script(script_args, log=None):
+    """
+    Run one of the stage scripts, returning True if it succeeded.
+    `log`: optional path of a file to append the script's output to.
+    """
+    if log is None:
+        return subprocess.run(["python3", *script_args]).returncode == 0
+    with open(log, 'a') as f:
+        return subprocess.run(["python3", *script_args], stdout=f, stderr=subprocess.STDOUT).returncode == 0
+
+def add_preprocess_step(graph, genres, chord_strategy, log=None, representation="absolute", quantize=None,
+                        hash_cache=None):
+    """
+    Add the raw files and the processed corpus built from them to `graph`.
+    With `representation` "interval", pitches are stored as intervals.
+    With a `quantize` grid (in quarter notes), durations are quantized to it.
+    A shared `build_graph.HashCache` can be passed as `hash_cache`; the caller saves it.
+    """
+    preprocessed_file = get_preprocessed_path(genres, chord_strategy, representation=representation)
+    raw = graph.add(Source("raw", lambda: get_raw_files(genres), hash_cache))
+    return graph.add(Step(
+        "preprocess",
+        target=preprocessed_file,
+        outputs=lambda: [preprocessed_file],
+        action=lambda: run_script([
+            "src/preprocess.py",
+            "-o", preprocessed_file,
+            "-c", chord_strategy,
+            "-g", *genres
+        ] + (["-m", DEFAULT_MANIFEST] if os.path.exists(DEFAULT_MANIFEST) else [])
+          + (["--intervals"] if representation == "interval" else [])
+          + (["--quantize", str(quantize)] if quantize is not None else []), log),
+        deps=[raw],
+        params={"genres": sorted(genres), "chord_strategy": chord_strategy, "representation": representation,
+                "quantize": quantize},
+        code=["parse_midi.py", "preprocess.py", "intervals.py", "quantize.py", "safe_parse.py", "corpus_index.py",
+              "mood_data_pipeline.py"],
+    ))
+
+def add_train_step(graph, processed, genres, chord_strategy, order, log=None, smoothing="none", min_count=1):
+    """
+    Add the Markov models trained from the `processed` step to `graph`.
+    With `smoothing` "witten-bell", the model also gets backoff tables.
+    Transitions seen fewer than `min_count` times are pruned.
+    """
+    representation = processed.params["representation"]
+    model_dir = get_model_dir(genres, chord_strategy, order, representation=representation)
+    model_files = ["pitch.pkl", "duration.pkl"]
+    if smoothing != "none":
+        model_files += ["pitch_backoff.pkl", "duration_backoff.pkl"]
+    return graph.add(Step(
+        "train",
+        target=model_dir,
+        outputs=lambda: [os.path.join(model_dir, f) for f in model_files],
+        action=lambda: run_script([
+            "src/markov.py",
+            "-i", processed.target,
+            "-o", model_dir,
+            "-or", order,
+            "-s", smoothing,
+            "--min-count", str(min_count)
+        ], log),
+        deps=[processed],
+        params={"order": order, "smoothing": smoothing, "representation": representation, "min_count": min_count},
+        code=["markov.py", "backoff.py"],
+    ))
+
+def add_generate_step(graph, model, sample_dir, num_samples, bpm, length, key=None, seed=None, workers=1, log=None,
+                      constraint=None, decode="sample", beam_width=64, smoothing=False, cache_dir=None):
+    """
+    Add `num_samples` melodies generated from the `model` step into `sample_dir` to `graph`.
+    With a `seed` the samples are reproducible, so they are only regenerated when stale.
+    With a `constrained.Constraint`, pitches are sampled exactly under it (its key is `key`).
+    With `decode` "beam", the `num_samples` most likely melodies are written instead, with their scores.
+    With `smoothing`, melodies are sampled from the model's backoff tables.
+    With a `cache_dir`, seeded samples are reused from that `sample_cache.SampleCache`.
+    """
+    sample_files = [os.path.join(sample_dir, f"{i}.mid") for i in range(1, num_samples + 1)]
+    order = model.params["order"]
+
+    def generate_samples():
+        script_args = [
+            "src/generate.py",
+            "-i", model.target,
+            "-od", sample_dir,
+            "-n", str(num_samples),
+            "-or", order,
+            "--bpm", str(bpm),
+            "--length", str(length),
+            "--workers", str(workers),
+            "--decode", decode,
+        ]
+        if decode == "beam":
+            script_args += ["--beam-width", str(beam_width)]
+        if smoothing:
+            script_args += ["--smoothing"]
+        if model.params["representation"] == "interval":
+            script_args += ["--intervals"]
+        if key is not None:
+            script_args += ["-k", key]
+        if seed is not None:
+            script_args += ["--seed", str(seed)]
+        if cache_dir is not None:
+            script_args += ["--cache-dir", cache_dir]
+        if constraint is not None:
+            script_args += ["--strict"]
+            if constraint.end_on_tonic:
+                script_args += ["--end-on-tonic"]
+            if constraint.min_pitch is not None:
+                script_args += ["--min-pitch", str(constraint.min_pitch)]
+            if constraint.max_pitch is not None:
+                script_args += ["--max-pitch", str(constraint.max_pitch)]
+        return run_script(script_args, log)
+
+    # Unseeded sampling is random, so those samples are regenerated on every run.
+    return graph.add(Step(
+        "generate",
+        target=sample_dir,
+        outputs=lambda: sample_files,
+        action=generate_samples,
+        deps=[model],
+        params={"num_samples": num_samples, "bpm": bpm, "length": length, "key": key, "seed": seed,
+                "constraint": constraint._asdict() if constraint is not None else None,
+                "decode": decode, "beam_width": beam_width if decode == "beam" else None, "smoothing": smoothing},
+        code=GENERATION_CODE + ["sample_cache.py"],
+        always=seed is None,
+    ))
+
+def add_evaluate_step(graph, samples, eval_dir, log=None):
+    """Add the evaluation of the `samples` step into `eval_dir` to `graph`."""
+    return graph.add(Step(
+        "evaluate",
+        target=eval_dir,
+        outputs=lambda: [os.path.join(eval_dir, "metrics.json")],
+        action=lambda: run_script([
+            "src/evaluate.py",
+            "-d", samples.target,
+            "-o", eval_dir,
+            "-mp"
+        ], log),
+        deps=[samples],
+        code=["evaluate.py"],
+    ))
+
+def make_build_graph(genres, chord_strategy, order, num_samples, bpm, length, key=None, evaluate=False, seed=None, workers=1,
+                     constraint=None, decode="sample", beam_width=64, smoothing="none", representation="absolute",
+                     quantize=None, min_count=1, cache_dir=None):
+    """
+    Returns the build graph raw files -> processed corpus -> models -> samples (-> evaluation).
+    """
+    graph = BuildGraph()
+    processed = add_preprocess_step(graph, genres, chord_strategy, representation=representation, quantize=quantize)
+    model = add_train_step(graph, processed, genres, chord_strategy, order, smoothing=smoothing, min_count=min_count)
+
+    sample_dir = get_sample_dir(model.target)
+    eval_dir = os.path.join("evaluation", os.path.basename(model.target))
+    if key is not None:
+        sample_dir = os.path.join(sample_dir, key)
+        eval_dir = os.path.join(eval_dir, key)
+
+    samples = add_generate_step(graph, model, sample_dir, num_samples, bpm, length, key, seed, workers,
+                                constraint=constraint, decode=decode, beam_width=beam_width,
+                                smoothing=smoothing != "none", cache_dir=cache_dir)
+    if evaluate:
+        add_evaluate_step(graph, samples, eval_dir)
+    return graph
 
 def main():
     # Initialize Parser
@@ -92,8 +282,110 @@ def main():
                 'A_minor', 'E_minor', 'D_minor', 'Bb_major'],
         help="Musical key to constrain generation (e.g., C_major, A_minor)"
     )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Sample exactly under the key/range/ending constraints instead of filtering greedily"
+    )
+    parser.add_argument(
+        "--end-on-tonic",
+        action="store_true",
+        help="End every melody on the tonic of --key. Implies --strict"
+    )
+    parser.add_argument(
+        "--min-pitch",
+        type=int,
+        default=None,
+        help="Lowest MIDI pitch allowed. Implies --strict"
+    )
+    parser.add_argument(
+        "--max-pitch",
+        type=int,
+        default=None,
+        help="Highest MIDI pitch allowed. Implies --strict"
+    )
+    parser.add_argument(
+        "--representation", "-r",
+        choices=["absolute", "interval"],
+        default="absolute",
+        help="Train pitch models on absolute MIDI pitches, or on intervals between notes (transposition-invariant)"
+    )
+    parser.add_argument(
+        "--quantize",
+        type=float,
+        default=None,
+        metavar="GRID",
+        help="Quantize durations to multiples (and triplets) of GRID quarter notes, e.g. 0.25, capping rests at 4"
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=1,
+        help="Prune transitions seen fewer than N times from the models. Default 1 (keep everything)"
+    )
+    parser.add_argument(
+        "--smoothing", "-s",
+        choices=["none", "witten-bell"],
+        default="none",
+        help="Train Witten-Bell backoff tables and sample from them, so unseen contexts back off smoothly"
+    )
+    parser.add_argument(
+        "--decode",
+        choices=["sample", "beam"],
+        default="sample",
+        help="`sample` draws random melodies, `beam` generates the most likely ones and scores them"
+    )
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=64,
+        help="Candidates kept per step with --decode beam. Default 64"
+    )
+    parser.add_argument(
+        "--sample-cache",
+        default=None,
+        help="Directory of a cache of seeded samples, shared by every model and output directory"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for reproducible samples. Seeded samples are reused until the model or settings change"
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=1,
+        help="Worker processes for generating samples. Doesn't change the output. Default 1"
+    )
+    parser.add_argument(
+        "--evaluate", "-e",
+        action="store_true",
+        help="Also evaluate the generated samples into evaluation/[MODEL_NAME]"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show which steps are stale and would be rebuilt, without running anything"
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Append per-stage spans and counters from every stage as JSON lines to this file"
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Run every stage under cProfile and dump the stats into this directory"
+    )
     args = parser.parse_args()
 
+    # Stage scripts pick these up from the environment
+    if args.trace:
+        os.environ[instrument.TRACE_ENV] = os.path.abspath(args.trace)
+    if args.profile:
+        os.environ[instrument.PROFILE_DIR_ENV] = os.path.abspath(args.profile)
+
     # Get args
     genres = args.genres
     order = args.order
@@ -109,59 +401,26 @@ def main():
     elif 'all-moods' in genres:
         genres = ['angry', 'sad', 'exciting', 'warm']
 
+    constraint = None
+    if args.strict or args.end_on_tonic or args.min_pitch is not None or args.max_pitch is not None:
+        if args.end_on_tonic and key is None:
+            parser.error("--end-on-tonic needs --key")
+        constraint = Constraint(key, args.end_on_tonic, args.min_pitch, args.max_pitch)
+    # generate.py rejects these combinations; fail before preprocessing and training run
+    if args.representation == "interval" and (constraint is not None or args.decode == "beam" or args.smoothing != "none"):
+        parser.error("--representation interval can't be combined with --strict constraints, --decode beam or --smoothing")
+    if args.smoothing != "none" and (constraint is not None or args.decode == "beam"):
+        parser.error("--smoothing can't be combined with --strict constraints or --decode beam")
+
     print("="*50)
     print("MIDI Markov Model Pipeline")
     print("="*50)
 
-    # Setup file locations
-    preprocessed_file = get_preprocessed_path(genres, chord_strategy)
-    model_dir = get_model_dir(genres, chord_strategy, order)
-    sample_dir = get_sample_dir(model_dir)
-
-    required_files = ["pitch.pkl", "duration.pkl"]
-
-    model_exists = all(file_nonempty(os.path.join(model_dir, f)) for f in required_files)
-    preprocess_exists = os.path.exists(preprocessed_file)
-
-    if (not model_exists and not preprocess_exists):
-        subprocess.run([
-            "python3", "src/preprocess.py",
-            "-o", preprocessed_file,
-            "-c", chord_strategy,
-            "-g", *genres
-        ])
-    if (not model_exists):
-        subprocess.run([
-            "python3", "src/markov.py",
-            "-i", preprocessed_file,
-            "-o", model_dir,
-            "-or", order
-        ])
-    
-    for i in range(1, num_samples + 1):
-        if key is None:
-            fname = os.path.join(sample_dir, f"{i}.mid")
-            subprocess.run([
-                "python3", "src/generate.py",
-                "-i", model_dir,
-                "-o", fname,
-                "-or", order,
-                "--bpm", str(bpm),
-                "--length", str(length),
-            ])
-        else:
-            key_dir = os.path.join(sample_dir, key)
-            os.makedirs(key_dir, exist_ok=True)
-            fname = os.path.join(key_dir, f"{i}.mid")
-            subprocess.run([
-                "python3", "src/generate.py",
-                "-i", model_dir,
-                "-o", fname,
-                "-or", order,
-                "--bpm", str(bpm),
-                "--length", str(length),
-                "-k", key,
-            ])
+    graph = make_build_graph(genres, chord_strategy, order, num_samples, bpm, length, key, args.evaluate,
+                             args.seed, args.workers, constraint, args.decode, args.beam_width, args.smoothing,
+                             args.representation, args.quantize, args.min_count, args.sample_cache)
+    if not graph.run(dry_run=args.dry_run):
+        sys.exit(1)
 
     print("\n" + "="*50)
     print("Pipeline complete!")
@@ -1,54 +1,156 @@
 import os
-import pickle
-from parse_midi import parse_midi, REST
+from parse_midi import REST
+from safe_parse import parse_files, Quarantine, summarize, write_report, DEFAULT_TIMEOUT, DEFAULT_MEMORY_MB, QUARANTINE_FILE
+from build_graph import atomic_pickle_dump
+import instrument
+from mood_data_pipeline import manifest_files
+from corpus_index import select_files
+from intervals import to_intervals
+from quantize import Quantization, quantize_corpus, DEFAULT_TUPLETS, DEFAULT_MAX_REST
 import time
 import argparse
 
-def preprocess_midis(input_dirs, output_file=None, chord_strategy='highest'):
+def list_midi_files(input_dir):
+    """Returns the paths of the MIDI files directly inside `input_dir`."""
+    return [os.path.join(input_dir, f) for f in os.listdir(input_dir)
+            if f.lower().endswith('.mid') or f.lower().endswith('.midi')]
+
+PART_ROLES = ['bass', 'harmony', 'inner']
+
+def role_output_path(output_file, role):
+    """Path of the processed data of one part role, next to `output_file` (e.g. processed_jazz_highest_bass.pkl)."""
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}_{role}{ext or '.pkl'}"
+
+def preprocess_midis(input_dirs, output_file=None, chord_strategy='highest', input_files=None, intervals=False,
+                     quantization=None, roles=None, workers=1, timeout=DEFAULT_TIMEOUT, memory_mb=DEFAULT_MEMORY_MB,
+                     quarantine=None, retry_quarantined=False, report_file=None):
     """
     Input:
     `input_dirs`: list of directories containing MIDI files
+    `input_files`: optional dict mapping a label (e.g. an emotion) -> list of MIDI file
+      paths, processed in addition to `input_dirs` (e.g. files selected from a manifest)
     `output_file`: optional path to save preprocessed data as a pickle file
     `chord_strategy`: strategy for handling chords; options are
       'highest' (use highest note), 'root' (use root note), 'skip' (ignore chords)
+    `intervals`: store pitches as intervals from the previous note (see `intervals.py`)
+    `quantization`: optional `quantize.Quantization` to snap durations to a grid and cap their vocabulary
+    `roles`: optional part roles (see `PART_ROLES`) to extract from the same parse as the melody. Each is
+      saved as its own (pitches, durations) pickle (see `role_output_path`), and every tagged part, with
+      its full chords, is saved to the `parts` one
+    `workers`, `timeout`, `memory_mb`: worker processes and per-file limits (see `safe_parse.parse_files`)
+    `quarantine`: optional `safe_parse.Quarantine`; listed files are skipped (unless `retry_quarantined`)
+      and new failures added
+    `report_file`: optional path to save the per-file parse records (status, time) as CSV
 
     Returns:
-        - all_pitches: list of lists of MIDI pitch numbers (integers), with REST (-1) for rests
+        - all_pitches: list of lists of MIDI pitch numbers (integers), with REST (-1) for rests,
+          or of intervals with `intervals`
         - all_durations: list of lists of durations in quarter lengths (floats)
     """
     all_pitches = []
     all_durations = []
+    role_sequences = {role: ([], []) for role in roles or []}
+    all_parts = []
 
-    for input_dir in input_dirs:
-        midi_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.mid') or f.lower().endswith('.midi')]
+    groups = [(input_dir, list_midi_files(input_dir)) for input_dir in input_dirs]
+    if input_files:
+        groups += list(input_files.items())
 
+    records = []
+    for input_dir, midi_files in groups:
         print(f"Found {len(midi_files)} MIDI files in {input_dir}.")
+        if quarantine is not None and not retry_quarantined:
+            skipped = [f for f in midi_files if quarantine.contains(f)]
+            if skipped:
+                print(f"Skipping {len(skipped)} quarantined files.")
+                instrument.count("files_quarantined", len(skipped))
+                skipped = set(skipped)
+                midi_files = [f for f in midi_files if f not in skipped]
 
         successful = 0
         failed = 0
 
-        for i, filename in enumerate(midi_files):
-            filepath = os.path.join(input_dir, filename)
-            pitches, durations = parse_midi(filepath, chord_strategy=chord_strategy)
+        results = [None] * len(midi_files)
+        with instrument.span("parse_midis", files=len(midi_files)):
+            parsed = parse_files(midi_files, chord_strategy, parts=bool(roles), workers=workers,
+                                 timeout=timeout, memory_mb=memory_mb)
+            for done, (index, record, data) in enumerate(parsed, start=1):
+                results[index] = data
+                records.append(record)
+                if quarantine is not None:
+                    quarantine.update(record)
+                if record["status"] == "ok":
+                    successful += 1
+                    instrument.count("files_parsed")
+                    instrument.count("notes_parsed", record["notes"])
+                else:
+                    failed += 1
+                    instrument.count("parse_failures")
+                    reason = f" ({record['status']}: {record['error']})" if record["error"] else " (no notes)"
+                    print(f"Warning: Failed to parse MIDI file {os.path.basename(record['file'])}{reason}.")
+
+                if done % 10 == 0 or done == len(midi_files):
+                    print(f"Processed {done}/{len(midi_files)} files. Successful: {successful}, Failed: {failed}")
+        if quarantine is not None:
+            quarantine.save()
+
+        # In file order, so the output doesn't depend on which worker finished first
+        for filepath, data in zip(midi_files, results):
+            if data is None:
+                continue
+            if roles:
+                parts = data
+                melody = next((p for p in parts if p["role"] == "melody"), None)
+                pitches, durations = (melody["pitches"], melody["durations"]) if melody else ([], [])
+            else:
+                pitches, durations = data
+
+            if roles and len(pitches) > 0:
+                for part in parts:
+                    if part["role"] in role_sequences and len(part["pitches"]) > 0:
+                        role_sequences[part["role"]][0].append(part["pitches"])
+                        role_sequences[part["role"]][1].append(part["durations"])
+                        instrument.count("parts_extracted")
+                    all_parts.append({"file": filepath, **part})
 
             if len(pitches) > 0:
                 all_pitches.append(pitches)
                 all_durations.append(durations)
-                successful += 1
-            else:
-                failed += 1
-                print(f"Warning: Failed to parse MIDI file {filename}.")
-
-            if (i + 1) % 10 == 0 or (i + 1) == len(midi_files):
-                print(f"Processed {i + 1}/{len(midi_files)} files. Successful: {successful}, Failed: {failed}")
 
     print(f"Finished processing. Total successful: {successful}, Total failed: {failed}")
+    if records:
+        summarize(records)
+    if report_file:
+        write_report(records, report_file)
+        print(f"Saved parse report to {report_file}.")
+
+    def finish(pitches, durations):
+        if quantization is not None:
+            with instrument.span("quantize_durations"):
+                durations = quantize_corpus(pitches, durations, quantization)
+        if intervals:
+            pitches = [to_intervals(p) for p in pitches]
+        return pitches, durations
+
+    all_pitches, all_durations = finish(all_pitches, all_durations)
 
     if output_file:
-        with open(output_file, 'wb') as f:
-            pickle.dump((all_pitches, all_durations), f)
+        with instrument.span("save_pickle"):
+            atomic_pickle_dump((all_pitches, all_durations), output_file)
         print(f"Preprocessed data saved to {output_file}.")
-        
+
+        for role, (pitches, durations) in role_sequences.items():
+            role_file = role_output_path(output_file, role)
+            with instrument.span("save_pickle", file=role_file):
+                atomic_pickle_dump(finish(pitches, durations), role_file)
+            print(f"Saved {len(pitches)} {role} parts to {role_file}.")
+        if roles:
+            parts_file = role_output_path(output_file, "parts")
+            with instrument.span("save_pickle", file=parts_file):
+                atomic_pickle_dump(all_parts, parts_file)
+            print(f"Saved {len(all_parts)} tagged parts to {parts_file}.")
+
     return all_pitches, all_durations
 
 def main():
@@ -76,9 +178,142 @@ def main():
         help="How to reduce chords to a single pitch."
     )
 
+    parser.add_argument(
+        "--manifest", "-m",
+        default=None,
+        help="Manifest from `mood_data_pipeline.py --index`. Emotions without a data/raw folder are read from it."
+    )
+
+    parser.add_argument(
+        "--index-db",
+        default=None,
+        help="Corpus index from `corpus_index.py build`. Selects files from it instead of listing folders, skipping files that failed to parse."
+    )
+
+    parser.add_argument(
+        "--min-notes",
+        type=int,
+        default=None,
+        help="With --index-db, only use files with at least this many melody notes."
+    )
+
+    parser.add_argument(
+        "--xmidi-genre",
+        default=None,
+        help="With --index-db, only use XMIDI files of this genre (e.g. jazz)."
+    )
+
+    parser.add_argument(
+        "--intervals",
+        action="store_true",
+        help="Store pitches as intervals from the previous note, so models don't depend on the key."
+    )
+
+    parser.add_argument(
+        "--quantize",
+        type=float,
+        default=None,
+        metavar="GRID",
+        help="Snap durations to multiples of GRID quarter notes (e.g. 0.25 for sixteenths), and to tuplets of it."
+    )
+
+    parser.add_argument(
+        "--tuplets",
+        type=int,
+        nargs="*",
+        default=list(DEFAULT_TUPLETS),
+        help="Tuplets allowed with --quantize, e.g. 3 for triplets. Default 3; pass none for a straight grid."
+    )
+
+    parser.add_argument(
+        "--max-rest",
+        type=float,
+        default=DEFAULT_MAX_REST,
+        help=f"With --quantize, cap rests to this many quarter notes. Default {DEFAULT_MAX_REST}"
+    )
+
+    parser.add_argument(
+        "--max-duration-vocab",
+        type=int,
+        default=None,
+        help="Keep only the N most frequent durations; others become the nearest kept duration."
+    )
+
+    parser.add_argument(
+        "--min-duration-count",
+        type=int,
+        default=1,
+        help="Replace durations seen fewer than N times by the nearest more frequent duration."
+    )
+
+    parser.add_argument(
+        "--roles",
+        nargs="+",
+        choices=PART_ROLES,
+        default=None,
+        help="Also extract these parts (from the same parse) into [OUTPUT_NAME]_[ROLE].pkl, and every tagged part into [OUTPUT_NAME]_parts.pkl."
+    )
+
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=1,
+        help="Worker processes for parsing. Default 1"
+    )
+
+    parser.add_argument(
+        "--parse-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"Seconds a file may take to parse before its worker is killed. Default {DEFAULT_TIMEOUT:g}; 0 for no limit"
+    )
+
+    parser.add_argument(
+        "--parse-memory-mb",
+        type=int,
+        default=DEFAULT_MEMORY_MB,
+        help=f"Memory limit of each parsing worker in MB. Default {DEFAULT_MEMORY_MB}; 0 for no limit"
+    )
+
+    parser.add_argument(
+        "--quarantine",
+        default=QUARANTINE_FILE,
+        help=f"Files that failed to parse are listed here and skipped by later runs until they change. Default {QUARANTINE_FILE}"
+    )
+
+    parser.add_argument(
+        "--retry-quarantined",
+        action="store_true",
+        help="Parse quarantined files again (still updating the quarantine list)."
+    )
+
+    parser.add_argument(
+        "--parse-report",
+        default=None,
+        help="Save each file's parse status, error and time as CSV, slowest first."
+    )
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.configure(args.trace, "preprocess")
     
-    input_dirs = [f"data/raw/{genre}" for genre in args.genres]
+    input_dirs = []
+    input_files = {}
+    for genre in args.genres:
+        genre_dir = f"data/raw/{genre}"
+        if args.index_db:
+            input_files[f"{args.index_db} ({genre})"] = select_files(
+                args.index_db, group=genre, genre=args.xmidi_genre, min_notes=args.min_notes)
+        elif args.manifest and not os.path.isdir(genre_dir):
+            input_files[f"{args.manifest} ({genre})"] = manifest_files(args.manifest, [genre])
+        else:
+            input_dirs.append(genre_dir)
+
+    quantization = None
+    if args.quantize is not None or args.max_duration_vocab is not None or args.min_duration_count > 1:
+        quantization = Quantization(args.quantize, tuple(args.tuplets), args.max_rest,
+                                    args.max_duration_vocab, args.min_duration_count)
 
     print("="*50)
     print("Preprocessing MIDI files...")
@@ -86,11 +321,22 @@ def main():
 
     start_time = time.time()
 
-    preprocess_midis(
-        input_dirs = input_dirs,
-        output_file = args.output_name,
-        chord_strategy = args.chord_strategy
-    )
+    with instrument.stage("preprocess", args.profile):
+        preprocess_midis(
+            input_dirs = input_dirs,
+            output_file = args.output_name,
+            chord_strategy = args.chord_strategy,
+            input_files = input_files,
+            intervals = args.intervals,
+            quantization = quantization,
+            roles = args.roles,
+            workers = args.workers,
+            timeout = args.parse_timeout or None,
+            memory_mb = args.parse_memory_mb or None,
+            quarantine = Quarantine(args.quarantine),
+            retry_quarantined = args.retry_quarantined,
+            report_file = args.parse_report
+        )
 
     end_time = time.time()
     print("="*50)
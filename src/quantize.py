@@ -0,0 +1,95 @@
+"""Duration quantization and vocabulary capping.
+
+`parse_midi` keeps raw music21 quarter lengths, including rests computed as
+gaps between note offsets, so duration models see many near-duplicate
+float/Fraction states. Here durations are snapped to a rhythmic grid before
+training:
+
+  - straight grid: multiples of `grid` quarter lengths (0.25 = sixteenths)
+  - tuplets: for each n in `tuplets`, multiples of `grid * 2 / n` too
+    (n=3 gives triplets), used when closer than the straight grid
+  - rests longer than `max_rest` are capped to it
+  - nothing is quantized to zero; the shortest value is one step of the
+    finest grid
+
+`cap_vocabulary` then maps rare values to the nearest frequent one, so the
+duration vocabulary has at most `max_size` values each seen at least
+`min_count` times.
+"""
+
+from collections import Counter, namedtuple
+from fractions import Fraction
+
+from music21.common.numberTools import opFrac
+
+REST = -1
+
+DEFAULT_GRID = 0.25
+DEFAULT_TUPLETS = (3,)
+DEFAULT_MAX_REST = 4.0
+
+# Settings for `quantize_corpus`; grid None leaves durations as parsed
+Quantization = namedtuple("Quantization", ["grid", "tuplets", "max_rest", "max_vocab", "min_count"])
+Quantization.__new__.__defaults__ = (DEFAULT_GRID, DEFAULT_TUPLETS, DEFAULT_MAX_REST, None, 1)
+
+
+def quantize_duration(duration, grid=DEFAULT_GRID, tuplets=DEFAULT_TUPLETS, max_rest=None, is_rest=False):
+    """
+    The grid value nearest to `duration` (quarter lengths), as music21 represents
+    quarter lengths: a float when exact, else a Fraction. Rests are capped to `max_rest`.
+    """
+    duration = Fraction(duration).limit_denominator(10000)
+    if is_rest and max_rest is not None:
+        duration = min(duration, Fraction(max_rest))
+
+    grid = Fraction(grid).limit_denominator(10000)
+    units = [grid] + [grid * 2 / n for n in tuplets]
+    best = None
+    for unit in units:
+        candidate = max(round(duration / unit), 1) * unit
+        # Ties go to the straight grid, which comes first
+        if best is None or abs(candidate - duration) < abs(best - duration):
+            best = candidate
+    return opFrac(best)
+
+
+def quantize_sequence(pitches, durations, grid=DEFAULT_GRID, tuplets=DEFAULT_TUPLETS, max_rest=DEFAULT_MAX_REST):
+    """Quantized copy of `durations`; rests (REST in `pitches`) are capped to `max_rest`."""
+    return [quantize_duration(d, grid, tuplets, max_rest, p == REST) for p, d in zip(pitches, durations)]
+
+
+def cap_vocabulary(sequences, max_size=None, min_count=1):
+    """
+    Input:
+    `sequences`: list of sequences of numeric values (e.g. durations)
+    `max_size`: keep at most this many of the most frequent values
+    `min_count`: keep only values seen at least this many times
+
+    Returns:
+        (sequences with every dropped value replaced by the nearest kept value, {dropped: kept})
+    """
+    counts = Counter(v for seq in sequences for v in seq)
+    ranked = [v for v, c in counts.most_common() if c >= min_count]
+    kept = set(ranked[:max_size] if max_size is not None else ranked)
+    if not kept or len(kept) == len(counts):
+        return sequences, {}
+
+    kept_sorted = sorted(kept, key=float)
+    mapping = {v: min(kept_sorted, key=lambda k: (abs(float(k) - float(v)), float(k)))
+               for v in counts if v not in kept}
+    return [[mapping.get(v, v) for v in seq] for seq in sequences], mapping
+
+
+def quantize_corpus(all_pitches, all_durations, quantization: Quantization):
+    """
+    Quantize every duration sequence of a corpus and cap its vocabulary.
+    Prints the duration vocabulary size before and after. Returns the new duration sequences.
+    """
+    before = len({v for seq in all_durations for v in seq})
+    if quantization.grid is not None:
+        all_durations = [quantize_sequence(p, d, quantization.grid, quantization.tuplets, quantization.max_rest)
+                         for p, d in zip(all_pitches, all_durations)]
+    all_durations, _ = cap_vocabulary(all_durations, quantization.max_vocab, quantization.min_count)
+    after = len({v for seq in all_durations for v in seq})
+    print(f"Duration vocabulary: {before} values before quantization, {after} after.")
+    return all_durations
@@ -0,0 +1,248 @@
+"""Parse MIDI files in worker processes with per-file time and memory limits.
+
+music21 can spend minutes (or all memory) on one pathological file, and
+`parse_midi` returns empty sequences for every kind of failure. Here each
+file is parsed in a worker process:
+
+  - the worker's address space is capped at `memory_mb` (where the
+    `resource` module exists), so a runaway parse raises MemoryError
+  - a worker still busy after `timeout` seconds is killed and replaced
+
+and every file gets a record `{file, status, error, seconds, notes}` with
+status `ok`, `empty` (parsed, but no notes), `error` (an exception, as in
+`corpus_index.py`), `memory`, `timeout` or `crashed` (the worker died).
+
+Failed files are added to a quarantine list (`data/processed/quarantine.json`
+by default), which later runs skip until the file changes. Saving merges this
+run's changes into the file under a lock, so preprocessing jobs running at
+once (e.g. in `sweep.py`) don't drop each other's entries.
+"""
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from multiprocessing.connection import wait
+
+from build_graph import atomic_write_bytes
+from parse_midi import parse_midi, parse_midi_parts
+import instrument
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MEMORY_MB = 2048
+QUARANTINE_FILE = "data/processed/quarantine.json"
+# Statuses that put a file in quarantine; empty files parse quickly and are just skipped
+FAILURES = {"error", "memory", "timeout", "crashed"}
+REPORT_COLUMNS = ["file", "status", "error", "seconds", "notes"]
+
+
+def note_count(data, parts=False):
+    """Melody notes and rests in the output of `parse_midi` (or `parse_midi_parts` with `parts`)."""
+    if parts:
+        return next((len(p["pitches"]) for p in data if p["role"] == "melody"), 0)
+    return len(data[0])
+
+
+def _worker(conn, chord_strategy, parts, memory_mb):
+    """Parse (index, path) tasks from `conn` until it sends None, answering (index, record, data)."""
+    if memory_mb and resource is not None:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    parse = parse_midi_parts if parts else parse_midi
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        index, path = task
+        record = {"status": "ok", "error": None, "notes": 0}
+        data = None
+        start_time = time.perf_counter()
+        try:
+            data = parse(path, chord_strategy, raise_errors=True)
+            record["notes"] = note_count(data, parts)
+            if record["notes"] == 0:
+                record["status"] = "empty"
+        except MemoryError:
+            data = None
+            record.update(status="memory", error=f"MemoryError: over {memory_mb} MB")
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        record["seconds"] = time.perf_counter() - start_time
+        conn.send((index, record, data))
+
+
+def parse_files(paths, chord_strategy='highest', parts=False, workers=1, timeout=DEFAULT_TIMEOUT,
+                memory_mb=DEFAULT_MEMORY_MB):
+    """
+    Input:
+    `paths`: MIDI files to parse
+    `chord_strategy`: as in `parse_midi`
+    `parts`: parse with `parse_midi_parts` instead of `parse_midi`
+    `workers`: worker processes
+    `timeout`: seconds after which a file's worker is killed (None for no limit)
+    `memory_mb`: address space limit of each worker (None for no limit)
+
+    Yields:
+        (index in `paths`, record, parsed data or None), in the order files finish.
+    """
+    ctx = multiprocessing.get_context()
+
+    def spawn():
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=_worker, args=(child_conn, chord_strategy, parts, memory_mb), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    pending = deque(enumerate(paths))
+    idle = [spawn() for _ in range(min(max(workers, 1), len(paths)))]
+    busy = {}  # conn -> (process, index, path, start time)
+
+    def replace(conn, process):
+        process.kill()
+        process.join()
+        conn.close()
+        idle.append(spawn())
+
+    try:
+        while pending or busy:
+            while idle and pending:
+                process, conn = idle.pop()
+                index, path = pending.popleft()
+                conn.send((index, path))
+                busy[conn] = (process, index, path, time.perf_counter())
+
+            wait_seconds = None
+            if timeout is not None:
+                wait_seconds = max(min(start for _, _, _, start in busy.values()) + timeout - time.perf_counter(), 0)
+            for conn in wait(list(busy), wait_seconds):
+                process, index, path, start = busy.pop(conn)
+                try:
+                    _, record, data = conn.recv()
+                    idle.append((process, conn))
+                except (EOFError, OSError):
+                    process.join()
+                    record = {"status": "crashed", "error": f"Worker exited with code {process.exitcode}",
+                              "seconds": time.perf_counter() - start, "notes": 0}
+                    data = None
+                    replace(conn, process)
+                yield index, {"file": path, **record}, data
+
+            if timeout is not None:
+                now = time.perf_counter()
+                for conn, (process, index, path, start) in list(busy.items()):
+                    if now - start > timeout:
+                        del busy[conn]
+                        replace(conn, process)
+                        instrument.count("parse_timeouts")
+                        yield index, {"file": path, "status": "timeout", "error": f"Over {timeout:g} seconds",
+                                      "seconds": now - start, "notes": 0}, None
+    finally:
+        for process, conn in idle + [(p, c) for c, (p, _, _, _) in busy.items()]:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            conn.close()
+
+
+class Quarantine:
+    """
+    Files that failed to parse, with the size and mtime they had then.
+    A file is skipped while it is listed with an unchanged size and mtime.
+    """
+    def __init__(self, path=QUARANTINE_FILE):
+        self.path = path
+        self.entries = self._read()
+        # path -> new entry, or None for a dropped one; merged into the file by `save`
+        self.changes = {}
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def contains(self, path):
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+
+    def update(self, record):
+        """Add a failed file, or drop a file that now parses."""
+        path = record["file"]
+        if record["status"] in FAILURES:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # e.g. a stale manifest entry; nothing to skip next time
+                if self.entries.pop(path, None) is not None:
+                    self.changes[path] = None
+                return
+            self.entries[path] = self.changes[path] = {
+                "size": st.st_size, "mtime_ns": st.st_mtime_ns, "status": record["status"],
+                "error": record["error"], "seconds": round(record["seconds"], 3)}
+        elif self.entries.pop(path, None) is not None:
+            self.changes[path] = None
+
+    def save(self):
+        """Merge this run's changes into the file, holding a lock against other runs saving at once."""
+        if not self.changes:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            for path, entry in self.changes.items():
+                if entry is None:
+                    entries.pop(path, None)
+                else:
+                    entries[path] = entry
+            atomic_write_bytes(self.path, json.dumps(entries, indent=1).encode())
+        self.entries = entries
+        self.changes = {}
+
+
+def summarize(records, slowest=5):
+    """Print file counts per status and the slowest files."""
+    counts = Counter(r["status"] for r in records)
+    print("Parse results: " + ", ".join(f"{status} {n}" for status, n in sorted(counts.items())))
+    for r in sorted(records, key=lambda r: r["seconds"], reverse=True)[:slowest]:
+        print(f"  {r['seconds']:8.2f} s  {r['status']:8} {r['file']}")
+
+
+def write_report(records, path):
+    """Save the per-file records as CSV, slowest first."""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=REPORT_COLUMNS)
+    writer.writeheader()
+    for r in sorted(records, key=lambda r: r["seconds"], reverse=True):
+        writer.writerow({**r, "seconds": round(r["seconds"], 4)})
+    atomic_write_bytes(path, out.getvalue().encode())
@@ -0,0 +1,87 @@
+"""Content-addressed cache of generated MIDI samples.
+
+Seeded generation is deterministic, so a sample is fully described by the
+model it was drawn from, the generation settings, its seed and the code that
+generated it. `generate.py --cache-dir DIR` stores every seeded sample as
+`DIR/<key>.mid`, where the key is a fingerprint of all four, and returns
+stored bytes for repeat requests instead of generating them again.
+
+The model is fingerprinted by the contents of its files (hashes are reused
+while a file's size and mtime are unchanged, like raw MIDI files in
+`build_graph.py`), so retraining a model gives its samples new keys and the
+old entries are never hit again. They are evicted like any other entry: when
+the cache grows past its size cap, the least recently used files go first
+(a hit refreshes an entry's mtime).
+"""
+
+import os
+
+from build_graph import HashCache, atomic_write_bytes, hash_source, hash_values
+import instrument
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+HASHES_FILE = ".model_hashes.json"
+# Source files whose changes can change generated samples
+GENERATION_CODE = ["generate.py", "constrained.py", "beam.py", "backoff.py", "intervals.py", "coded_model.py"]
+
+
+class SampleCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.hash_cache = HashCache(os.path.join(directory, HASHES_FILE))
+
+    def model_fingerprint(self, model_dir, files):
+        """Fingerprint of the contents of `files` in `model_dir`."""
+        digest = hash_values(sorted((f, self.hash_cache.hash(os.path.join(model_dir, f))) for f in files))
+        self.hash_cache.save()
+        return digest
+
+    def keys(self, fingerprint, params, seeds):
+        """One key per seed, for samples of the model `fingerprint` generated with `params`."""
+        code = hash_source(*GENERATION_CODE)
+        return [hash_values(fingerprint, code, params, seed) for seed in seeds]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".mid")
+
+    def get(self, key):
+        """The stored MIDI bytes for `key`, or None."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            instrument.count("sample_cache_misses")
+            return None
+        instrument.count("sample_cache_hits")
+        return data
+
+    def put(self, key, data):
+        atomic_write_bytes(self.path(key), data)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`. Returns how many were removed."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".mid") and not entry.name.startswith("."):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        instrument.count("sample_cache_evictions", removed)
+        return removed
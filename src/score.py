@@ -0,0 +1,301 @@
+"""Likelihood and perplexity of melodies under trained models.
+
+Scores many pitch/duration sequences at once against one or more
+`models/<name>` directories. Sequences come from preprocessed pickles
+(`data/processed/*.pkl`) or directories of MIDI files (e.g. generated
+samples), e.g.:
+
+    python3 src/score.py -m models/jazz_highest_second -i data/processed/jazz_highest.pkl
+    python3 src/score.py -m models/jazz_highest_second models/classical_highest_second \\
+        -i data/raw/jazz data/raw/classical -o evaluation/scores.csv
+
+A sequence's log-likelihood is log P(start) + sum of log P(next | context)
+for its pitches plus the same for its durations, and its perplexity is
+exp(-log-likelihood / (2 * notes)), i.e. per pitch or duration token. Values
+or transitions the model has never seen get probability `min_prob`, and are
+counted as `unseen`. With `--smoothing`, the models' Witten-Bell backoff
+tables (see `backoff.py`) are used instead, so only values outside the
+vocabulary are unseen. With several models, each sequence is also classified
+as the model that gives it the highest likelihood.
+
+All lookups are vectorized: the sequences are concatenated into one array,
+mapped to state indices of the integer-coded model (see `coded_model.py`)
+with `np.searchsorted`, and every transition is found in the sorted CSR
+edge keys at once.
+"""
+
+import argparse
+import csv
+import io
+import math
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from coded_model import coded
+from build_graph import atomic_write_bytes
+from backoff import BackoffModel
+
+DEFAULT_MIN_PROB = 1e-6
+
+
+def model_order(transitions, start_dist):
+    """`second` if the model's states are pairs, else `first`."""
+    states = next(iter(start_dist or transitions), None)
+    return 'second' if isinstance(states, tuple) else 'first'
+
+
+class SequenceScorer:
+    """Vectorized scoring of sequences under one pitch or duration model."""
+
+    def __init__(self, transitions, start_dist, order=None):
+        self.order = order or model_order(transitions, start_dist)
+        self.model = coded(transitions, start_dist, self.order)
+
+        # Value codes: index of each value in the sorted vocabulary
+        values = sorted({float(v) for v in self.model.values} | {float(s[0]) for s in self.model.states
+                                                                   if isinstance(s, tuple)})
+        self.vocab = np.array(values)
+        value_codes = {v: i for i, v in enumerate(values)}
+
+        # Code of each state (a pair of value codes for second order); sorted like the states
+        if self.order == 'second':
+            self.state_codes = np.array([value_codes[float(a)] * len(values) + value_codes[float(b)]
+                                         for a, b in self.model.states], dtype=np.int64)
+        else:
+            self.state_codes = np.array([value_codes[float(s)] for s in self.model.states], dtype=np.int64)
+
+        num_states = self.model.num_states
+        self.edge_keys = self.model.rows * num_states + self.model.indices
+        with np.errstate(divide='ignore'):
+            self.log_start = np.log(self.model.start)
+
+    def encode(self, values):
+        """Value codes of a float array; -1 for values outside the vocabulary."""
+        pos = np.searchsorted(self.vocab, values)
+        pos = np.minimum(pos, len(self.vocab) - 1)
+        return np.where(self.vocab[pos] == values, pos, -1)
+
+    def lookup_states(self, codes):
+        """State indices of state codes; -1 where the state doesn't exist."""
+        pos = np.searchsorted(self.state_codes, codes)
+        pos = np.minimum(pos, len(self.state_codes) - 1)
+        return np.where((codes >= 0) & (self.state_codes[pos] == codes), pos, -1)
+
+    def score(self, sequences, min_prob=DEFAULT_MIN_PROB):
+        """
+        Input:
+        `sequences`: list of sequences of values (pitches or durations)
+        `min_prob`: probability given to unseen values and transitions
+
+        Returns:
+            (log_likelihood, unseen): arrays with one entry per sequence. Sequences
+            shorter than the model order get NaN.
+        """
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        num_sequences = len(sequences)
+        flat = np.fromiter((float(v) for seq in sequences for v in seq), dtype=float, count=int(lengths.sum()))
+        seq_ids = np.repeat(np.arange(num_sequences), lengths)
+        offsets = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        codes = self.encode(flat)
+        if self.order == 'second':
+            # The state at position i is the pair (value i-1, value i)
+            pair_codes = np.full(len(flat), -1, dtype=np.int64)
+            prev, cur = codes[:-1], codes[1:]
+            pair_codes[1:] = np.where((prev >= 0) & (cur >= 0), prev * len(self.vocab) + cur, -1)
+            states = self.lookup_states(pair_codes)
+            first = 1
+        else:
+            states = self.lookup_states(codes)
+            first = 0
+        states[offsets < first] = -1
+
+        log_min = math.log(min_prob)
+
+        # Start term, at the first complete state of each sequence
+        start_pos = np.flatnonzero(offsets == first)
+        start_states = states[start_pos]
+        start_lp = np.where(start_states >= 0, self.log_start[np.maximum(start_states, 0)], -np.inf)
+        start_unseen = ~np.isfinite(start_lp)
+        start_lp[start_unseen] = log_min
+
+        # Transition terms, from each state to the next one in the same sequence
+        src_pos = np.flatnonzero((offsets >= first) & (offsets < np.repeat(lengths, lengths) - 1))
+        src, dst = states[src_pos], states[src_pos + 1]
+        keys = src * self.model.num_states + dst
+        edge = np.minimum(np.searchsorted(self.edge_keys, keys), len(self.edge_keys) - 1)
+        found = (src >= 0) & (dst >= 0) & (self.edge_keys[edge] == keys)
+        step_lp = np.where(found, self.model.log_probs[edge], log_min)
+
+        log_likelihood = (np.bincount(seq_ids[start_pos], weights=start_lp, minlength=num_sequences)
+                          + np.bincount(seq_ids[src_pos], weights=step_lp, minlength=num_sequences))
+        unseen = (np.bincount(seq_ids[start_pos], weights=start_unseen, minlength=num_sequences)
+                  + np.bincount(seq_ids[src_pos], weights=~found, minlength=num_sequences)).astype(np.int64)
+        log_likelihood[lengths <= first] = np.nan
+        return log_likelihood, unseen
+
+
+def load_model(model_dir):
+    """
+    Returns {'pitch': (transitions, start_dist), 'duration': (...)} of a model directory,
+    plus 'pitch_backoff' and 'duration_backoff' BackoffModels if it has smoothed tables.
+    """
+    model = {}
+    for part in ['pitch', 'duration']:
+        with open(os.path.join(model_dir, f"{part}.pkl"), 'rb') as f:
+            model[part] = pickle.load(f)
+        backoff_path = os.path.join(model_dir, f"{part}_backoff.pkl")
+        if os.path.exists(backoff_path):
+            model[f"{part}_backoff"] = BackoffModel.load(backoff_path)
+    return model
+
+
+def load_sequences(path, chord_strategy='highest', workers=1):
+    """
+    Input:
+    `path`: a preprocessed pickle, or a directory of MIDI files
+    `chord_strategy`: as in `parse_midi`, for MIDI directories
+    `workers`: processes for parsing MIDI files
+
+    Returns:
+        (names, pitches, durations), skipping files that failed to parse.
+    """
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            pitches, durations = pickle.load(f)
+        return [f"{path}[{i}]" for i in range(len(pitches))], pitches, durations
+
+    from parse_midi import parse_midi
+    from preprocess import list_midi_files
+    files = sorted(list_midi_files(path))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = list(pool.map(parse_midi, files, [chord_strategy] * len(files), chunksize=16))
+    kept = [(f, p, d) for f, (p, d) in zip(files, parsed) if len(p) > 0]
+    if len(kept) < len(files):
+        print(f"Warning: {len(files) - len(kept)} files in {path} failed to parse.")
+    return [k[0] for k in kept], [k[1] for k in kept], [k[2] for k in kept]
+
+
+def score_corpus(pitches, durations, model, min_prob=DEFAULT_MIN_PROB, smoothed=False):
+    """
+    Score pitch and duration sequences under a model from `load_model`, or
+    under its smoothed backoff tables if `smoothed`.
+
+    Returns:
+        dict of per-sequence arrays: log_likelihood (pitch + duration), pitch_log_likelihood,
+        duration_log_likelihood, tokens (pitches + durations) and unseen.
+    """
+    if smoothed:
+        pitch_ll, pitch_unseen = model['pitch_backoff'].score(pitches, min_prob)
+        duration_ll, duration_unseen = model['duration_backoff'].score(durations, min_prob)
+    else:
+        pitch_ll, pitch_unseen = SequenceScorer(*model['pitch']).score(pitches, min_prob)
+        duration_ll, duration_unseen = SequenceScorer(*model['duration']).score(durations, min_prob)
+    return {
+        "log_likelihood": pitch_ll + duration_ll,
+        "pitch_log_likelihood": pitch_ll,
+        "duration_log_likelihood": duration_ll,
+        "tokens": np.array([len(p) + len(d) for p, d in zip(pitches, durations)], dtype=np.int64),
+        "unseen": pitch_unseen + duration_unseen,
+    }
+
+
+def perplexity(log_likelihood, tokens):
+    """Perplexity per token of one or many sequences together (NaN entries are ignored)."""
+    ok = ~np.isnan(log_likelihood)
+    return float(np.exp(-log_likelihood[ok].sum() / tokens[ok].sum())) if ok.any() else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score melodies by their likelihood under trained models")
+    parser.add_argument("--models", "-m", nargs="+", required=True,
+                        help="Model directories, e.g. models/jazz_highest_second")
+    parser.add_argument("--inputs", "-i", nargs="+", required=True,
+                        help="Preprocessed pickles or directories of MIDI files to score")
+    parser.add_argument("--output", "-o", default=None,
+                        help="Path to save per-sequence scores as CSV")
+    parser.add_argument("--chord-strategy", "-c", choices=["highest", "root", "skip"], default="highest",
+                        help="How to reduce chords to a single pitch when parsing MIDI files")
+    parser.add_argument("--min-prob", type=float, default=DEFAULT_MIN_PROB,
+                        help=f"Probability of unseen values and transitions. Default {DEFAULT_MIN_PROB}")
+    parser.add_argument("--workers", "-w", type=int, default=None,
+                        help="Worker processes for parsing MIDI files. Default: all CPUs")
+    parser.add_argument("--smoothing", "-s", action="store_true",
+                        help="Score with the models' Witten-Bell backoff tables (`markov.py --smoothing`), "
+                             "and print the unsmoothed perplexity next to it")
+    args = parser.parse_args()
+
+    try:
+        models = {os.path.basename(os.path.normpath(m)): load_model(m) for m in args.models}
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.smoothing:
+        missing = [name for name, model in models.items() if 'pitch_backoff' not in model]
+        if missing:
+            print(f"Error: no backoff tables for {', '.join(missing)}. Train with `markov.py --smoothing witten-bell`.")
+            sys.exit(1)
+
+    rows = []
+    print("="*50)
+    for path in args.inputs:
+        start_time = time.time()
+        names, pitches, durations = load_sequences(path, args.chord_strategy, args.workers)
+        load_seconds = time.time() - start_time
+
+        start_time = time.time()
+        scores = {name: score_corpus(pitches, durations, model, args.min_prob, args.smoothing)
+                  for name, model in models.items()}
+        score_seconds = time.time() - start_time
+        print(f"\n{path}: {len(names)} sequences (loaded in {load_seconds:.2f}s, scored in {score_seconds:.2f}s)")
+
+        for name, s in scores.items():
+            unseen_rate = s["unseen"].sum() / max(s["tokens"].sum(), 1)
+            line = f"  {name:<40} perplexity {perplexity(s['log_likelihood'], s['tokens']):10.3f}  unseen {unseen_rate:.2%}"
+            if args.smoothing:
+                raw = score_corpus(pitches, durations, models[name], args.min_prob)
+                line += f"  (unsmoothed {perplexity(raw['log_likelihood'], raw['tokens']):.3f})"
+            print(line)
+
+        # Classify each sequence as the model with the highest likelihood
+        table = np.vstack([s["log_likelihood"] for s in scores.values()])
+        best = np.argmax(np.nan_to_num(table, nan=-np.inf), axis=0)
+        if len(models) > 1:
+            counts = np.bincount(best, minlength=len(models))
+            print("  Classified as: " + ", ".join(f"{name} {c / len(names):.1%}"
+                                                  for name, c in zip(models, counts)))
+
+        model_names = list(models)
+        for i, seq_name in enumerate(names):
+            for name, s in scores.items():
+                ll = s["log_likelihood"][i]
+                rows.append({
+                    "input": path,
+                    "sequence": seq_name,
+                    "model": name,
+                    "tokens": int(s["tokens"][i]),
+                    "log_likelihood": ll,
+                    "pitch_log_likelihood": s["pitch_log_likelihood"][i],
+                    "duration_log_likelihood": s["duration_log_likelihood"][i],
+                    "perplexity": math.exp(-ll / s["tokens"][i]) if not math.isnan(ll) else float('nan'),
+                    "unseen": int(s["unseen"][i]),
+                    "best_model": model_names[best[i]],
+                })
+    print("="*50)
+
+    if args.output and rows:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        atomic_write_bytes(args.output, buffer.getvalue().encode())
+        print(f"Saved scores to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Train, generate and evaluate over a grid of configurations.
+
+The grid is a JSON file whose values are lists of options, e.g.:
+
+    {
+        "genres": [["jazz"], ["classical"], ["classical", "jazz"]],
+        "chord_strategy": ["highest", "root"],
+        "representation": ["absolute", "interval"],
+        "order": ["first", "second"],
+        "key": [null, "C_major"],
+        "bpm": [90, 120],
+        "length": [30],
+        "num_samples": [5],
+        "seed": [0],
+        "decode": ["sample", "beam"]
+    }
+
+Every combination becomes one configuration, except those `generate.py`
+can't run (interval models with beam decoding), which are skipped. Preprocessing and training are
+shared between configurations that need the same processed data or model, and
+reuse anything already built by earlier runs (see `build_graph.py`). Jobs run
+on a worker pool as soon as the jobs they depend on have finished.
+
+Usage (from repository root):
+    python3 src/sweep.py -c sweep.json -n my_sweep -w 4
+
+Results are written to `evaluation/sweeps/<name>/results.csv`, one row per
+configuration with its metrics and per-stage timings.
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from build_graph import BuildGraph, HashCache, atomic_write_bytes
+from pipeline import join_genres, representation_suffix, add_preprocess_step, add_train_step, add_generate_step, add_evaluate_step
+
+GRID_DEFAULTS = {
+    "genres": [["classical", "jazz", "nes", "pop"]],
+    "chord_strategy": ["highest"],
+    "representation": ["absolute"],
+    "order": ["second"],
+    "key": [None],
+    "bpm": [120],
+    "length": [30],
+    "num_samples": [1],
+    "seed": [None],
+    "decode": ["sample"],
+}
+
+METRICS = ['avg_interval', 'pitch_range', 'repeat_rate', 'bigram_diversity',
+           'max_interval', 'avg_duration', 'duration_variety', 'files_analyzed', 'log_prob_per_note']
+
+
+def expand_grid(grid: dict):
+    """
+    Input:
+    `grid`: dict mapping option name -> list of values (missing options use GRID_DEFAULTS).
+
+    Returns:
+        list of dicts, one per supported combination of options, each with a `config_id`.
+    """
+    unknown = set(grid) - set(GRID_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown sweep options: {sorted(unknown)}")
+
+    options = {name: grid.get(name, default) for name, default in GRID_DEFAULTS.items()}
+    for name, values in options.items():
+        if not isinstance(values, list):
+            options[name] = [values]
+    # A genre entry may be a single genre name instead of a list of genres
+    options["genres"] = [sorted([g] if isinstance(g, str) else g) for g in options["genres"]]
+
+    names = list(options)
+    configs = []
+    skipped = 0
+    for values in itertools.product(*(options[name] for name in names)):
+        config = dict(zip(names, values))
+        if config["representation"] == "interval" and config["decode"] == "beam":
+            skipped += 1
+            continue
+        config["config_id"] = config_id(config)
+        configs.append(config)
+    if skipped:
+        print(f"Skipped {skipped} combination(s): interval models can't be decoded with beam search")
+    return configs
+
+
+def config_id(config):
+    """A readable, unique name for a configuration, used for its output directories."""
+    parts = [join_genres(config["genres"]), config["chord_strategy"] + representation_suffix(config["representation"]),
+             config["order"],
+             config["key"] or "anykey", f"{config['bpm']}bpm", f"{config['length']}s",
+             f"{config['num_samples']}n"]
+    if config["seed"] is not None:
+        parts.append(f"seed{config['seed']}")
+    if config["decode"] != "sample":
+        parts.append(config["decode"])
+    return "_".join(str(p) for p in parts)
+
+
+def timed(fn):
+    """Run `fn`, returning whether it succeeded and how long it took."""
+    start_time = time.time()
+    try:
+        ok = bool(fn())
+        error = ""
+    except Exception as e:
+        ok = False
+        error = str(e)
+    return {"ok": ok, "seconds": time.time() - start_time, "error": error}
+
+
+def run_jobs(jobs: dict, workers: int):
+    """
+    Input:
+    `jobs`: dict job_id -> (list of job_ids it depends on, function returning True on success)
+    `workers`: size of the worker pool
+
+    Returns:
+        dict job_id -> {"ok", "seconds", "error"}. Jobs whose dependencies failed
+        are not run and are reported as failed.
+    """
+    results = {}
+    remaining = dict(jobs)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while remaining or running:
+            for job_id in list(remaining):
+                deps, fn = remaining[job_id]
+                if not all(d in results for d in deps):
+                    continue
+                del remaining[job_id]
+                if all(results[d]["ok"] for d in deps):
+                    running[pool.submit(timed, fn)] = job_id
+                else:
+                    results[job_id] = {"ok": False, "seconds": 0.0, "error": "dependency failed"}
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id = running.pop(future)
+                results[job_id] = future.result()
+                status = "done" if results[job_id]["ok"] else "FAILED"
+                print(f"[{len(results)}/{len(jobs)}] {job_id}: {status} ({results[job_id]['seconds']:.2f}s)")
+    return results
+
+
+def graph_job(graph, log_path):
+    """A job that runs `graph`, logging its plan and the stage scripts' output to `log_path`."""
+    def run():
+        with open(log_path, 'a') as log:
+            return graph.run(out=log)
+    return run
+
+
+def run_sweep(configs, sweep_dir, workers=4):
+    """
+    Schedule every preprocessing, training, generation and evaluation job needed
+    by `configs`, sharing the preprocessing and training jobs between configurations.
+
+    Returns:
+        list of result rows (dicts), one per configuration.
+    """
+    log_dir = os.path.join(sweep_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    # One cache of raw file hashes for every preprocessing job, saved once at the end
+    hash_cache = HashCache()
+    jobs = {}
+    processed_steps = {}
+    model_steps = {}
+    rows = []
+
+    def log_path(job_id):
+        return os.path.join(log_dir, job_id + ".log")
+
+    def add_job(job_id, deps, graph):
+        jobs[job_id] = (deps, graph_job(graph, log_path(job_id)))
+
+    for config in configs:
+        genres, chord_strategy, order = config["genres"], config["chord_strategy"], config["order"]
+        representation = config["representation"]
+        data_name = f"{join_genres(genres)}_{chord_strategy}{representation_suffix(representation)}"
+        data_id = f"preprocess_{data_name}"
+        model_id = f"train_{data_name}_{order}"
+
+        if data_id not in processed_steps:
+            graph = BuildGraph()
+            processed_steps[data_id] = add_preprocess_step(graph, genres, chord_strategy, log_path(data_id),
+                                                           representation, hash_cache=hash_cache)
+            add_job(data_id, [], graph)
+
+        if model_id not in model_steps:
+            graph = BuildGraph()
+            model_steps[model_id] = add_train_step(graph, processed_steps[data_id], genres, chord_strategy, order,
+                                                 log_path(model_id))
+            add_job(model_id, [data_id], graph)
+
+        cid = config["config_id"]
+        sample_dir = os.path.join("outputs", "sweeps", os.path.basename(sweep_dir), cid)
+        eval_dir = os.path.join(sweep_dir, cid)
+
+        graph = BuildGraph()
+        samples = add_generate_step(graph, model_steps[model_id], sample_dir,
+                                    config["num_samples"], config["bpm"], config["length"], config["key"],
+                                    config["seed"], log=log_path("generate_" + cid), decode=config["decode"])
+        add_job("generate_" + cid, [model_id], graph)
+
+        graph = BuildGraph()
+        add_evaluate_step(graph, samples, eval_dir, log_path("evaluate_" + cid))
+        add_job("evaluate_" + cid, ["generate_" + cid], graph)
+
+        rows.append((config, data_id, model_id, eval_dir))
+
+    print(f"Running {len(jobs)} jobs for {len(configs)} configurations on {workers} workers...")
+    try:
+        results = run_jobs(jobs, workers)
+    finally:
+        hash_cache.save()
+
+    table = []
+    for config, data_id, model_id, eval_dir in rows:
+        cid = config["config_id"]
+        stages = {
+            "preprocess": results[data_id],
+            "train": results[model_id],
+            "generate": results["generate_" + cid],
+            "evaluate": results["evaluate_" + cid],
+        }
+        row = {
+            "config_id": cid,
+            "genres": join_genres(config["genres"]),
+            "chord_strategy": config["chord_strategy"],
+            "representation": config["representation"],
+            "order": config["order"],
+            "key": config["key"] or "",
+            "bpm": config["bpm"],
+            "length": config["length"],
+            "num_samples": config["num_samples"],
+            "seed": "" if config["seed"] is None else config["seed"],
+            "decode": config["decode"],
+            "status": "ok" if all(r["ok"] for r in stages.values())
+                      else "failed: " + ", ".join(name for name, r in stages.items() if not r["ok"]),
+        }
+        for name, result in stages.items():
+            row[f"{name}_seconds"] = round(result["seconds"], 4)
+
+        metrics = {}
+        if stages["evaluate"]["ok"]:
+            with open(os.path.join(eval_dir, "metrics.json"), 'r') as f:
+                metrics = json.load(f)
+        for metric in METRICS:
+            row[metric] = metrics.get(metric, "")
+        table.append(row)
+
+    return table
+
+
+def save_results(rows, path):
+    """Write result rows to a CSV file."""
+    if not rows:
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+    atomic_write_bytes(path, buffer.getvalue().encode())
+    print(f"Saved results to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train, generate and evaluate over a grid of configurations"
+    )
+    parser.add_argument(
+        "--config", "-c",
+        required=True,
+        help="Path to a JSON file describing the configuration grid"
+    )
+    parser.add_argument(
+        "--name", "-n",
+        default=None,
+        help="Name of the sweep, used for evaluation/sweeps/[NAME]. Defaults to the config file name"
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of jobs to run at once. Defaults to the number of CPUs"
+    )
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        grid = json.load(f)
+    name = args.name or os.path.splitext(os.path.basename(args.config))[0]
+    sweep_dir = os.path.join("evaluation", "sweeps", name)
+
+    configs = expand_grid(grid)
+
+    print("="*50)
+    print(f"Sweep {name}: {len(configs)} configurations")
+    print("="*50)
+
+    start_time = time.time()
+    rows = run_sweep(configs, sweep_dir, workers=args.workers)
+    save_results(rows, os.path.join(sweep_dir, "results.csv"))
+    end_time = time.time()
+
+    failed = sum(1 for row in rows if row["status"] != "ok")
+    print("="*50)
+    print(f"\nFinished sweep in {end_time - start_time:.2f} seconds")
+    print(f"{len(rows) - failed} configurations succeeded, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()